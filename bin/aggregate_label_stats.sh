@@ -0,0 +1,78 @@
+#!/bin/bash
+
+module load apptainer/1.4.1
+
+scriptPath=$(readlink -f "$0")
+scriptDir=$(dirname "${scriptPath}")
+# Repo base dir under which we find bin/ and containers/
+repoDir=${scriptDir%/bin}
+
+container="${repoDir}/containers/antsnetct-0.6.2.sif"
+
+function usage() {
+  echo "Usage:
+  $0 -i ihmt_t1w_dataset -o store_dir [-f parquet/feather]
+  "
+}
+
+if [[ $# -eq 0 ]]; then
+  usage
+  exit 1
+fi
+
+function help() {
+cat << HELP
+  `usage`
+
+  Wrapper script to aggregate per-session label stats into a cohort-wide columnar store.
+
+  Required args:
+
+    -i ihmt_t1w_dataset : BIDS dataset dir, containing the label stats computed by label_stats.sh.
+
+    -o store_dir : Output directory for the aggregated stats. If it exists, it is updated with new or modified stats.
+
+  Optional args:
+
+    -f format : "parquet" (default) or "feather".
+
+
+  Output:
+
+    One file per atlas and table, in store_dir/atlas=<atlas>/. QC brain stats are stored under atlas=qc.
+
+
+HELP
+
+}
+
+input_dataset=""
+store_dir=""
+store_format="parquet"
+
+while getopts "f:i:o:h" opt; do
+  case $opt in
+    f) store_format=$OPTARG;;
+    i) input_dataset=$OPTARG;;
+    o) store_dir=$OPTARG;;
+    h) help; exit 1;;
+    \?) echo "Unknown option $OPTARG"; exit 2;;
+    :) echo "Option $OPTARG requires an argument"; exit 2;;
+  esac
+done
+
+date=`date +%Y%m%d`
+
+mkdir -p ${input_dataset}/code/logs ${store_dir}
+
+export APPTAINERENV_TMPDIR="/tmp"
+
+bsub -M 8GB -cwd . -o "${input_dataset}/code/logs/aggregate_label_stats_${date}_%J.txt" \
+    apptainer exec \
+      --containall \
+      -B /scratch:/tmp,${input_dataset},${store_dir},${repoDir} \
+      ${container} \
+        ${repoDir}/scripts/aggregate_label_stats.py \
+          --input-dataset ${input_dataset} \
+          --store ${store_dir} \
+          --format ${store_format}
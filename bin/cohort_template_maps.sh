@@ -0,0 +1,106 @@
+#!/bin/bash
+
+module load apptainer/1.4.1
+
+scriptPath=$(readlink -f "$0")
+scriptDir=$(dirname "${scriptPath}")
+# Repo base dir under which we find bin/ and containers/
+repoDir=${scriptDir%/bin}
+
+container="${repoDir}/containers/antsnetct-0.6.2.sif"
+
+function usage() {
+  echo "Usage:
+  $0 -a antsnetct_dataset -i ihmt_t1w_dataset -o output_dir -t template_image -n template_name [-p threads] session_list.csv
+  "
+}
+
+if [[ $# -eq 0 ]]; then
+  usage
+  exit 1
+fi
+
+function help() {
+cat << HELP
+  `usage`
+
+  Wrapper script to make cohort mean and SD maps of the ihMTR in template space.
+
+  Each session's ihMTR is resampled to the template through its T1w, and added to running mean and variance maps, so the
+  cohort is processed in a single pass without holding it in memory.
+
+  Required args:
+
+    -a antsnetct_dataset : antsnetct dataset, containing the T1w to template transforms.
+
+    -i ihmt_t1w_dataset : BIDS dataset dir, containing the ihMTR images and the T1w to ihMT transforms written by
+      register_t1w_to_ihmt.sh.
+
+    -o output_dir : Output directory for the cohort maps.
+
+    -t template_image : Template image, defining the output grid.
+
+    -n template_name : Template name in the antsnetct transform names, eg ADNINormalAgingANTs.
+
+  Optional args:
+
+    -p threads : Number of sessions to resample concurrently (default 2).
+
+  session_list.csv : CSV file with participant,session to include, one per line, no header.
+
+
+  Output:
+
+    Mean, SD and count maps in output_dir, and a list of the sessions that were included.
+
+
+HELP
+
+}
+
+antsnetct_dataset=""
+input_dataset=""
+output_dir=""
+template_image=""
+template_name=""
+threads=2
+
+while getopts "a:i:n:o:p:t:h" opt; do
+  case $opt in
+    a) antsnetct_dataset=$OPTARG;;
+    i) input_dataset=$OPTARG;;
+    n) template_name=$OPTARG;;
+    o) output_dir=$OPTARG;;
+    p) threads=$OPTARG;;
+    t) template_image=$(readlink -f "$OPTARG");;
+    h) help; exit 1;;
+    \?) echo "Unknown option $OPTARG"; exit 2;;
+    :) echo "Option $OPTARG requires an argument"; exit 2;;
+  esac
+done
+
+shift $((OPTIND-1))
+
+sessionList=$(readlink -f "$1")
+
+date=`date +%Y%m%d`
+
+mkdir -p ${output_dir}/logs
+
+export APPTAINERENV_TMPDIR="/tmp"
+
+export APPTAINERENV_ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=1
+
+bsub -M 8GB -n ${threads} -cwd . -o "${output_dir}/logs/cohort_template_maps_${date}_%J.txt" \
+    apptainer exec \
+      --containall \
+      -B /scratch:/tmp,${antsnetct_dataset},${input_dataset},${output_dir},$(dirname ${template_image}),$(dirname ${sessionList}),${repoDir} \
+      ${container} \
+        ${repoDir}/scripts/cohort_template_maps.py \
+          --antsnetct-dataset ${antsnetct_dataset} \
+          --input-dataset ${input_dataset} \
+          --template-image ${template_image} \
+          --template-name ${template_name} \
+          --session-list ${sessionList} \
+          --output-dir ${output_dir} \
+          --threads ${threads}
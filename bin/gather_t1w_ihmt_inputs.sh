@@ -13,7 +13,7 @@ container="${repoDir}/containers/antsnetct-0.6.2.sif"
 
 function usage() {
   echo "Usage:
-  $0 -a antsnetct_dataset -o output_dataset -q ihmt_dir subj_sess_list.csv
+  $0 -a antsnetct_dataset -o output_dataset -q ihmt_dir [-S i/N] subj_sess_list.csv
   "
 }
 
@@ -38,7 +38,10 @@ cat << HELP
     -q ihmt_dir : ihmt_proc output directory containing the ihmt-weighted images. This is not a BIDS
        dataset, the script looks for files in 'ihmt_dir/sub-<participant>/ses-<session>/output'
 
+  Options:
 
+    -S i/N : Only gather shard i of N of the session list, 1 <= i <= N, so a large cohort can be gathered by several
+       jobs. Sessions are assigned to shards by a hash of the participant.
 
   Positional args:
 
@@ -68,12 +71,14 @@ HELP
 antsnetct_dataset=""
 output_dataset=""
 ihmt_dir=""
+shardArgs=()
 
-while getopts "a:o:q:h" opt; do
+while getopts "a:o:q:S:h" opt; do
   case $opt in
     a) antsnetct_dataset=$OPTARG;;
     o) output_dataset=$OPTARG;;
     q) ihmt_dir=$OPTARG;;
+    S) shardArgs=(--shard $OPTARG);;
     h) help; exit 1;;
     \?) echo "Unknown option $OPTARG"; exit 2;;
     :) echo "Option $OPTARG requires an argument"; exit 2;;
@@ -98,5 +103,6 @@ bsub -M 8GB -cwd . -o "${output_dataset}/code/logs/gather_t1w_ihmt_inputs_${date
         ${repoDir}/scripts/gather_t1w_ihmt_inputs.py \
           --antsnetct-dataset ${antsnetct_dataset} \
           --session-list ${imageList} \
+          "${shardArgs[@]}" \
           --ihmt-dir ${ihmt_dir} \
           --output-dataset ${output_dataset}
@@ -13,7 +13,7 @@ container="${repoDir}/containers/antsnetct-0.6.2.sif"
 
 function usage() {
   echo "Usage:
-  $0 -i ihmt_t1w_dataset subj_sess_list.csv
+  $0 -i ihmt_t1w_dataset [-s description=pattern ...] [-p] [-w shm_mb] [-k] [-S i/N] [-u] subj_sess_list.csv
   "
 }
 
@@ -33,6 +33,28 @@ cat << HELP
     -i ihmt_t1w_dataset : BIDS dataset dir, containing the ihMT images and labels from the T1w space. Output is to the same
                           dataset.
 
+  Optional args:
+
+    -s description=pattern : scalar image to summarize within each atlas, as a glob relative to the session anat
+                             directory, eg -s ihMTsat='*_ihMTsat.nii.gz'. May be repeated. Default is the ihMTR only.
+                             All scalars and atlases are summarized in one pass.
+
+    -p : Also compute partial-volume weighted stats of the atlases transferred from the T1w, written to
+         _seg-<atlas>_desc-partialvolume_scalarstats.tsv. Requires registration with register_t1w_to_ihmt.sh -p.
+
+    -w shm_mb : RAM in MB that may be used for intermediate files. If /dev/shm and the job have this much to spare,
+         the working directory is placed on /dev/shm instead of /scratch. Files on /dev/shm count against the job
+         memory. The size of the working directory is recorded in the completion manifest.
+
+    -k : Keep the working directory, for debugging.
+
+    -S i/N : Only submit shard i of N of the session list, 1 <= i <= N. Sessions are assigned to shards by a hash of
+             the participant, so the shards are disjoint, and all sessions of a participant are in the same shard.
+
+    -u : Only submit sessions that are not done, according to the label stats manifests in the dataset. Stage
+         parameters are not checked. To find sessions that need rerunning with new options, use
+         pipeline_status.py --stage labelstats --parameter name=value --todo-list, and submit the todo list.
+
   Positional args:
 
     subj_sess_list.csv : CSV file with participants and sessions to process, one per line, no header.
@@ -40,7 +62,8 @@ cat << HELP
 
   Output:
 
-    For each of seg-dkt31 and seg-hoa, label stats are computed on the ihMTR image.
+    For each of seg-dkt31, seg-hoa and seg-dkt31wmlobes, label stats are computed on the ihMTR image, and the
+    scalar stats of all scalar images are written to _seg-<atlas>_scalarstats.tsv.
 
 
 
@@ -53,10 +76,23 @@ antsnetct_dataset=""
 input_dataset=""
 mask_method=""
 output_dataset=""
-
-while getopts "i:h" opt; do
+scalarArgs=()
+partialVolumeArgs=()
+workDirArgs=()
+shmBind=""
+shardArgs=()
+skipDone=0
+
+while getopts "i:kps:S:uw:h" opt; do
   case $opt in
     i) input_dataset=$OPTARG;;
+    k) workDirArgs+=(--keep-work-dir);;
+    p) partialVolumeArgs=(--partial-volume);;
+    s) scalarArgs+=(--scalar "$OPTARG");;
+    S) shardArgs=(--shard $OPTARG);;
+    u) skipDone=1;;
+    w) workDirArgs+=(--work-dir-shm-mb $OPTARG)
+       shmBind=",/dev/shm";;
     h) help; exit 1;;
     \?) echo "Unknown option $OPTARG"; exit 2;;
     :) echo "Option $OPTARG requires an argument"; exit 2;;
@@ -67,6 +103,11 @@ shift $((OPTIND - 1))
 
 imageList=$(readlink -f "$1")
 
+todoArgs=()
+if [[ ${skipDone} -eq 1 ]]; then
+  todoArgs=(--dataset ${input_dataset} --stage labelstats)
+fi
+
 date=`date +%Y%m%d`
 
 mkdir -p ${input_dataset}/code/logs
@@ -78,9 +119,7 @@ nthreads=2
 export APPTAINERENV_ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=$nthreads
 export APPTAINERENV_OMP_NUM_THREADS=$nthreads
 
-for line in $(cat ${imageList}); do
-  participant=$(echo ${line} | cut -d ',' -f 1)
-  session=$(echo ${line} | cut -d ',' -f 2)
+while IFS=, read -r participant session; do
 
   echo "Submitting label stats for participant ${participant}, session ${session}"
 
@@ -91,14 +130,17 @@ for line in $(cat ${imageList}); do
     -J "labelStats_${participant}_${session}" \
     apptainer exec \
       --containall \
-      -B /scratch:/tmp,${input_dataset},${repoDir},${imageList} \
+      -B /scratch:/tmp,${input_dataset},${repoDir},${imageList}${shmBind} \
       ${container} \
         ${repoDir}/scripts/label_stats_plus.py \
         --input-dataset ${input_dataset} \
         --label-def-dir ${repoDir}/label_def \
         --participant ${participant} \
         --session ${session} \
+        "${scalarArgs[@]}" \
+        "${partialVolumeArgs[@]}" \
+        "${workDirArgs[@]}" \
         --verbose
   sleep 1
 
-done
+done < <(python3 ${repoDir}/scripts/session_lists.py --session-list ${imageList} "${shardArgs[@]}" "${todoArgs[@]}")
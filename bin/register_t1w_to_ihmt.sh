@@ -13,7 +13,7 @@ container="${repoDir}/containers/antsnetct-0.6.2.sif"
 
 function usage() {
   echo "Usage:
-  $0 -a antsnetct_dataset -i gathered_input_dataset -o output_dataset -m mask_method subj_sess_list.csv
+  $0 -a antsnetct_dataset -i gathered_input_dataset -o output_dataset -m mask_method [-l] [-p] [-c cache_dir] [-w shm_mb] [-k] [-S i/N] [-u] subj_sess_list.csv
   "
 }
 
@@ -39,7 +39,35 @@ cat << HELP
 
     -m mask_method :  method for selecting brain masks for T1w images. Options are "synthstrip",
                       "synthstrip_no_csf", or "no_synthstrip". If the latter, masks from antsnetct (hd-bet)
-                      for T1w and will probably crash because nothing has been done for ihMT yet.
+                      for T1w and will probably crash because nothing has been done for ihMT yet. A comma-separated
+                      list of methods, eg "synthstrip,synthstrip_no_csf", registers with each of them in one job, and
+                      keeps the registration that best aligns the T1w and ihMTR.
+
+  Options:
+
+    -l : Longitudinal mode. The ihMTR of each session is registered to a single-subject T1w template (SST),
+         built once per participant from all of their sessions in the input dataset. Sessions of the same
+         participant may run at the same time; the first to run builds the SST.
+
+    -p : Also write a sparse partial-volume operator of the atlases with label definitions, computed from the
+         T1w-resolution atlases, for partial-volume weighted label stats (label_stats.sh -p).
+
+    -c cache_dir : Registration cache directory. Registrations are stored here, keyed by the contents of their
+         inputs and parameters, and reused by later runs with the same inputs. The cache may be shared between
+         output datasets.
+
+    -w shm_mb : RAM in MB that may be used for intermediate files. If /dev/shm and the job have this much to spare,
+         the working directory is placed on /dev/shm instead of /scratch. Files on /dev/shm count against the job
+         memory. The size of the working directory is recorded in the completion manifest.
+
+    -k : Keep the working directory, for debugging.
+
+    -S i/N : Only submit shard i of N of the session list, 1 <= i <= N. Sessions are assigned to shards by a hash of
+         the participant, so the shards are disjoint, and all sessions of a participant are in the same shard.
+
+    -u : Only submit sessions that are not done, according to the registration manifests in the output dataset.
+         Stage parameters are not checked. To find sessions that need rerunning with new options, use
+         pipeline_status.py --stage register --parameter name=value --todo-list, and submit the todo list.
 
   Positional args:
 
@@ -59,13 +87,32 @@ antsnetct_dataset=""
 input_dataset=""
 mask_method=""
 output_dataset=""
-
-while getopts "a:i:m:o:h" opt; do
+longitudinalArgs=()
+partialVolumeArgs=()
+cacheArgs=()
+cacheBind=""
+workDirArgs=()
+shmBind=""
+shardArgs=()
+skipDone=0
+
+while getopts "a:c:i:klm:o:pS:uw:h" opt; do
   case $opt in
     a) antsnetct_dataset=$OPTARG;;
+    c) cacheDir=$(readlink -f "$OPTARG")
+       mkdir -p ${cacheDir}
+       cacheArgs=(--registration-cache-dir ${cacheDir})
+       cacheBind=",${cacheDir}";;
     i) input_dataset=$OPTARG;;
+    k) workDirArgs+=(--keep-work-dir);;
+    l) longitudinalArgs=(--longitudinal);;
     m) mask_method=$OPTARG;;
     o) output_dataset=$OPTARG;;
+    p) partialVolumeArgs=(--partial-volume-labels);;
+    S) shardArgs=(--shard $OPTARG);;
+    u) skipDone=1;;
+    w) workDirArgs+=(--work-dir-shm-mb $OPTARG)
+       shmBind=",/dev/shm";;
     h) help; exit 1;;
     \?) echo "Unknown option $OPTARG"; exit 2;;
     :) echo "Option $OPTARG requires an argument"; exit 2;;
@@ -76,6 +123,16 @@ shift $((OPTIND - 1))
 
 imageList=$(readlink -f "$1")
 
+maskArgs=(--registration-mask-strategy ${mask_method})
+if [[ ${mask_method} == *,* ]]; then
+  maskArgs=(--sweep-mask-strategies ${mask_method})
+fi
+
+todoArgs=()
+if [[ ${skipDone} -eq 1 ]]; then
+  todoArgs=(--dataset ${output_dataset} --stage register)
+fi
+
 date=`date +%Y%m%d`
 
 mkdir -p ${output_dataset}/code/logs
@@ -87,9 +144,7 @@ nthreads=2
 export APPTAINERENV_ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=$nthreads
 export APPTAINERENV_OMP_NUM_THREADS=$nthreads
 
-for line in $(cat ${imageList}); do
-  participant=$(echo ${line} | cut -d ',' -f 1)
-  session=$(echo ${line} | cut -d ',' -f 2)
+while IFS=, read -r participant session; do
 
   echo "Submitting registration for participant ${participant}, session ${session}"
 
@@ -100,16 +155,20 @@ for line in $(cat ${imageList}); do
     -J "regT1wihMT_${participant}_${session}" \
     apptainer exec \
       --containall \
-      -B /scratch:/tmp,${antsnetct_dataset},${input_dataset},${output_dataset},${repoDir},${imageList} \
+      -B /scratch:/tmp,${antsnetct_dataset},${input_dataset},${output_dataset},${repoDir},${imageList}${cacheBind}${shmBind} \
       ${container} \
         ${repoDir}/scripts/register_t1w_to_ihmt_plus.py \
         --antsnetct-dataset ${antsnetct_dataset} \
         --input-dataset ${input_dataset} \
-        --registration-mask-strategy ${mask_method} \
+        "${maskArgs[@]}" \
         --output-dataset ${output_dataset} \
         --participant ${participant} \
         --session ${session} \
+        "${longitudinalArgs[@]}" \
+        "${partialVolumeArgs[@]}" \
+        "${cacheArgs[@]}" \
+        "${workDirArgs[@]}" \
         --verbose
   sleep 1
 
-done
+done < <(python3 ${repoDir}/scripts/session_lists.py --session-list ${imageList} "${shardArgs[@]}" "${todoArgs[@]}")
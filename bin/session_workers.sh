@@ -0,0 +1,107 @@
+#!/bin/bash
+
+module load apptainer/1.4.1
+
+scriptPath=$(readlink -f "$0")
+scriptDir=$(dirname "${scriptPath}")
+# Repo base dir under which we find bin/ and containers/
+repoDir=${scriptDir%/bin}
+
+container="${repoDir}/containers/antsnetct-0.6.2.sif"
+
+function usage() {
+  echo "Usage:
+  $0 -q queue_dir -b bind_dirs [-n num_workers] [-t max_tasks] [-r max_rss_mb]
+  "
+}
+
+if [[ $# -lt 2 ]]; then
+  usage
+  exit 1
+fi
+
+function help() {
+cat << HELP
+  `usage`
+
+  Submit worker jobs that run queued sessions, importing the pipeline once per worker rather than once per session.
+
+  Add sessions to the queue first, eg
+
+    python3 ${repoDir}/scripts/session_worker.py submit --queue-dir /path/to/queue --stage labelstats \\
+      --session-list lists/test_batch.txt -- --input-dataset /path/to/t1wToihMT --label-def-dir ${repoDir}/label_def
+
+  Required args:
+
+    -q queue_dir : Queue directory the sessions were submitted to.
+
+    -b bind_dirs : Comma-separated list of the dataset directories the queued sessions read and write.
+
+  Options:
+
+    -n num_workers : Number of worker jobs to submit (default 4).
+
+    -t max_tasks : Number of sessions a worker process runs before it is replaced by a fresh one (default 50).
+
+    -r max_rss_mb : Replace a worker process after a session if its memory exceeds this many MB.
+
+  Output:
+
+  Sessions write to their datasets as when they are submitted individually. Worker logs are written to
+  queue_dir/logs, and finished sessions are recorded in queue_dir/done and queue_dir/failed.
+
+
+HELP
+
+}
+
+queue_dir=""
+bind_dirs=""
+num_workers=4
+max_tasks=50
+rssArgs=()
+
+while getopts "b:hn:q:r:t:" opt; do
+  case $opt in
+    b) bind_dirs=$OPTARG;;
+    n) num_workers=$OPTARG;;
+    q) queue_dir=$(readlink -f "$OPTARG");;
+    r) rssArgs=(--max-rss-mb "$OPTARG");;
+    t) max_tasks=$OPTARG;;
+    h) help; exit 1;;
+    \?) echo "Unknown option $OPTARG"; exit 2;;
+    :) echo "Option $OPTARG requires an argument"; exit 2;;
+  esac
+done
+
+date=`date +%Y%m%d`
+
+mkdir -p ${queue_dir}/logs
+
+export APPTAINERENV_TMPDIR="/tmp"
+
+nthreads=2
+
+export APPTAINERENV_ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=$nthreads
+export APPTAINERENV_OMP_NUM_THREADS=$nthreads
+
+for worker in $(seq 1 ${num_workers}); do
+
+  echo "Submitting worker ${worker} for queue ${queue_dir}"
+
+  bsub \
+    -cwd . \
+    -o "${queue_dir}/logs/session_worker_${worker}_${date}_%J.txt" \
+    -n $nthreads \
+    -J "sessionWorker_${worker}" \
+    apptainer exec \
+      --containall \
+      -B /scratch:/tmp,${bind_dirs},${queue_dir},${repoDir} \
+      ${container} \
+        ${repoDir}/scripts/session_worker.py work \
+        --queue-dir ${queue_dir} \
+        --max-tasks ${max_tasks} \
+        "${rssArgs[@]}"
+  sleep 1
+
+done
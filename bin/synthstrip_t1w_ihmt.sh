@@ -11,7 +11,7 @@ container="${repoDir}/containers/freesurfer-8.1.0.sif"
 
 function usage() {
   echo "Usage:
-  $0 [-h] [-c 0/1] -i input_ds subj_sess_list.csv
+  $0 [-h] [-c 0/1] [-n cores] [-S i/N] -i input_ds subj_sess_list.csv
   "
 }
 
@@ -29,8 +29,10 @@ cat << HELP
   used to provide a consistent brain extraction across modalities for registration, and are independent of ihmt_proc or the
   antsnetct processing.
 
-  Images are run serially, each takes a couple of minutes. Full parallel processing is not implemented to limit memory
-  usage, but it should be safe to submit a few batches in parallel.
+  Images are masked in parallel, with the job's cores divided between concurrent synthstrip processes. The number of
+  threads per process is planned from per-image times measured on the first images, which are cached in
+  input_ds/code/synthstrip_timings.json. Existing masks are checked, and remade if they are incomplete, empty, do not
+  match their image, or are older than it.
 
   Required args:
 
@@ -41,6 +43,13 @@ cat << HELP
     -c 0/1
         If 1, additional masks without CSF are created. Default is 0.
 
+    -n cores
+        Number of cores to request. Default is 8. Each synthstrip process uses about 3 GB of memory.
+
+    -S i/N
+        Only mask shard i of N of the session list, 1 <= i <= N, so a large cohort can be split across several jobs.
+        Sessions are assigned to shards by a hash of the participant.
+
   Positional args:
 
     subj_sess_list.csv
@@ -64,11 +73,15 @@ HELP
 imageList=""
 inputBIDS=""
 doNoCSFMask=0
+cores=8
+shardArgs=()
 
-while getopts "i:c:h" opt; do
+while getopts "i:c:n:S:h" opt; do
   case $opt in
     i) inputBIDS=$OPTARG;;
     c) doNoCSFMask=$OPTARG;;
+    n) cores=$OPTARG;;
+    S) shardArgs=(--shard $OPTARG);;
     h) help; exit 1;;
     \?) echo "Unknown option $OPTARG"; exit 2;;
     :) echo "Option $OPTARG requires an argument"; exit 2;;
@@ -93,13 +106,24 @@ date=`date +%Y%m%d`
 
 mkdir -p ${inputBIDS}/code/logs
 
+noCSFArgs=()
+if [[ $doNoCSFMask -gt 0 ]]; then
+  noCSFArgs=(--no-csf)
+fi
+
+memGB=$((cores * 3 + 2))
+
 bsub \
   -cwd . \
-  -n 2 \
+  -n ${cores} \
+  -M ${memGB}GB \
   -J synthstrip_t1w_qsm \
   -o "${inputBIDS}/code/logs/synthstrip_t1w_ihmt_${date}_%J.txt" \
-    ${repoDir}/scripts/synthstrip_t1w_ihmt.sh \
-      -f ${container} \
-      -i ${inputBIDS} \
-      -c ${doNoCSFMask} \
-      ${imageList}
\ No newline at end of file
+    python3 ${repoDir}/scripts/synthstrip_parallel.py \
+      --container ${container} \
+      --input-dataset ${inputBIDS} \
+      --session-list ${imageList} \
+      --cores ${cores} \
+      --memory-gb $((memGB - 2)) \
+      "${shardArgs[@]}" \
+      "${noCSFArgs[@]}"
\ No newline at end of file
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import logging
+import os
+import re
+import sys
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Columns added to every row, identifying where it came from
+ID_COLUMNS = ['participant', 'session', 'atlas', 'source']
+
+SOURCES_INDEX = '_sources.tsv'
+
+# sub-<participant>_ses-<session>_..._seg-<atlas>_<table>.tsv
+LABEL_STATS_PATTERN = re.compile(r'^sub-(?P<participant>[^_]+)_ses-(?P<session>[^_]+)_.*_seg-(?P<atlas>[^_]+)_'
+                                 r'(?P<table>.+)\.tsv$')
+QC_STATS_PATTERN = re.compile(r'^sub-(?P<participant>[^_]+)_ses-(?P<session>[^_]+)_.*_desc-qc_brainstats\.tsv$')
+
+# Helps with CLI help formatting
+class RawDefaultsHelpFormatter(
+    argparse.RawTextHelpFormatter, argparse.ArgumentDefaultsHelpFormatter
+):
+    pass
+
+def aggregate_label_stats():
+
+    parser = argparse.ArgumentParser(formatter_class=RawDefaultsHelpFormatter, add_help = False,
+                                     description='''Aggregate per-session label stats into a cohort-wide columnar store.
+
+    All label stats TSV files (seg-dkt31, seg-hoa, seg-dkt31wmlobes, ...) and QC brain stats
+    (_desc-qc_brainstats.tsv) in the dataset are merged into one file per atlas and table, partitioned by atlas:
+
+        <store>/atlas=dkt31/<table>.parquet
+        <store>/atlas=hoa/<table>.parquet
+        <store>/atlas=qc/brainstats.parquet
+
+    Each row has the columns of the source TSV plus participant, session, atlas and source (the TSV path relative to
+    the dataset).
+
+    The store is updated incrementally. The size and mtime of every source TSV are recorded in the store, and on each run
+    only new or modified TSVs are read; rows from TSVs that have been modified or removed are replaced.
+
+    Parquet output requires pyarrow. To read the store from analysis code:
+
+        from aggregate_label_stats import read_label_stats
+        df = read_label_stats(store, atlas='dkt31', participants=['001', '002'])
+
+    ''')
+    required_parser = parser.add_argument_group('Required arguments')
+    required_parser.add_argument('--input-dataset', help='BIDS dataset containing the label stats, as produced by '
+                                 'label_stats_plus.py', type=str, required=True)
+    required_parser.add_argument('--store', help='Output directory for the aggregated stats', type=str, required=True)
+
+    optional_parser = parser.add_argument_group('General optional arguments')
+    optional_parser.add_argument('--format', help='Storage format, "parquet" or "feather"', type=str, default='parquet',
+                                 choices=['parquet', 'feather'])
+    optional_parser.add_argument('--threads', help='Number of TSV files to read concurrently', type=int, default=8)
+    optional_parser.add_argument('-h', '--help', action='help', help='show this help message and exit')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+        print(f"\nRun {os.path.basename(sys.argv[0])} --help for more information")
+        sys.exit(1)
+
+    args = parser.parse_args()
+
+    logger.info("Parsed args: " + str(args))
+
+    update_store(args.input_dataset, args.store, store_format=args.format, threads=args.threads)
+
+
+def find_stats_files(dataset):
+    """
+    Find label stats and QC stats TSV files in a dataset.
+
+    Args:
+        dataset (str): BIDS dataset.
+
+    Returns:
+        dict: relative path -> dict with keys participant, session, atlas, table, size, mtime_ns.
+    """
+    stats_files = dict()
+
+    for tsv_file in glob.glob(os.path.join(dataset, 'sub-*', 'ses-*', 'anat', '*.tsv')):
+        file_name = os.path.basename(tsv_file)
+        match = QC_STATS_PATTERN.match(file_name)
+        if match is not None:
+            atlas, table = 'qc', 'brainstats'
+        else:
+            match = LABEL_STATS_PATTERN.match(file_name)
+            if match is None:
+                continue
+            atlas, table = match.group('atlas'), match.group('table')
+
+        stat = os.stat(tsv_file)
+        stats_files[os.path.relpath(tsv_file, dataset)] = {
+            'participant': match.group('participant'),
+            'session': match.group('session'),
+            'atlas': atlas,
+            'table': table,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns
+        }
+
+    return stats_files
+
+
+def read_stats_file(dataset, rel_path, info):
+    """
+    Read one stats TSV file, adding the ID columns.
+
+    Args:
+        dataset (str): BIDS dataset.
+        rel_path (str): path to the TSV file relative to the dataset.
+        info (dict): file info from find_stats_files.
+
+    Returns:
+        DataFrame: the stats.
+    """
+    df = pd.read_csv(os.path.join(dataset, rel_path), sep='\t')
+    df.insert(0, 'source', rel_path)
+    df.insert(0, 'atlas', info['atlas'])
+    df.insert(0, 'session', info['session'])
+    df.insert(0, 'participant', info['participant'])
+    return df
+
+
+def get_partition_path(store, atlas, table, store_format):
+    """
+    Get the path to a partition file in the store.
+
+    Args:
+        store (str): store directory.
+        atlas (str): atlas name, or 'qc'.
+        table (str): table name, from the TSV file name after the seg entity.
+        store_format (str): 'parquet' or 'feather'.
+
+    Returns:
+        str: partition path.
+    """
+    return os.path.join(store, f"atlas={atlas}", f"{table}.{store_format}")
+
+
+def _write_atomic(df, path, store_format):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    os.close(fd)
+    try:
+        if store_format == 'parquet':
+            df.to_parquet(tmp_path, index=False)
+        elif store_format == 'feather':
+            df.to_feather(tmp_path)
+        else:
+            df.to_csv(tmp_path, sep='\t', index=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _partition_columns(path, store_format):
+    # Read only the schema, both formats are read with pyarrow
+    if store_format == 'parquet':
+        import pyarrow.parquet
+        return pyarrow.parquet.read_schema(path).names
+    import pyarrow.ipc
+    with pyarrow.ipc.open_file(path) as reader:
+        return reader.schema.names
+
+
+def _read_partition(path, store_format, **kwargs):
+    if store_format == 'parquet':
+        return pd.read_parquet(path, **kwargs)
+    return pd.read_feather(path, **kwargs)
+
+
+def update_store(dataset, store, store_format='parquet', threads=8):
+    """
+    Incrementally update the label stats store from a dataset.
+
+    Args:
+        dataset (str): BIDS dataset containing the label stats.
+        store (str): store directory.
+        store_format (str): 'parquet' or 'feather'.
+        threads (int): number of TSV files to read concurrently.
+    """
+    sources_index = os.path.join(store, SOURCES_INDEX)
+
+    if os.path.exists(sources_index):
+        indexed = pd.read_csv(sources_index, sep='\t', dtype={'participant': str, 'session': str})
+        if len(indexed) > 0 and indexed['format'].iloc[0] != store_format:
+            raise ValueError(f"Store {store} is in {indexed['format'].iloc[0]} format, not {store_format}")
+        indexed = indexed.set_index('path').to_dict(orient='index')
+    else:
+        indexed = dict()
+
+    current = find_stats_files(dataset)
+
+    changed = [path for path, info in current.items() if path not in indexed or
+               (indexed[path]['size'], indexed[path]['mtime_ns']) != (info['size'], info['mtime_ns'])]
+    removed = [path for path in indexed if path not in current]
+
+    logger.info(f"Found {len(current)} stats files: {len(changed)} new or modified, {len(removed)} removed")
+
+    if len(changed) == 0 and len(removed) == 0:
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        new_frames = list(executor.map(lambda path: read_stats_file(dataset, path, current[path]), changed))
+
+    # Group the new rows and the stale sources by partition
+    partitions = dict()
+    for path, df in zip(changed, new_frames):
+        key = (current[path]['atlas'], current[path]['table'])
+        partitions.setdefault(key, {'new': [], 'drop': set()})
+        partitions[key]['new'].append(df)
+        partitions[key]['drop'].add(path)
+    for path in removed:
+        key = (indexed[path]['atlas'], indexed[path]['table'])
+        partitions.setdefault(key, {'new': [], 'drop': set()})
+        partitions[key]['drop'].add(path)
+
+    for (atlas, table), update in partitions.items():
+        partition_path = get_partition_path(store, atlas, table, store_format)
+        frames = list()
+        if os.path.exists(partition_path):
+            existing = _read_partition(partition_path, store_format)
+            frames.append(existing[~existing['source'].isin(update['drop'])])
+        frames.extend(update['new'])
+        partition_df = pd.concat(frames, ignore_index=True)
+        partition_df = partition_df.sort_values(['participant', 'session'], kind='stable').reset_index(drop=True)
+        _write_atomic(partition_df, partition_path, store_format)
+        logger.info(f"Wrote {len(partition_df)} rows to {partition_path}")
+
+    index_df = pd.DataFrame.from_dict(current, orient='index')
+    index_df.index.name = 'path'
+    index_df = index_df.reset_index()
+    index_df['format'] = store_format
+    _write_atomic(index_df, sources_index, 'tsv')
+
+
+def read_label_stats(store, atlas=None, table=None, labels=None, participants=None, sessions=None, columns=None):
+    """
+    Read aggregated label stats from the store, with optional filters.
+
+    With parquet, filters on participant, session and label are pushed down to the reader, so only the matching row
+    groups are decoded.
+
+    Args:
+        store (str): store directory.
+        atlas (str or list, optional): atlas or atlases to read, eg 'dkt31' or ['dkt31', 'hoa']. Default is all.
+        table (str, optional): table to read within each atlas. Default is all.
+        labels (list, optional): label indices to keep. Tables without a 'label' column, eg the QC brain stats, are
+            not read.
+        participants (list, optional): participants to keep.
+        sessions (list, optional): sessions to keep.
+        columns (list, optional): columns to read. The ID columns are always read. Columns that a table does not have
+            are not read from it.
+
+    Returns:
+        DataFrame: the matching stats.
+    """
+    if atlas is None:
+        atlases = sorted(d[len('atlas='):] for d in os.listdir(store) if d.startswith('atlas='))
+    elif isinstance(atlas, str):
+        atlases = [atlas]
+    else:
+        atlases = list(atlas)
+
+    filters = list()
+    if participants is not None:
+        filters.append(('participant', 'in', [str(p) for p in participants]))
+    if sessions is not None:
+        filters.append(('session', 'in', [str(s) for s in sessions]))
+    if labels is not None:
+        filters.append(('label', 'in', list(labels)))
+
+    if columns is not None:
+        columns = ID_COLUMNS + [c for c in columns if c not in ID_COLUMNS]
+
+    frames = list()
+    for atlas_name in atlases:
+        for partition_file in sorted(glob.glob(os.path.join(store, f"atlas={atlas_name}", '*'))):
+            partition_table, store_format = os.path.splitext(os.path.basename(partition_file))
+            store_format = store_format.lstrip('.')
+            if table is not None and partition_table != table:
+                continue
+            partition_columns = _partition_columns(partition_file, store_format)
+            if labels is not None and 'label' not in partition_columns:
+                continue
+            read_columns = None if columns is None else [c for c in columns if c in partition_columns]
+            if store_format == 'parquet':
+                df = pd.read_parquet(partition_file, columns=read_columns,
+                                     filters=filters if len(filters) > 0 else None)
+            else:
+                df = pd.read_feather(partition_file, columns=read_columns)
+                for column, _, values in filters:
+                    df = df[df[column].isin(values)]
+            frames.append(df)
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=ID_COLUMNS)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    aggregate_label_stats()
@@ -0,0 +1,179 @@
+"""
+Registry of the atlases transferred to ihMT space and summarized.
+
+The atlases are listed in label_def/atlases.tsv, one row per atlas, so that an atlas can be added without changing the
+pipeline code. Columns are
+
+    atlas           : atlas name, used in output file names as '_space-ihmt_seg-<atlas>_dseg.nii.gz'.
+    source          : where the atlas comes from, one of
+                        'antsnetct:<suffix>' - an antsnetct derivative of the T1w, resampled to ihMT space.
+                        'propagate:<atlas>'  - another atlas propagated through a dilated tissue mask, then masked by it.
+                        'map:<atlas>'        - another atlas relabeled with a mapping table.
+    interpolation   : interpolation for resampling 'antsnetct' atlases, eg GenericLabel.
+    mask            : '<name>:<classes>', with classes a comma-separated list of antsnetct segmentation classes. Atlases
+                      are masked to these classes in ihMT space. For 'propagate' atlases this is required, and the mask
+                      and its dilation are also written, as '_seg-<name>_dseg' and '_seg-<name>md_dseg'.
+    label_def       : label definition TSV in label_def/. Atlases with a label definition are summarized by the label
+                      stats.
+    mapping         : for 'map' atlases, a TSV in label_def/ with an 'index' column of source labels.
+    mapping_column  : for 'map' atlases, the column of the mapping TSV containing the new labels.
+    dilated_name    : for 'propagate' atlases, the name of the propagated labels before masking.
+
+Empty values are 'n/a'. Rows may only refer to atlases listed above them.
+
+This module only uses the standard library, so the registry can be checked without loading the imaging libraries.
+"""
+
+import csv
+import os
+
+ATLAS_REGISTRY_FILE = 'atlases.tsv'
+
+SOURCE_TYPES = ('antsnetct', 'propagate', 'map')
+
+_COLUMNS = ('atlas', 'source', 'interpolation', 'mask', 'label_def', 'mapping', 'mapping_column', 'dilated_name')
+
+
+def get_registry_file(label_def_dir):
+    """
+    Get the path to the atlas registry in a label definition directory.
+
+    Args:
+        label_def_dir (str): label definition directory.
+
+    Returns:
+        str: path to the registry.
+    """
+    return os.path.join(label_def_dir, ATLAS_REGISTRY_FILE)
+
+
+def _parse_mask(mask_spec, atlas):
+    if mask_spec is None:
+        return None
+    if ':' not in mask_spec:
+        raise ValueError(f"Invalid mask for atlas {atlas}: {mask_spec}. Expected '<name>:<classes>'")
+    name, classes = mask_spec.split(':', 1)
+    try:
+        classes = [int(c) for c in classes.split(',')]
+    except ValueError:
+        raise ValueError(f"Invalid mask classes for atlas {atlas}: {mask_spec}")
+    return {'name': name, 'classes': classes}
+
+
+def read_atlas_registry(label_def_dir):
+    """
+    Read and validate the atlas registry.
+
+    Args:
+        label_def_dir (str): label definition directory containing atlases.tsv.
+
+    Returns:
+        list: atlases in registry order, each a dict with keys 'atlas', 'source_type', 'source', 'interpolation',
+            'mask' (None or dict with 'name' and 'classes'), 'label_def', 'mapping', 'mapping_column' and
+            'dilated_name'. File paths are absolute, and missing values are None.
+    """
+    registry_file = get_registry_file(label_def_dir)
+
+    with open(registry_file, 'r', newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        columns = reader.fieldnames if reader.fieldnames is not None else list()
+        rows = list(reader)
+
+    missing_columns = [c for c in _COLUMNS if c not in columns]
+    if len(missing_columns) > 0:
+        raise ValueError(f"Atlas registry {registry_file} is missing columns {missing_columns}")
+
+    atlases = list()
+    names = set()
+
+    for row in rows:
+        entry = {c: (None if (row[c] or '').strip() in ('', 'n/a') else row[c].strip()) for c in _COLUMNS}
+        atlas = entry['atlas']
+
+        if atlas is None:
+            raise ValueError(f"Atlas registry {registry_file} has a row without an atlas name")
+        if atlas in names:
+            raise ValueError(f"Atlas {atlas} is listed more than once in {registry_file}")
+        if entry['source'] is None or ':' not in entry['source']:
+            raise ValueError(f"Invalid source for atlas {atlas}: {entry['source']}")
+
+        source_type, source = entry['source'].split(':', 1)
+        if source_type not in SOURCE_TYPES:
+            raise ValueError(f"Invalid source type for atlas {atlas}: {source_type}. Options are {SOURCE_TYPES}")
+        if source_type in ('propagate', 'map') and source not in names:
+            raise ValueError(f"Atlas {atlas} is derived from {source}, which is not listed before it")
+
+        entry['source_type'] = source_type
+        entry['source'] = source
+        entry['mask'] = _parse_mask(entry['mask'], atlas)
+
+        if source_type == 'antsnetct' and entry['interpolation'] is None:
+            raise ValueError(f"Atlas {atlas} requires an interpolation")
+        if source_type == 'propagate' and (entry['mask'] is None or entry['dilated_name'] is None):
+            raise ValueError(f"Propagated atlas {atlas} requires a mask and a dilated_name")
+        if source_type == 'map' and (entry['mapping'] is None or entry['mapping_column'] is None):
+            raise ValueError(f"Mapped atlas {atlas} requires a mapping and a mapping_column")
+
+        for file_column in ('label_def', 'mapping'):
+            if entry[file_column] is not None:
+                entry[file_column] = os.path.abspath(os.path.join(label_def_dir, entry[file_column]))
+                if not os.path.exists(entry[file_column]):
+                    raise ValueError(f"The {file_column} file for atlas {atlas} does not exist: {entry[file_column]}")
+
+        atlases.append(entry)
+        names.add(atlas)
+
+    return atlases
+
+
+def get_atlases(atlases, source_type=None, with_label_def=False):
+    """
+    Select atlases from the registry.
+
+    Args:
+        atlases (list): registry from read_atlas_registry.
+        source_type (str, optional): only return atlases with this source type.
+        with_label_def (bool): only return atlases with a label definition.
+
+    Returns:
+        list: the selected atlases, in registry order.
+    """
+    return [a for a in atlases if (source_type is None or a['source_type'] == source_type) and
+            (not with_label_def or a['label_def'] is not None)]
+
+
+def get_wm_atlases(atlases):
+    """
+    Select the WM atlases, which are summarized by depth from the cortex.
+
+    These are the 'propagate' atlases, and 'map' atlases derived from them. Each is paired with the atlas its labels
+    were propagated from, which defines the cortex, and with its label definition. A propagated atlas without its own
+    label definition uses that of its source, since it has the same labels.
+
+    Args:
+        atlases (list): registry from read_atlas_registry.
+
+    Returns:
+        list: dicts with keys 'atlas', 'cortex' and 'label_def', in registry order. Atlases without a label definition
+            are omitted.
+    """
+    by_name = {a['atlas']: a for a in atlases}
+
+    wm_atlases = list()
+
+    for atlas in atlases:
+        propagated = atlas
+        while propagated['source_type'] == 'map':
+            propagated = by_name[propagated['source']]
+        if propagated['source_type'] != 'propagate':
+            continue
+
+        label_def = atlas['label_def']
+        if label_def is None and atlas['source_type'] == 'propagate':
+            label_def = by_name[atlas['source']]['label_def']
+        if label_def is None:
+            continue
+
+        wm_atlases.append({'atlas': atlas['atlas'], 'cortex': propagated['source'], 'label_def': label_def})
+
+    return wm_atlases
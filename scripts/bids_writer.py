@@ -0,0 +1,137 @@
+"""
+Background writing of output images to a BIDS dataset.
+
+Publishing an image means writing it, compressing it and copying it to the dataset, usually on a network filesystem,
+which would otherwise block the computation for every output. BIDSWriter does this in a small thread pool, so that the
+next output is computed while the previous ones are written.
+
+The number of images queued or being written is bounded, so a fast producer blocks rather than holding every output
+volume in memory. Sidecars are written together when the writer is flushed, after all of the images, so a sidecar
+never refers to an image that has not been written. Errors in the background are raised by flush.
+
+    writer = bids_writer.BIDSWriter(work_dir)
+    t1w_future = writer.submit(t1w_image, output_dataset, rel_path, metadata={'Sources': [...]})
+    ...
+    writer.flush()
+    t1w_bids = t1w_future.result()
+"""
+
+import json
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import lazy_imports
+import scratch_helpers
+
+bids_helpers = lazy_imports.lazy_module('antsnetct.bids_helpers')
+
+logger = logging.getLogger(__name__)
+
+
+class BIDSWriter:
+    """
+    Write images to BIDS datasets in background threads, and their sidecars in one batch.
+
+    Args:
+        work_dir (str): working directory, for scratch and compressed copies.
+        scratch_format (str): format for images submitted in memory, 'nii' or 'nii.gz'.
+        max_workers (int): number of images written at once.
+        max_pending (int): number of images that may be queued or being written. submit blocks when this is reached.
+    """
+    def __init__(self, work_dir, scratch_format='nii', max_workers=2, max_pending=4):
+        self._work_dir = work_dir
+        self._scratch_format = scratch_format
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='bids_writer')
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._jobs = list()
+        self._sidecars = list()
+
+    def submit(self, image, output_dataset, rel_path, metadata=None):
+        """
+        Queue an image to be written to a dataset.
+
+        Args:
+            image (str or ANTsImage): image file, compressed or not, or an image in memory. An image in memory must not
+                be modified after it is submitted.
+            output_dataset (str): BIDS dataset.
+            rel_path (str): path of the image in the dataset, ending in .nii.gz. Absolute paths inside the dataset are
+                also accepted.
+            metadata (dict, optional): sidecar metadata, written by flush.
+
+        Returns:
+            Future: resolves to the BIDSImage in the dataset once the image is written.
+        """
+        if os.path.isabs(rel_path):
+            rel_path = os.path.relpath(rel_path, output_dataset)
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._write, image, output_dataset, rel_path)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        self._jobs.append((rel_path, future))
+        if metadata is not None:
+            self._sidecars.append((output_dataset, rel_path, metadata))
+
+        return future
+
+    def _write(self, image, output_dataset, rel_path):
+        if not isinstance(image, str):
+            image = scratch_helpers.write_scratch_image(image, self._work_dir, 'bids_output', self._scratch_format)
+        compressed = scratch_helpers.compress_image(image, self._work_dir)
+        return bids_helpers.image_to_bids(compressed, output_dataset, rel_path)
+
+    def flush(self):
+        """
+        Wait for all queued images, then write their sidecars.
+
+        Raises:
+            RuntimeError: if any image could not be written. The other images are still waited for, and no sidecars are
+                written.
+        """
+        errors = list()
+        for rel_path, future in self._jobs:
+            exception = future.exception()
+            if exception is not None:
+                logger.error(f"Failed to write {rel_path}: {exception}")
+                errors.append((rel_path, exception))
+
+        self._jobs = list()
+
+        if len(errors) > 0:
+            self._sidecars = list()
+            rel_path, exception = errors[0]
+            raise RuntimeError(f"Failed to write {len(errors)} output images, first {rel_path}") from exception
+
+        for output_dataset, rel_path, metadata in self._sidecars:
+            sidecar_file = os.path.join(output_dataset, rel_path[:-len('.nii.gz')] + '.json')
+            with open(sidecar_file, 'w') as f:
+                json.dump(metadata, f, indent=4, sort_keys=True)
+
+        self._sidecars = list()
+
+    def close(self):
+        """
+        Flush, and stop the background threads.
+        """
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not mask the original error with write errors
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        return False
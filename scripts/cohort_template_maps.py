@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import glob
+import logging
+import os
+import sys
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import lazy_imports
+from session_lists import read_session_list
+
+nib = lazy_imports.lazy_module('nibabel')
+system_helpers = lazy_imports.lazy_module('antsnetct.system_helpers')
+
+logger = logging.getLogger(__name__)
+
+MAP_STATS = ('mean', 'sd', 'count')
+
+# Helps with CLI help formatting
+class RawDefaultsHelpFormatter(
+    argparse.RawTextHelpFormatter, argparse.ArgumentDefaultsHelpFormatter
+):
+    pass
+
+def cohort_template_maps():
+
+    parser = argparse.ArgumentParser(formatter_class=RawDefaultsHelpFormatter, add_help = False,
+                                     description='''Make cohort mean and SD maps of the ihMTR in template space.
+
+    Each session's ihMTR is resampled to the antsnetct template in one interpolation, through the composition of the
+    inverse of the _from-T1w_to-ihmt transform from the registration and the antsnetct T1w to template transform:
+
+        ihMT -> T1w -> template
+
+    The resampled images are added to running voxelwise mean and variance accumulators (Welford's method) one at a time,
+    in slabs of --chunk-slices slices. The accumulators are memory-mapped arrays in the working directory, so neither
+    the cohort nor a full set of accumulators is held in memory. Sessions are resampled in --threads concurrent
+    antsApplyTransforms processes, and accumulated in the order of the session list.
+
+    Voxels where the resampled ihMTR is zero or not finite, ie outside the ihMTR brain mask or field of view, are not
+    counted. Output is to the output directory:
+
+        tpl-<template>_desc-cohortmean_ihMTR.nii.gz  : mean
+        tpl-<template>_desc-cohortsd_ihMTR.nii.gz    : sample standard deviation, 0 where fewer than 2 sessions
+        tpl-<template>_desc-cohortcount_ihMTR.nii.gz : number of sessions contributing to each voxel
+        tpl-<template>_desc-cohort_sessions.tsv      : the sessions, and whether they were included
+
+    ''')
+    required_parser = parser.add_argument_group('Required arguments')
+    required_parser.add_argument('--input-dataset', help='BIDS dataset containing the ihMTR images and the '
+                                 '_from-T1w_to-ihmt transforms, as produced by register_t1w_to_ihmt_plus.py', type=str,
+                                 required=True)
+    required_parser.add_argument('--antsnetct-dataset', help='antsnetct dataset containing the T1w to template '
+                                 'transforms', type=str, required=True)
+    required_parser.add_argument('--template-image', help='Template image, defining the output grid', type=str,
+                                 required=True)
+    required_parser.add_argument('--template-name', help='Template name, as in the antsnetct transform names, eg '
+                                 'ADNINormalAgingANTs', type=str, required=True)
+    required_parser.add_argument('--session-list', help='CSV file with participants and sessions to include, one per '
+                                 'line, no header', type=str, required=True)
+    required_parser.add_argument('--output-dir', help='Output directory for the cohort maps', type=str, required=True)
+
+    optional_parser = parser.add_argument_group('General optional arguments')
+    optional_parser.add_argument('--threads', help='Number of sessions to resample concurrently', type=int, default=2)
+    optional_parser.add_argument('--chunk-slices', help='Number of slices to accumulate at a time', type=int,
+                                 default=16)
+    optional_parser.add_argument('--work-dir', help='Directory for the resampled images and accumulators. Default is a '
+                                 'temporary directory under TMPDIR', type=str, default=None)
+    optional_parser.add_argument('-h', '--help', action='help', help='show this help message and exit')
+    optional_parser.add_argument('--verbose', help='Verbose output from subcommands', action='store_true')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+        print(f"\nRun {os.path.basename(sys.argv[0])} --help for more information")
+        sys.exit(1)
+
+    args = parser.parse_args()
+
+    logger.info("Parsed args: " + str(args))
+
+    sessions = read_session_list(args.session_list)
+
+    system_helpers.set_verbose(args.verbose)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(suffix='cohort_template_maps.tmpdir', dir=args.work_dir) as work_dir:
+        session_status = make_cohort_maps(args.input_dataset, args.antsnetct_dataset, args.template_image,
+                                          args.template_name, sessions, args.output_dir, work_dir,
+                                          threads=args.threads, chunk_slices=args.chunk_slices)
+
+    num_included = sum(1 for status in session_status.values() if status == 'included')
+    logger.info(f"Included {num_included} of {len(sessions)} sessions")
+
+
+def find_session_inputs(input_dataset, antsnetct_dataset, template_name, participant, session):
+    """
+    Find the ihMTR image and the transforms to template space for a session.
+
+    Args:
+        input_dataset (str): BIDS dataset with the ihMTR and the _from-T1w_to-ihmt transform.
+        antsnetct_dataset (str): antsnetct dataset with the T1w to template transform.
+        template_name (str): template name in the transform file names.
+        participant (str): Participant ID.
+        session (str): Session ID.
+
+    Returns:
+        dict: 'ihMTR', 'T1w_to_ihmt' and 'T1w_to_template' paths.
+
+    Raises:
+        ValueError: if an input is missing or ambiguous.
+    """
+    patterns = {
+        'ihMTR': os.path.join(input_dataset, f"sub-{participant}", f"ses-{session}", 'anat',
+                              f"sub-{participant}_ses-{session}_*_part-mag_ihMTR.nii.gz"),
+        'T1w_to_ihmt': os.path.join(input_dataset, f"sub-{participant}", f"ses-{session}", 'anat',
+                                    f"sub-{participant}_ses-{session}_*from-T1w_to-ihmt_mode-image_xfm.mat"),
+        'T1w_to_template': os.path.join(antsnetct_dataset, f"sub-{participant}", f"ses-{session}", 'anat',
+                                        f"sub-{participant}_ses-{session}_*from-T1w_to-{template_name}_mode-image_"
+                                        'xfm.h5')
+    }
+
+    inputs = dict()
+
+    for name, pattern in patterns.items():
+        matches = glob.glob(pattern)
+        if len(matches) != 1:
+            raise ValueError(f"Expected one {name} file matching {os.path.basename(pattern)}, found {len(matches)}")
+        inputs[name] = matches[0]
+
+    return inputs
+
+
+def resample_to_template(template_image, inputs, output_file):
+    """
+    Resample an ihMTR image to template space, composing the ihMT -> T1w -> template transforms.
+
+    Args:
+        template_image (str): template image, defining the output grid.
+        inputs (dict): session inputs from find_session_inputs.
+        output_file (str): output image. An uncompressed .nii is memory-mapped when it is read.
+
+    Returns:
+        str: path to the resampled image.
+    """
+    cmd = ['antsApplyTransforms', '--dimensionality', '3', '--float', '1',
+           '--input', inputs['ihMTR'],
+           '--reference-image', template_image,
+           '--output', output_file,
+           '--interpolation', 'Linear',
+           '--transform', inputs['T1w_to_template'],
+           '--transform', f"[{inputs['T1w_to_ihmt']},1]"]
+
+    system_helpers.run_command(cmd)
+
+    return output_file
+
+
+def welford_update(count, mean, m2, values):
+    """
+    Add one sample per voxel to running mean and variance accumulators, in place.
+
+    Voxels where the value is zero or not finite are not updated.
+
+    Args:
+        count (ndarray): number of samples per voxel.
+        mean (ndarray): running mean.
+        m2 (ndarray): running sum of squared differences from the mean.
+        values (ndarray): the new sample, of the same shape.
+    """
+    valid = np.isfinite(values) & (values != 0)
+    if not np.any(valid):
+        return
+
+    x = values[valid].astype(np.float64)
+    n = count[valid] + 1
+    delta = x - mean[valid]
+    updated_mean = mean[valid] + delta / n
+
+    count[valid] = n
+    mean[valid] = updated_mean
+    m2[valid] += delta * (x - updated_mean)
+
+
+def make_cohort_maps(input_dataset, antsnetct_dataset, template_image, template_name, sessions, output_dir, work_dir,
+                     threads=2, chunk_slices=16):
+    """
+    Make cohort mean, SD and count maps of the ihMTR in template space, in a single streaming pass over the sessions.
+
+    Args:
+        input_dataset (str): BIDS dataset with the ihMTR and the _from-T1w_to-ihmt transforms.
+        antsnetct_dataset (str): antsnetct dataset with the T1w to template transforms.
+        template_image (str): template image, defining the output grid.
+        template_name (str): template name in the transform file names and the output file names.
+        sessions (list): (participant, session) tuples.
+        output_dir (str): output directory.
+        work_dir (str): working directory for the resampled images and the accumulators.
+        threads (int): number of sessions to resample concurrently.
+        chunk_slices (int): number of slices to accumulate at a time.
+
+    Returns:
+        dict: (participant, session) -> 'included', or the reason the session was excluded.
+    """
+    template = nib.load(template_image)
+    shape = template.shape[:3]
+
+    accumulators = {
+        'count': np.lib.format.open_memmap(os.path.join(work_dir, 'count.npy'), mode='w+', dtype=np.uint32,
+                                           shape=shape),
+        'mean': np.lib.format.open_memmap(os.path.join(work_dir, 'mean.npy'), mode='w+', dtype=np.float64, shape=shape),
+        'm2': np.lib.format.open_memmap(os.path.join(work_dir, 'm2.npy'), mode='w+', dtype=np.float64, shape=shape)
+    }
+
+    session_status = dict()
+
+    def resample_session(index, participant, session):
+        inputs = find_session_inputs(input_dataset, antsnetct_dataset, template_name, participant, session)
+        return resample_to_template(template_image, inputs, os.path.join(work_dir, f"resampled_{index}.nii"))
+
+    # Keep at most `threads` sessions resampling ahead of the accumulation, so the resampled images on disk are bounded
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        pending = collections.deque()
+        session_iter = iter(enumerate(sessions))
+
+        def submit_next():
+            next_session = next(session_iter, None)
+            if next_session is not None:
+                index, (participant, session) = next_session
+                pending.append(((participant, session),
+                                executor.submit(resample_session, index, participant, session)))
+
+        for _ in range(max(1, threads)):
+            submit_next()
+
+        while len(pending) > 0:
+            (participant, session), future = pending.popleft()
+            submit_next()
+
+            try:
+                resampled_file = future.result()
+            except Exception as e:
+                logger.warning(f"Excluding participant {participant}, session {session}: {e}")
+                session_status[(participant, session)] = str(e).replace('\t', ' ').replace('\n', ' ')
+                continue
+
+            resampled = nib.load(resampled_file)
+            if resampled.shape[:3] != shape:
+                raise ValueError(f"Resampled image {resampled_file} does not match the template grid")
+
+            for slab_start in range(0, shape[2], chunk_slices):
+                slab = slice(slab_start, min(slab_start + chunk_slices, shape[2]))
+                values = np.asarray(resampled.dataobj[:, :, slab])
+                welford_update(accumulators['count'][:, :, slab], accumulators['mean'][:, :, slab],
+                               accumulators['m2'][:, :, slab], values)
+
+            del resampled
+            os.remove(resampled_file)
+
+            session_status[(participant, session)] = 'included'
+            logger.info(f"Added participant {participant}, session {session}")
+
+    write_cohort_maps(accumulators, template, template_name, output_dir, work_dir, chunk_slices=chunk_slices)
+
+    sessions_file = os.path.join(output_dir, f"tpl-{template_name}_desc-cohort_sessions.tsv")
+    with open(sessions_file, 'w') as f:
+        f.write("participant\tsession\tstatus\n")
+        for participant, session in sessions:
+            f.write(f"{participant}\t{session}\t{session_status[(participant, session)]}\n")
+
+    return session_status
+
+
+def write_cohort_maps(accumulators, template, template_name, output_dir, work_dir, chunk_slices=16):
+    """
+    Write the mean, SD and count maps from the accumulators.
+
+    The SD is computed slab by slab into a memory-mapped array, so the maps are not all held in memory at once.
+
+    Args:
+        accumulators (dict): 'count', 'mean' and 'm2' arrays from make_cohort_maps.
+        template (Nifti1Image): template image, for the output header.
+        template_name (str): template name for the output file names.
+        output_dir (str): output directory.
+        work_dir (str): working directory.
+        chunk_slices (int): number of slices to process at a time.
+
+    Returns:
+        dict: statistic -> path of the map.
+    """
+    shape = template.shape[:3]
+    count = accumulators['count']
+
+    maps = {'mean': np.lib.format.open_memmap(os.path.join(work_dir, 'mean_map.npy'), mode='w+', dtype=np.float32,
+                                              shape=shape),
+            'sd': np.lib.format.open_memmap(os.path.join(work_dir, 'sd_map.npy'), mode='w+', dtype=np.float32,
+                                            shape=shape)}
+
+    for slab_start in range(0, shape[2], chunk_slices):
+        slab = slice(slab_start, min(slab_start + chunk_slices, shape[2]))
+        slab_count = count[:, :, slab]
+        maps['mean'][:, :, slab] = accumulators['mean'][:, :, slab]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            variance = np.where(slab_count > 1, accumulators['m2'][:, :, slab] / (slab_count - 1.0), 0.0)
+        maps['sd'][:, :, slab] = np.sqrt(np.maximum(variance, 0.0))
+
+    maps['count'] = count
+
+    output_files = dict()
+
+    for stat in MAP_STATS:
+        output_file = os.path.join(output_dir, f"tpl-{template_name}_desc-cohort{stat}_ihMTR.nii.gz")
+        image = nib.Nifti1Image(maps[stat], template.affine)
+        image.set_qform(*template.get_qform(coded=True))
+        image.set_sform(*template.get_sform(coded=True))
+        nib.save(image, output_file)
+        output_files[stat] = output_file
+        logger.info(f"Wrote {output_file}")
+
+    return output_files
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    cohort_template_maps()
@@ -0,0 +1,150 @@
+"""
+Crop images to the bounding box of a brain mask, and put them back on the original grid.
+
+Most voxels of the T1w and ihMTR images are background. The bounding box of the mask is computed once per image, padded,
+and processing runs on the cropped sub-image. Cropped images keep their physical-space header, so transforms computed
+on them apply to the full images. Results are put back on the original grid only when they are written out.
+
+A bounding box is a tuple of (lower, upper) voxel indices, where upper is exclusive, as in Python slicing.
+"""
+
+import numpy as np
+
+import lazy_imports
+import scratch_helpers
+
+ants_image_read = lazy_imports.lazy_function('ants', 'image_read')
+crop_indices = lazy_imports.lazy_function('ants', 'crop_indices')
+decrop_image = lazy_imports.lazy_function('ants', 'decrop_image')
+
+
+def bounding_box(mask_array, pad=0):
+    """
+    Get the bounding box of the non-zero voxels in an array.
+
+    Args:
+        mask_array (ndarray): mask or label array.
+        pad (int): voxels of padding on each side, clipped to the array bounds.
+
+    Returns:
+        tuple: (lower, upper) index tuples. If the mask is empty, the full array extent is returned.
+    """
+    shape = mask_array.shape
+    lower = list()
+    upper = list()
+    for axis in range(mask_array.ndim):
+        other_axes = tuple(a for a in range(mask_array.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask_array, axis=other_axes))
+        if len(nonzero) == 0:
+            return tuple(0 for _ in shape), tuple(shape)
+        lower.append(max(int(nonzero[0]) - pad, 0))
+        upper.append(min(int(nonzero[-1]) + 1 + pad, shape[axis]))
+    return tuple(lower), tuple(upper)
+
+
+def union_bounding_box(*boxes):
+    """
+    Get the bounding box containing several bounding boxes.
+
+    Args:
+        boxes (tuple): bounding boxes on the same grid.
+
+    Returns:
+        tuple: (lower, upper) index tuples.
+    """
+    lower = tuple(min(box[0][axis] for box in boxes) for axis in range(len(boxes[0][0])))
+    upper = tuple(max(box[1][axis] for box in boxes) for axis in range(len(boxes[0][1])))
+    return lower, upper
+
+
+def bounding_box_slices(box):
+    """
+    Convert a bounding box to a tuple of slices, for indexing numpy arrays.
+
+    Args:
+        box (tuple): (lower, upper) index tuples.
+
+    Returns:
+        tuple: slices.
+    """
+    return tuple(slice(lo, hi) for lo, hi in zip(box[0], box[1]))
+
+
+def image_bounding_box(image_file, pad=0):
+    """
+    Get the bounding box of the non-zero voxels of an image file.
+
+    Args:
+        image_file (str): mask or label image.
+        pad (int): voxels of padding on each side.
+
+    Returns:
+        tuple: (lower, upper) index tuples.
+    """
+    mask_array, _ = scratch_helpers.load_array(image_file)
+    return bounding_box(mask_array, pad)
+
+
+def crop_image(image, box):
+    """
+    Crop an ANTsImage to a bounding box, preserving its physical space.
+
+    Args:
+        image (ANTsImage): image to crop.
+        box (tuple): (lower, upper) index tuples.
+
+    Returns:
+        ANTsImage: cropped image.
+    """
+    return crop_indices(image, box[0], box[1])
+
+
+def uncrop_image(cropped_image, reference_image):
+    """
+    Put a cropped image back on the grid of a full image, with zeros outside the crop.
+
+    Args:
+        cropped_image (ANTsImage): image cropped from an image on the reference grid.
+        reference_image (ANTsImage): image on the full grid.
+
+    Returns:
+        ANTsImage: the cropped image embedded in the full grid, with the pixel type of the cropped image.
+    """
+    background = reference_image.clone(cropped_image.pixeltype) * 0
+    return decrop_image(cropped_image, background)
+
+
+def crop_image_file(image_file, box, work_dir, prefix, scratch_format='nii'):
+    """
+    Crop an image file to a bounding box, writing the result to scratch.
+
+    Args:
+        image_file (str): image to crop.
+        box (tuple): (lower, upper) index tuples.
+        work_dir (str): working directory.
+        prefix (str): prefix for the scratch file.
+        scratch_format (str): scratch image format.
+
+    Returns:
+        str: path to the cropped image.
+    """
+    cropped = crop_image(ants_image_read(image_file), box)
+    return scratch_helpers.write_scratch_image(cropped, work_dir, prefix, scratch_format)
+
+
+def uncrop_image_file(cropped_file, reference_file, work_dir, prefix, scratch_format='nii'):
+    """
+    Put a cropped image file back on the grid of a reference image, writing the result to scratch.
+
+    Args:
+        cropped_file (str): cropped image.
+        reference_file (str): image on the full grid.
+        work_dir (str): working directory.
+        prefix (str): prefix for the scratch file.
+        scratch_format (str): scratch image format.
+
+    Returns:
+        str: path to the image on the full grid.
+    """
+    uncropped = uncrop_image(ants_image_read(cropped_file), ants_image_read(reference_file))
+    return scratch_helpers.write_scratch_image(uncropped, work_dir, prefix, scratch_format)
@@ -4,14 +4,23 @@ from antsnetct import bids_helpers,system_helpers
 
 import ants
 
+import manifest_helpers
+import session_lists
+import staging_helpers
+import work_dir_helpers
+
 import argparse
 import json
 import logging
+import nibabel as nib
+import numpy as np
 import os
-import pandas as pd
+import shutil
 import sys
 import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
+
 logger = logging.getLogger(__name__)
 
 # Helps with CLI help formatting
@@ -37,10 +46,15 @@ def gather_inputs():
     --- Processing steps ---
 
     1. T1w selection. If there is more than one T1w image for the session, the best one is selected based on an FTDC
-    heuristic. If there is only one T1w image, it is used.
+    heuristic. If there is only one T1w image, it is used. Candidates are compared using only their NIfTI headers and
+    file stats, read concurrently and cached in the output dataset under code/t1w_header_cache.json.
 
     2. ihMT selection. The ihMT image 'pick one.nii.gz' is is used as the target for registration.
 
+    3. Staging. The selected files are staged into the output dataset in batches of sessions, concurrently. Files are
+    hard linked if the source is on the same filesystem, else reflinked if supported, else copied and verified by
+    checksum. See --stage-mode.
+
 
     ''')
     required_parser = parser.add_argument_group("Required arguments")
@@ -56,6 +70,17 @@ def gather_inputs():
     optional_parser = parser.add_argument_group("General optional arguments")
     optional_parser.add_argument("-h", "--help", action="help", help="show this help message and exit")
     optional_parser.add_argument("--verbose", help="Verbose output from subcommands", action='store_true')
+    optional_parser.add_argument("--threads", help="Number of files to inspect or copy concurrently", type=int, default=4)
+    optional_parser.add_argument("--stage-mode", help="How to stage files into the output dataset: 'auto' (hard link, "
+                                 "then reflink, then copy), 'hardlink', 'reflink' or 'copy'. Links fall back to copies if "
+                                 "they are not possible", type=str, default='auto', choices=staging_helpers.STAGE_MODES)
+    optional_parser.add_argument("--batch-size", help="Number of sessions to stage together", type=int, default=20)
+    optional_parser.add_argument("--work-dir-shm-mb", help="RAM in MB that may be used for intermediate files. If /dev/shm "
+                                 "and the job have this much to spare, the working directory is placed on /dev/shm, "
+                                 "otherwise under TMPDIR", type=float, default=0)
+    optional_parser.add_argument("--keep-work-dir", help="Keep the working directory, for debugging", action='store_true')
+    optional_parser.add_argument("--shard", help="Only process shard i of N of the session list, as i/N. See "
+                                 "session_lists.py", type=str, default=None)
 
     if len(sys.argv) == 1:
         parser.print_usage()
@@ -99,22 +124,43 @@ def gather_inputs():
     bids_t1w_filter = bids_helpers.get_modality_filter_query('t1w')
     bids_t1w_filter['desc'] = 'preproc'
 
-    # Read input from csv
-    with open(args.session_list, 'r') as f:
-        session_df = pd.read_csv(f, names=['participant', 'session'])
+    header_cache_file = os.path.join(output_dataset, 'code', 't1w_header_cache.json')
+    header_cache = load_header_cache(header_cache_file)
+
+    # Sessions are streamed from the list, so IDs are read as strings and repeated sessions are skipped
+    sessions = session_lists.iter_session_list(args.session_list, shard=args.shard)
+
+    # Sessions waiting to be staged, each a dict with the staging jobs and manifest contents
+    pending_sessions = list()
 
-    for participant, session in zip(session_df['participant'], session_df['session']):
-        with tempfile.TemporaryDirectory(suffix=f"ihmt_t1w_selector.tmpdir") as work_dir:
+    # Session working directories are removed once their files are staged, so the working directory holds at most one
+    # batch
+    with work_dir_helpers.WorkDir("ihmt_t1w_selector", shm_budget_mb=args.work_dir_shm_mb,
+                                  keep=args.keep_work_dir) as managed_work_dir:
+        work_dir = managed_work_dir.path
+
+        for participant, session in sessions:
             logger.info(f"Processing participant {participant}, session {session}")
 
-            if os.path.exists(os.path.join(output_dataset, f"sub-{participant}", f"ses-{session}", 'anat')):
+            session_status, status_reasons = manifest_helpers.check_session(output_dataset, 'gather', participant,
+                                                                            session)
+
+            if session_status == manifest_helpers.STATUS_DONE:
                 logger.info(f"Outputs already exist for participant {participant}, session {session}")
                 continue
 
+            if session_status != manifest_helpers.STATUS_MISSING:
+                logger.info(f"Rerunning participant {participant}, session {session} ({session_status}): " +
+                            "; ".join(status_reasons))
+                manifest_helpers.remove_manifest(output_dataset, 'gather', participant, session)
+
+            session_work_dir = os.path.join(work_dir, f"sub-{participant}_ses-{session}")
+            os.makedirs(session_work_dir, exist_ok=True)
+
             bids_t1w_filter['session'] = session
 
-            input_t1w_bids = bids_helpers.find_participant_images(input_dataset, participant, work_dir, validate=False,
-                                                          **bids_t1w_filter)
+            input_t1w_bids = bids_helpers.find_participant_images(input_dataset, participant, session_work_dir,
+                                                                  validate=False, **bids_t1w_filter)
 
             if input_t1w_bids is None or len(input_t1w_bids) == 0:
                 logger.warning(f"No T1w images found for participant {participant}.")
@@ -123,7 +169,8 @@ def gather_inputs():
             for t1w_bids in input_t1w_bids:
                 logger.info("Found T1w image: " + t1w_bids.get_uri(relative=False))
 
-            selected_t1w_bids = select_best_t1w_image(input_t1w_bids)
+            selected_t1w_bids = select_best_t1w_image(input_t1w_bids, header_cache=header_cache, threads=args.threads)
+            save_header_cache(header_cache, header_cache_file)
 
             # ihMTR image
             ihmt_image_path = os.path.join(args.ihmt_dir, f"sub-{participant}", f"ses-{session}", "anat",
@@ -133,29 +180,28 @@ def gather_inputs():
                 logger.warning(f"ihMT image not found for participant {participant}, session {session}: {ihmt_image_path}")
                 continue
 
-            ihmt_ref_input = get_ihmt_reference_image(args.ihmt_dir, participant, session, work_dir)
+            ihmt_ref_input = get_ihmt_reference_image(args.ihmt_dir, participant, session, session_work_dir)
 
-            # Copy images to output dataset
+            # Stage images to output dataset
             ihmt_output_rel_path = os.path.join(f"sub-{participant}", f"ses-{session}", "anat",
                                                f"sub-{participant}_ses-{session}_acq-ihMTgre2500um_part-mag_ihMTR.nii.gz")
 
-            ihmt_ref_bids = bids_helpers.image_to_bids(ihmt_ref_input, output_dataset, ihmt_output_rel_path,
-                                                      metadata={'Sources': [ihmt_image_path], 'SkullStripped': False})
-
-            output_t1w_bids = bids_helpers.image_to_bids(selected_t1w_bids.get_path(), output_dataset,
-                                                         selected_t1w_bids.get_rel_path(), metadata={
-                                                    'Sources': [selected_t1w_bids.get_uri(relative=False)],
-                                                    'SkullStripped': False
-                                                            })
-
-            # Copy masks
             selected_t1w_mask_bids = selected_t1w_bids.get_derivative_image('_desc-brain_mask.nii.gz')
 
-            output_t1w_mask_bids = bids_helpers.image_to_bids(
-                selected_t1w_mask_bids.get_path(), output_dataset,
-                output_t1w_bids.get_derivative_rel_path_prefix() + '_desc-antsnetct_mask.nii.gz',
-                metadata={'Sources': [selected_t1w_mask_bids.get_uri(relative=False)]}
-                )
+            # The T1w keeps its relative path in the output dataset, so its derivatives have the same prefix
+            output_t1w_mask_rel_path = selected_t1w_bids.get_derivative_rel_path_prefix() + '_desc-antsnetct_mask.nii.gz'
+
+            staging_jobs = [
+                {'src': ihmt_ref_input,
+                 'dest': os.path.join(output_dataset, ihmt_output_rel_path),
+                 'metadata': {'Sources': [ihmt_image_path], 'SkullStripped': False}},
+                {'src': selected_t1w_bids.get_path(),
+                 'dest': os.path.join(output_dataset, selected_t1w_bids.get_rel_path()),
+                 'metadata': {'Sources': [selected_t1w_bids.get_uri(relative=False)], 'SkullStripped': False}},
+                {'src': selected_t1w_mask_bids.get_path(),
+                 'dest': os.path.join(output_dataset, output_t1w_mask_rel_path),
+                 'metadata': {'Sources': [selected_t1w_mask_bids.get_uri(relative=False)]}}
+            ]
 
             # ihmt_input_mask = get_ihmt_mask_image(args.ihmt_dir, participant, session)
 
@@ -166,12 +212,73 @@ def gather_inputs():
             #    metadata={'Sources': [ihmt_input_mask]}
             #    )
 
+            pending_sessions.append({
+                'participant': participant,
+                'session': session,
+                'jobs': staging_jobs,
+                'inputs': {'ihMTR': ihmt_image_path,
+                           'T1w': selected_t1w_bids.get_path(),
+                           'T1w_mask': selected_t1w_mask_bids.get_path()},
+                'work_dir': session_work_dir
+            })
+
+            if len(pending_sessions) >= args.batch_size:
+                managed_work_dir.report(f"batch of {len(pending_sessions)} sessions")
+                stage_sessions(pending_sessions, output_dataset, args.threads, args.stage_mode)
+                remove_session_work_dirs(pending_sessions, args.keep_work_dir)
+                pending_sessions = list()
+
+        managed_work_dir.report(f"batch of {len(pending_sessions)} sessions")
+        stage_sessions(pending_sessions, output_dataset, args.threads, args.stage_mode)
+
+
+
+def remove_session_work_dirs(staged_sessions, keep):
+    """
+    Remove the working directories of sessions whose files have been staged.
+
+    Args:
+        staged_sessions (list): dicts with key 'work_dir', as passed to stage_sessions.
+        keep (bool): keep the directories, for debugging.
+    """
+    if keep:
+        return
+    for staged in staged_sessions:
+        shutil.rmtree(staged['work_dir'], ignore_errors=True)
+
+
+def stage_sessions(pending_sessions, output_dataset, threads, stage_mode):
+    """
+    Stage the files for a batch of sessions into the output dataset, and write their manifests.
+
+    Args:
+        pending_sessions (list): dicts with keys 'participant', 'session', 'jobs' (staging jobs, see
+            staging_helpers.stage_files) and 'inputs' (manifest inputs).
+        output_dataset (str): output BIDS dataset.
+        threads (int): number of files to stage concurrently.
+        stage_mode (str): staging mode, see staging_helpers.stage_file.
+    """
+    if len(pending_sessions) == 0:
+        return
+
+    all_jobs = [job for pending in pending_sessions for job in pending['jobs']]
+
+    logger.info(f"Staging {len(all_jobs)} files for {len(pending_sessions)} sessions")
+
+    checksums = staging_helpers.stage_files(all_jobs, threads=threads, mode=stage_mode)
+
+    for pending in pending_sessions:
+        manifest_helpers.write_manifest(output_dataset, 'gather', pending['participant'], pending['session'],
+                                        outputs=[job['dest'] for job in pending['jobs']], inputs=pending['inputs'],
+                                        checksums=checksums)
+
 
 def get_ihmt_reference_image(ihmt_dir, participant, session, work_dir):
     """
     Get the reference ihMT image for registration.
 
-    The first volume from the ihMT image is used as the reference.
+    The first volume from the ihMT image is used as the reference. If the image is 3D, the image itself is the reference
+    and it is returned without being read, so it can be staged as is.
 
     Args:
         ihmt_dir (str): Directory containing the ihMT images.
@@ -187,13 +294,17 @@ def get_ihmt_reference_image(ihmt_dir, participant, session, work_dir):
 
     ihmt_image_path = os.path.join(ihmt_dir, f"sub-{participant}", f"ses-{session}", "anat", f"sub-{participant}_ses-{session}_acq-ihMTgre2500um_part-mag_ihMTR.nii.gz")
 
+    # Header only
+    if len(nib.load(ihmt_image_path).shape) == 3:
+        return ihmt_image_path
+
     ihmt_image = ants.image_read(ihmt_image_path)
     if ihmt_image is None:
         raise ValueError(f"Failed to read ihMT image: {ihmt_image_path}")
 
     ihmt_image_np = ihmt_image.numpy()
     # get first volume
-    ihmt_ref_np = ihmt_image_np[:,:,:]
+    ihmt_ref_np = ihmt_image_np[:,:,:,0]
 
     ihmt_ref = ants.from_numpy(ihmt_ref_np, origin=ihmt_image.origin[:3], spacing=ihmt_image.spacing[:3],
                              direction=ihmt_image.direction[:3,:3])
@@ -229,85 +340,149 @@ def get_ihmt_mask_image(ihmt_dir, participant, session):
     return ihmt_mask_path
 
 
-def select_best_t1w_image(t1w_bids_list):
+def read_t1w_header_info(t1w_path, header_cache=None):
     """
-    Select the best T1w image from a list of T1w BIDSImage objects, based on an FTDC heuristic.
+    Get the header information used to rank a T1w image, without reading any voxel data.
 
-    If there is only one image in the list, it is returned.
+    Only the NIfTI header is decoded. Results are cached by path, and reused while the file size and mtime are unchanged.
 
-    If there are multiple images, the one with the highest resolution (smallest voxel size) is selected.
-    If there is a tie in resolution, the image with the smallest file size is selected.
+    Args:
+        t1w_path (str): path to the T1w image.
+        header_cache (dict, optional): cache of header information, updated in place.
+
+    Returns:
+        dict: header information with keys 'size', 'mtime_ns', 'shape', 'voxel_size', 'voxel_volume', 'qform_code'.
+    """
+    stat = os.stat(t1w_path)
+
+    if header_cache is not None:
+        cached = header_cache.get(t1w_path)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached
+
+    header = nib.load(t1w_path).header
+    voxel_size = [float(z) for z in header.get_zooms()[:3]]
+
+    info = {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'shape': [int(d) for d in header.get_data_shape()[:3]],
+        'voxel_size': voxel_size,
+        'voxel_volume': float(np.prod(voxel_size)),
+        'qform_code': int(header['qform_code'])
+    }
+
+    if header_cache is not None:
+        header_cache[t1w_path] = info
+
+    return info
+
+
+def load_header_cache(header_cache_file):
+    """
+    Load the T1w header cache.
 
     Args:
-        t1w_bids_list (list): List of BIDSImage objects representing T1w images.
+        header_cache_file (str): path to the cache JSON file.
 
     Returns:
-        BIDSImage: The selected best T1w image.
+        dict: the cache, empty if the file does not exist or cannot be read.
     """
-    if len(t1w_bids_list) == 0:
-        raise ValueError("The input list of T1w BIDS images is empty.")
+    try:
+        with open(header_cache_file, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read T1w header cache {header_cache_file}: {e}")
+        return dict()
 
-    if len(t1w_bids_list) == 1:
-        return t1w_bids_list[0]
 
-    # List of t1ws of each type
-    vnavpass = list()
-    vnavmoco = list()
-    recnorm = list()
-    acqsag = list()
-    others = list()
-
-
-    for t1w_bids in t1w_bids_list:
-        entities = t1w_bids.get_file_entities()
-        if entities.get('acq', None) == 'vnavpass':
-            vnavpass.append(t1w_bids)
-        elif entities.get('acq', None) == 'vnavmoco':
-            vnavmoco.append(t1w_bids)
-        elif entities.get('rec', None) == 'norm':
-            recnorm.append(t1w_bids)
-        elif entities.get('acq', None) == 'sag':
-            acqsag.append(t1w_bids)
-        else:
-            others.append(t1w_bids)
-
-    if len(vnavpass) > 0:
-        return get_last_run(vnavpass)
-    if len(vnavmoco) > 0:
-        return get_last_run(vnavmoco)
-    if len(recnorm) > 0:
-        return get_last_run(recnorm)
-    if len(acqsag) > 0:
-        return get_last_run(acqsag)
-    return get_last_run(others)
-
-
-def get_last_run(t1w_bids_list):
+def save_header_cache(header_cache, header_cache_file):
     """
-    Get the T1w image with the highest run number from a list of T1w BIDSImage objects.
+    Atomically write the T1w header cache.
+
+    Args:
+        header_cache (dict): the cache.
+        header_cache_file (str): path to the cache JSON file.
+    """
+    os.makedirs(os.path.dirname(header_cache_file), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(header_cache_file), prefix='.tmp_', suffix='.json',
+                                     delete=False) as f:
+        json.dump(header_cache, f)
+        tmp_path = f.name
+    os.replace(tmp_path, header_cache_file)
+
+
+def get_t1w_priority(t1w_bids):
+    """
+    Get the priority of a T1w image by acquisition type under the FTDC heuristic. Lower is better.
+
+    The order is acq-vnavpass, acq-vnavmoco, rec-norm, acq-sag, then anything else.
+
+    Args:
+        t1w_bids (BIDSImage): T1w image.
+
+    Returns:
+        int: priority.
+    """
+    entities = t1w_bids.get_file_entities()
+    if entities.get('acq', None) == 'vnavpass':
+        return 0
+    if entities.get('acq', None) == 'vnavmoco':
+        return 1
+    if entities.get('rec', None) == 'norm':
+        return 2
+    if entities.get('acq', None) == 'sag':
+        return 3
+    return 4
+
+
+def select_best_t1w_image(t1w_bids_list, header_cache=None, threads=4):
+    """
+    Select the best T1w image from a list of T1w BIDSImage objects, based on an FTDC heuristic.
+
+    If there is only one image in the list, it is returned.
+
+    If there are multiple images, they are ranked by
+
+        1. acquisition type: acq-vnavpass, acq-vnavmoco, rec-norm, acq-sag, then others
+        2. run number, highest first
+        3. resolution, smallest voxel volume first
+        4. file size, smallest first
+
+    Resolution and file size come from the NIfTI headers and file stats, read concurrently. No voxel data is read.
 
     Args:
         t1w_bids_list (list): List of BIDSImage objects representing T1w images.
+        header_cache (dict, optional): cache of header information, updated in place.
+        threads (int): number of headers to read concurrently.
 
     Returns:
-        BIDSImage: The T1w image with the highest run number.
+        BIDSImage: The selected best T1w image.
     """
     if len(t1w_bids_list) == 0:
         raise ValueError("The input list of T1w BIDS images is empty.")
+
     if len(t1w_bids_list) == 1:
         return t1w_bids_list[0]
 
-    max_run = -1
-    selected_t1w = None
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        header_infos = list(executor.map(lambda t1w_bids: read_t1w_header_info(t1w_bids.get_path(), header_cache),
+                                         t1w_bids_list))
+
+    def rank(candidate):
+        t1w_bids, header_info = candidate
+        run = int(t1w_bids.get_file_entities().get('run', 1))
+        return (get_t1w_priority(t1w_bids), -run, round(header_info['voxel_volume'], 6), header_info['size'])
+
+    ranked = sorted(zip(t1w_bids_list, header_infos), key=rank)
 
-    for t1w_bids in t1w_bids_list:
-        entities = t1w_bids.get_file_entities()
-        run = int(entities.get('run', 1))
-        if run > max_run:
-            max_run = run
-            selected_t1w = t1w_bids
+    for t1w_bids, header_info in ranked:
+        logger.info(f"T1w candidate {t1w_bids.get_uri(relative=False)}: voxel size {header_info['voxel_size']}, "
+                    f"file size {header_info['size']}")
 
-    return selected_t1w
+    return ranked[0][0]
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
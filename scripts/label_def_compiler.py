@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+"""
+Label definitions compiled into a validated lookup artifact.
+
+The label definition and mapping TSVs listed in the atlas registry are parsed and checked once, and compiled into
+label_def/label_defs_compiled.npz, which contains for each label definition the label indices, names and a dense lookup
+table from label to row, and for each 'map' atlas a dense lookup table from source label to mapped label. Stages load
+the artifact instead of parsing the TSVs for every session, and relabel images with one table lookup.
+
+The artifact records the size and modification time of every TSV it was compiled from, and is recompiled when any of
+them changes. If the label definition directory is not writable, the definitions are compiled in memory.
+
+Compilation fails, listing every problem, if a label definition has missing, duplicate or negative indices or empty
+names, if a mapping has duplicate source labels, maps to labels that are not in the label definition of the mapped
+atlas, or leaves labels of its source atlas unmapped. This catches label mismatches before any session is processed.
+
+To compile and check the label definitions:
+
+    label_def_compiler.py --label-def-dir label_def
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+import atlas_registry
+import lazy_imports
+
+pd = lazy_imports.lazy_module('pandas')
+
+logger = logging.getLogger(__name__)
+
+COMPILED_FILE = 'label_defs_compiled.npz'
+
+# Increment when the contents of the artifact change
+COMPILED_VERSION = 1
+
+# Largest label index, which bounds the size of the dense lookup tables
+MAX_LABEL_INDEX = (1 << 20) - 1
+
+
+def get_compiled_file(label_def_dir):
+    """
+    Get the path to the compiled label definitions in a label definition directory.
+
+    Args:
+        label_def_dir (str): label definition directory.
+
+    Returns:
+        str: path to the compiled artifact.
+    """
+    return os.path.join(label_def_dir, COMPILED_FILE)
+
+
+def _fingerprint_sources(label_def_dir, source_files):
+    fingerprints = dict()
+    for source_file in source_files:
+        stat = os.stat(source_file)
+        fingerprints[os.path.relpath(source_file, label_def_dir)] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprints
+
+
+def _read_tsv(tsv_file, columns, problems):
+    with open(tsv_file, 'r', newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        rows = list(reader)
+        fieldnames = reader.fieldnames if reader.fieldnames is not None else list()
+
+    missing_columns = [c for c in columns if c not in fieldnames]
+    if len(missing_columns) > 0:
+        problems.append(f"{tsv_file} is missing columns {missing_columns}")
+        return None
+
+    if len(rows) == 0:
+        problems.append(f"{tsv_file} has no rows")
+        return None
+
+    return rows
+
+
+def _parse_indices(values, tsv_file, column, problems):
+    indices = list()
+    for row_number, value in enumerate(values, start=2):
+        try:
+            index = int((value or '').strip())
+        except ValueError:
+            problems.append(f"{tsv_file} line {row_number}: {column} {value!r} is not an integer")
+            continue
+        if index < 0 or index > MAX_LABEL_INDEX:
+            problems.append(f"{tsv_file} line {row_number}: {column} {index} is outside [0, {MAX_LABEL_INDEX}]")
+            continue
+        indices.append(index)
+    return indices
+
+
+def _duplicates(indices):
+    seen = set()
+    duplicates = set()
+    for index in indices:
+        if index in seen:
+            duplicates.add(index)
+        seen.add(index)
+    return sorted(duplicates)
+
+
+def _compile_label_def(label_def_file, problems):
+    rows = _read_tsv(label_def_file, ('index', 'name'), problems)
+    if rows is None:
+        return None
+
+    num_problems = len(problems)
+
+    indices = _parse_indices([row['index'] for row in rows], label_def_file, 'index', problems)
+    names = [(row['name'] or '').strip() for row in rows]
+
+    duplicates = _duplicates(indices)
+    if len(duplicates) > 0:
+        problems.append(f"{label_def_file} has duplicate indices {duplicates}")
+
+    empty_names = [row['index'] for row, name in zip(rows, names) if name == '']
+    if len(empty_names) > 0:
+        problems.append(f"{label_def_file} has labels without a name: {empty_names}")
+
+    if len(problems) > num_problems:
+        return None
+
+    index = np.asarray(indices, dtype=np.int64)
+
+    # Row of each label in the definition, -1 for undefined labels
+    lut = np.full(int(index.max()) + 1, -1, dtype=np.int32)
+    lut[index] = np.arange(index.size, dtype=np.int32)
+
+    return {'index': index, 'name': np.asarray(names, dtype=str), 'lut': lut}
+
+
+def _compile_mapping(mapping_file, mapping_column, problems):
+    rows = _read_tsv(mapping_file, ('index', mapping_column), problems)
+    if rows is None:
+        return None
+
+    num_problems = len(problems)
+
+    source_indices = _parse_indices([row['index'] for row in rows], mapping_file, 'index', problems)
+    mapped_indices = _parse_indices([row[mapping_column] for row in rows], mapping_file, mapping_column, problems)
+
+    duplicates = _duplicates(source_indices)
+    if len(duplicates) > 0:
+        problems.append(f"{mapping_file} maps source labels {duplicates} more than once")
+
+    if len(problems) > num_problems:
+        return None
+
+    index = np.asarray(source_indices, dtype=np.int64)
+
+    # Labels that are not in the mapping are unchanged
+    lut = np.arange(int(index.max()) + 1, dtype=np.uint32)
+    lut[index] = np.asarray(mapped_indices, dtype=np.uint32)
+
+    return {'index': index, 'lut': lut}
+
+
+def _get_source_label_def(atlas, by_name):
+    # Propagated atlases have the labels of their source
+    source = by_name[atlas['source']]
+    while source['label_def'] is None and source['source_type'] == 'propagate':
+        source = by_name[source['source']]
+    return source['label_def']
+
+
+def compile_label_definitions(label_def_dir, atlases=None):
+    """
+    Parse and validate the label definitions and mappings of the atlas registry.
+
+    Args:
+        label_def_dir (str): label definition directory containing atlases.tsv.
+        atlases (list, optional): registry from atlas_registry.read_atlas_registry. Read from label_def_dir if not
+            provided.
+
+    Returns:
+        dict: compiled label definitions, with keys
+            'sources'    : relative path -> [size, mtime_ns] of the registry and every TSV.
+            'label_defs' : label definition path relative to label_def_dir -> dict with 'index' (int64), 'name' (str)
+                           and 'lut' (int32 array from label to row, -1 for undefined labels).
+            'mappings'   : 'map' atlas name -> dict with 'index', the mapped source labels, and 'lut' (uint32 array
+                           from source label to mapped label).
+
+    Raises:
+        ValueError: listing every problem found.
+    """
+    if atlases is None:
+        atlases = atlas_registry.read_atlas_registry(label_def_dir)
+
+    by_name = {atlas['atlas']: atlas for atlas in atlases}
+
+    problems = list()
+    label_defs = dict()
+    mappings = dict()
+    source_files = [atlas_registry.get_registry_file(label_def_dir)]
+
+    for atlas in atlases:
+        label_def_file = atlas['label_def']
+        if label_def_file is not None and label_def_file not in source_files:
+            source_files.append(label_def_file)
+            label_defs[label_def_file] = _compile_label_def(label_def_file, problems)
+
+    for atlas in atlas_registry.get_atlases(atlases, source_type='map'):
+        if atlas['mapping'] not in source_files:
+            source_files.append(atlas['mapping'])
+
+        mapping = _compile_mapping(atlas['mapping'], atlas['mapping_column'], problems)
+        mappings[atlas['atlas']] = mapping
+
+        if mapping is None:
+            continue
+
+        mapped_indices = np.unique(mapping['lut'][mapping['index']])
+
+        target_def = label_defs.get(atlas['label_def'])
+        if target_def is not None:
+            undefined = [int(i) for i in mapped_indices if i >= target_def['lut'].size or target_def['lut'][i] < 0]
+            if len(undefined) > 0:
+                problems.append(f"Atlas {atlas['atlas']}: {atlas['mapping']} maps to labels {undefined}, which are "
+                                f"not in {atlas['label_def']}")
+
+        source_label_def_file = _get_source_label_def(atlas, by_name)
+        source_def = label_defs.get(source_label_def_file)
+        if source_def is not None:
+            unmapped = sorted(set(source_def['index'].tolist()) - set(mapping['index'].tolist()))
+            if len(unmapped) > 0:
+                problems.append(f"Atlas {atlas['atlas']}: labels {unmapped} of {source_label_def_file} are not in "
+                                f"{atlas['mapping']}")
+            unused = sorted(set(mapping['index'].tolist()) - set(source_def['index'].tolist()))
+            if len(unused) > 0:
+                logger.warning(f"Atlas {atlas['atlas']}: {atlas['mapping']} maps labels {unused}, which are not in "
+                               f"{source_label_def_file}")
+
+    if len(problems) > 0:
+        raise ValueError(f"Invalid label definitions in {label_def_dir}:\n  " + "\n  ".join(problems))
+
+    return {'sources': _fingerprint_sources(label_def_dir, source_files),
+            'label_defs': {os.path.relpath(path, label_def_dir): label_def for path, label_def in label_defs.items()},
+            'mappings': mappings}
+
+
+def write_compiled_label_definitions(compiled, compiled_file):
+    """
+    Write compiled label definitions to an artifact.
+
+    The artifact is written to a temporary file and renamed into place, so concurrent jobs never read a partial file.
+
+    Args:
+        compiled (dict): compiled label definitions from compile_label_definitions.
+        compiled_file (str): output .npz file.
+
+    Returns:
+        str: path to the artifact.
+    """
+    arrays = dict()
+
+    for key, label_def in compiled['label_defs'].items():
+        for field in ('index', 'name', 'lut'):
+            arrays[f"label_def:{key}:{field}"] = label_def[field]
+
+    for atlas, mapping in compiled['mappings'].items():
+        for field in ('index', 'lut'):
+            arrays[f"mapping:{atlas}:{field}"] = mapping[field]
+
+    metadata = {'version': COMPILED_VERSION, 'sources': compiled['sources'],
+                'label_defs': sorted(compiled['label_defs']), 'mappings': sorted(compiled['mappings'])}
+    arrays['metadata'] = np.asarray(json.dumps(metadata, sort_keys=True))
+
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(compiled_file)), prefix='.tmp_',
+                                    suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file, compiled_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+    return compiled_file
+
+
+def read_compiled_label_definitions(compiled_file):
+    """
+    Read compiled label definitions from an artifact.
+
+    Args:
+        compiled_file (str): .npz file from write_compiled_label_definitions.
+
+    Returns:
+        dict: compiled label definitions as from compile_label_definitions, or None if the artifact does not exist or
+            is from another version.
+    """
+    try:
+        with np.load(compiled_file, allow_pickle=False) as arrays:
+            metadata = json.loads(str(arrays['metadata']))
+            if metadata.get('version') != COMPILED_VERSION:
+                return None
+            label_defs = {key: {field: arrays[f"label_def:{key}:{field}"] for field in ('index', 'name', 'lut')}
+                          for key in metadata['label_defs']}
+            mappings = {atlas: {field: arrays[f"mapping:{atlas}:{field}"] for field in ('index', 'lut')}
+                        for atlas in metadata['mappings']}
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return {'sources': metadata['sources'], 'label_defs': label_defs, 'mappings': mappings}
+
+
+def _sources_unchanged(label_def_dir, sources):
+    for rel_path, (size, mtime_ns) in sources.items():
+        try:
+            stat = os.stat(os.path.join(label_def_dir, rel_path))
+        except OSError:
+            return False
+        if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+            return False
+    return True
+
+
+def load_label_definitions(label_def_dir, atlases=None):
+    """
+    Load the compiled label definitions, compiling them if the artifact is missing or out of date.
+
+    Args:
+        label_def_dir (str): label definition directory containing atlases.tsv.
+        atlases (list, optional): registry from atlas_registry.read_atlas_registry, used if the definitions are
+            compiled.
+
+    Returns:
+        dict: compiled label definitions, as from compile_label_definitions.
+
+    Raises:
+        ValueError: if the definitions are compiled and are invalid.
+    """
+    compiled_file = get_compiled_file(label_def_dir)
+
+    compiled = read_compiled_label_definitions(compiled_file)
+
+    # The registry lists the sources, so a new TSV also changes the registry fingerprint
+    if compiled is not None and _sources_unchanged(label_def_dir, compiled['sources']):
+        return compiled
+
+    compiled = compile_label_definitions(label_def_dir, atlases)
+
+    try:
+        write_compiled_label_definitions(compiled, compiled_file)
+        logger.info(f"Compiled label definitions to {compiled_file}")
+    except OSError as e:
+        logger.warning(f"Could not write compiled label definitions {compiled_file}: {e}")
+
+    return compiled
+
+
+def get_label_definitions(compiled, label_def_dir, label_def_file):
+    """
+    Get a label definition as a DataFrame.
+
+    Args:
+        compiled (dict): compiled label definitions.
+        label_def_dir (str): label definition directory the definitions were compiled from.
+        label_def_file (str): label definition TSV, as in the atlas registry.
+
+    Returns:
+        DataFrame: label definitions, with integer 'index' and string 'name' columns, as from
+            label_stats_helpers.read_label_definitions.
+    """
+    label_def = compiled['label_defs'][os.path.relpath(label_def_file, label_def_dir)]
+    return pd.DataFrame({'index': label_def['index'], 'name': label_def['name'].astype(object)})
+
+
+def map_labels(compiled, atlas, labels):
+    """
+    Relabel the source labels of a 'map' atlas.
+
+    Labels that are not in the mapping are unchanged, and logged.
+
+    Args:
+        compiled (dict): compiled label definitions.
+        atlas (str): name of the 'map' atlas.
+        labels (ndarray): non-negative integer labels of the source atlas.
+
+    Returns:
+        ndarray: uint32 mapped labels, of the same shape.
+    """
+    mapping = compiled['mappings'][atlas]
+    lut = mapping['lut']
+
+    labels = np.asarray(labels)
+    if not np.issubdtype(labels.dtype, np.integer):
+        labels = labels.astype(np.int64)
+
+    if labels.size == 0:
+        return labels.astype(np.uint32)
+
+    max_label = int(labels.max())
+    if max_label >= lut.size:
+        lut = np.concatenate([lut, np.arange(lut.size, max_label + 1, dtype=np.uint32)])
+
+    present = np.flatnonzero(np.bincount(labels.reshape(-1), minlength=1))
+    unmapped = np.setdiff1d(present[present > 0], mapping['index'])
+    if unmapped.size > 0:
+        logger.warning(f"Atlas {atlas}: labels {unmapped.tolist()} are not in the mapping, and are unchanged")
+
+    return lut[labels]
+
+
+def label_def_compiler():
+    parser = argparse.ArgumentParser(description='Compile and check the label definitions of the atlas registry')
+    parser.add_argument('--label-def-dir', help='Directory containing the atlas registry, atlases.tsv', type=str,
+                        default=os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                             'label_def'))
+    args = parser.parse_args()
+
+    try:
+        compiled = compile_label_definitions(args.label_def_dir)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    compiled_file = write_compiled_label_definitions(compiled, get_compiled_file(args.label_def_dir))
+
+    for key, label_def in compiled['label_defs'].items():
+        print(f"{key}: {label_def['index'].size} labels")
+    for atlas, mapping in compiled['mappings'].items():
+        print(f"{atlas}: {mapping['index'].size} mapped labels")
+    print(f"Wrote {compiled_file}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    label_def_compiler()
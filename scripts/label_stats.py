@@ -1,9 +1,5 @@
 #!/usr/bin/env python
 
-import antsnetct
-
-from antsnetct import ants_helpers,bids_helpers,system_helpers
-
 import argparse
 import glob
 import json
@@ -12,6 +8,13 @@ import os
 import sys
 import tempfile
 
+import lazy_imports
+
+# antsnetct is imported on first use, so --help and argument errors are quick
+antsnetct = lazy_imports.lazy_module('antsnetct')
+bids_helpers = lazy_imports.lazy_module('antsnetct.bids_helpers')
+system_helpers = lazy_imports.lazy_module('antsnetct.system_helpers')
+
 # Helps with CLI help formatting
 class RawDefaultsHelpFormatter(
     argparse.RawTextHelpFormatter, argparse.ArgumentDefaultsHelpFormatter
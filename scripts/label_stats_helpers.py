@@ -0,0 +1,310 @@
+"""
+Label statistics computed directly with numpy.
+
+These complement antsnetct.parcellation_pipeline.make_label_stats, which handles one label image and its scalars per
+call. Here, any number of label images and co-registered scalar images are summarized in one pass over the voxels.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+import crop_helpers
+import lazy_imports
+import memory_helpers
+
+nib = lazy_imports.lazy_module('nibabel')
+pd = lazy_imports.lazy_module('pandas')
+ndimage = lazy_imports.lazy_module('scipy.ndimage')
+
+logger = logging.getLogger(__name__)
+
+
+def read_label_definitions(label_def_file):
+    """
+    Read a label definition TSV file.
+
+    Args:
+        label_def_file (str): TSV file with columns 'index' and 'name'.
+
+    Returns:
+        DataFrame: label definitions, with integer 'index' and string 'name' columns.
+    """
+    label_defs = pd.read_csv(label_def_file, sep='\t')
+    label_defs['index'] = label_defs['index'].astype(np.int64)
+    return label_defs[['index', 'name']]
+
+
+def _check_same_grid(reference, reference_path, image, image_path):
+    if reference.shape[:3] != image.shape[:3] or not np.allclose(reference.affine, image.affine, atol=1e-4):
+        raise ValueError(f"Image {image_path} is not on the same voxel grid as {reference_path}")
+
+
+def cortical_depth_bins(cortex_label_image, depth_edges):
+    """
+    Bin the voxels of an image by their distance from the cortex.
+
+    The distance of every voxel to the nearest cortical voxel is computed with one Euclidean distance transform, in mm,
+    between voxel centers. Cortical voxels have depth 0.
+
+    Args:
+        cortex_label_image (str): label image of the cortex, non-zero in cortical voxels, eg the dkt31 labels.
+        depth_edges (list): increasing depths in mm separating the bins. With edges [2, 4], the bins are [0, 2),
+            [2, 4) and [4, inf).
+
+    Returns:
+        tuple: (bins, columns), where bins is a uint8 array of bin indices on the grid of the cortex image, and columns
+            is a dict with 'depth_min_mm' and 'depth_max_mm', the depth range of each bin.
+    """
+    depth_edges = [float(edge) for edge in depth_edges]
+    if len(depth_edges) == 0 or any(b <= a for a, b in zip(depth_edges[:-1], depth_edges[1:])) or depth_edges[0] <= 0:
+        raise ValueError(f"Depth bin edges must be positive and increasing, got {depth_edges}")
+    if len(depth_edges) >= np.iinfo(np.uint8).max:
+        raise ValueError(f"Too many depth bins: {len(depth_edges) + 1}")
+
+    proxy = nib.load(cortex_label_image)
+    cortex = np.asanyarray(proxy.dataobj) > 0
+
+    if not np.any(cortex):
+        raise ValueError(f"No cortical voxels in {cortex_label_image}")
+
+    depth = ndimage.distance_transform_edt(~cortex, sampling=proxy.header.get_zooms()[:3])
+    bins = np.digitize(depth, depth_edges).astype(np.uint8)
+
+    columns = {'depth_min_mm': [0.0] + depth_edges, 'depth_max_mm': depth_edges + [np.inf]}
+
+    return bins, columns
+
+
+def compute_label_scalar_stats(label_images, scalar_images, chunk_slices=16, label_strata=None):
+    """
+    Compute the mean and standard deviation of each scalar image within each label, for several label images at once.
+
+    The scalar images are read together in slabs of `chunk_slices` slices along the last axis, so the whole stack of
+    scalars is never held in memory. Only the bounding box of the labels is read. Each slab is reduced into per-label
+    count, sum and sum of squares accumulators for every label image. Non-finite scalar values are excluded.
+
+    Label images may also be summarized by stratum, eg by depth from the cortex. Each voxel is then accumulated under
+    its label and stratum, in the same bincount as the unstratified labels.
+
+    Args:
+        label_images (dict): name -> path of integer label images.
+        scalar_images (dict): description -> path of scalar images, on the same voxel grid as the label images.
+        chunk_slices (int): number of slices per slab.
+        label_strata (dict, optional): name -> (strata, num_strata) for label images summarized by stratum, where
+            strata is an integer array of stratum indices on the label grid, each less than num_strata.
+
+    Returns:
+        dict: label image name -> dict with keys 'voxels', an array of voxel counts of shape (max label + 1,), and
+            'count', 'sum', 'sum_sq', each an array of shape (number of scalars, max label + 1), where 'count' is the
+            number of voxels with a finite scalar value. Arrays are indexed by label value, and scalars are in the
+            order of `scalar_images`. For label images in `label_strata`, every array has an extra last axis, indexed
+            by stratum.
+    """
+    if len(label_images) == 0 or len(scalar_images) == 0:
+        raise ValueError("At least one label image and one scalar image are required")
+
+    label_strata = label_strata if label_strata is not None else dict()
+
+    label_proxies = {name: nib.load(path) for name, path in label_images.items()}
+    scalar_proxies = [nib.load(path) for path in scalar_images.values()]
+
+    reference_path = next(iter(label_images.values()))
+    reference = label_proxies[next(iter(label_images))]
+
+    for name, proxy in label_proxies.items():
+        _check_same_grid(reference, reference_path, proxy, label_images[name])
+    for path, proxy in zip(scalar_images.values(), scalar_proxies):
+        _check_same_grid(reference, reference_path, proxy, path)
+
+    num_scalars = len(scalar_proxies)
+
+    # Labels are small next to the scalar stack, and we need the maximum label up front to size the accumulators. They
+    # are held as unsigned integers, rather than the float or int64 they are often stored as
+    label_arrays = dict()
+    for name, proxy in label_proxies.items():
+        try:
+            label_arrays[name] = memory_helpers.to_label_array(np.asanyarray(proxy.dataobj))
+        except ValueError as e:
+            raise ValueError(f"Invalid label image {label_images[name]}: {e}")
+
+    # Crop everything to the bounding box of all labels
+    label_box = crop_helpers.union_bounding_box(*[crop_helpers.bounding_box(labels) for labels in label_arrays.values()])
+    (x_start, y_start, z_start), (x_end, y_end, z_end) = label_box
+    strata_arrays = dict()
+    num_strata = dict()
+    for name, (strata, name_num_strata) in label_strata.items():
+        if strata.shape[:3] != label_arrays[name].shape[:3]:
+            raise ValueError(f"Strata for {label_images[name]} are not on the label image grid")
+        strata_arrays[name] = strata[x_start:x_end, y_start:y_end, z_start:z_end]
+        num_strata[name] = int(name_num_strata)
+
+    label_arrays = {name: labels[x_start:x_end, y_start:y_end, z_start:z_end] for name, labels in label_arrays.items()}
+
+    accumulators = dict()
+    for name, labels in label_arrays.items():
+        # Stratified labels are accumulated under label * num_strata + stratum, and reshaped at the end
+        num_bins = (int(labels.max()) + 1) * num_strata.get(name, 1)
+        accumulators[name] = {stat: np.zeros((num_scalars, num_bins)) for stat in ('count', 'sum', 'sum_sq')}
+        accumulators[name]['voxels'] = np.zeros(num_bins)
+
+    for slab_start in range(z_start, z_end, chunk_slices):
+        slab_end = min(slab_start + chunk_slices, z_end)
+
+        scalar_slab = np.stack([np.asarray(proxy.dataobj[x_start:x_end, y_start:y_end, slab_start:slab_end],
+                                           dtype=np.float64).reshape(-1)
+                                for proxy in scalar_proxies])
+        valid = np.isfinite(scalar_slab)
+        scalar_slab[~valid] = 0.0
+
+        for name, labels in label_arrays.items():
+            label_slab = labels[:, :, slab_start - z_start:slab_end - z_start].reshape(-1)
+            in_label = label_slab > 0
+            if not np.any(in_label):
+                continue
+            slab_labels = label_slab[in_label]
+            if name in strata_arrays:
+                strata_slab = strata_arrays[name][:, :, slab_start - z_start:slab_end - z_start].reshape(-1)
+                slab_labels = slab_labels.astype(np.int64) * num_strata[name] + strata_slab[in_label]
+            slab_values = scalar_slab[:, in_label]
+            slab_valid = valid[:, in_label]
+            acc = accumulators[name]
+            num_bins = acc['count'].shape[1]
+            acc['voxels'] += np.bincount(slab_labels, minlength=num_bins)
+            for scalar_index in range(num_scalars):
+                values = slab_values[scalar_index]
+                acc['count'][scalar_index] += np.bincount(slab_labels, weights=slab_valid[scalar_index],
+                                                          minlength=num_bins)
+                acc['sum'][scalar_index] += np.bincount(slab_labels, weights=values, minlength=num_bins)
+                acc['sum_sq'][scalar_index] += np.bincount(slab_labels, weights=values * values, minlength=num_bins)
+
+    for name in strata_arrays:
+        acc = accumulators[name]
+        for stat in ('count', 'sum', 'sum_sq'):
+            acc[stat] = acc[stat].reshape(num_scalars, -1, num_strata[name])
+        acc['voxels'] = acc['voxels'].reshape(-1, num_strata[name])
+
+    return accumulators
+
+
+def label_stats_table(accumulators, scalar_descriptions, label_defs, voxel_volume_ml=None, warn_undefined=True,
+                      fractional=False):
+    """
+    Convert label stats accumulators into a table with one row per defined label.
+
+    Args:
+        accumulators (dict): accumulators for one label image, from compute_label_scalar_stats.
+        scalar_descriptions (list): descriptions of the scalars, in accumulator order.
+        label_defs (DataFrame): label definitions from read_label_definitions.
+        voxel_volume_ml (float, optional): voxel volume in ml. If provided, a volume_ml column is added.
+        warn_undefined (bool): log labels that are in the image but not in the label definitions.
+        fractional (bool): the voxel counts are partial-volume weights, and are not rounded to integers.
+
+    Returns:
+        DataFrame: columns label, name, [volume_ml], then <scalar>_voxels, <scalar>_mean, <scalar>_sd for each scalar.
+            Labels with no voxels have NaN mean and sd.
+    """
+    num_bins = accumulators['count'].shape[1]
+    label_index = label_defs['index'].to_numpy()
+
+    in_range = label_index < num_bins
+    lookup = np.where(in_range, label_index, 0)
+
+    table = pd.DataFrame({'label': label_index, 'name': label_defs['name'].to_numpy()})
+
+    if voxel_volume_ml is not None:
+        voxels = np.where(in_range, accumulators['voxels'][lookup], 0)
+        table['volume_ml'] = voxels * voxel_volume_ml
+
+    for scalar_index, description in enumerate(scalar_descriptions):
+        count = np.where(in_range, accumulators['count'][scalar_index][lookup], 0)
+        total = np.where(in_range, accumulators['sum'][scalar_index][lookup], 0)
+        total_sq = np.where(in_range, accumulators['sum_sq'][scalar_index][lookup], 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+            variance = np.maximum(total_sq / count - mean * mean, 0.0)
+        table[f"{description}_voxels"] = count if fractional else count.astype(np.int64)
+        table[f"{description}_mean"] = mean
+        table[f"{description}_sd"] = np.sqrt(variance)
+
+    if warn_undefined:
+        undefined = np.setdiff1d(np.nonzero(accumulators['voxels'])[0], label_index)
+        undefined = undefined[undefined > 0]
+        if len(undefined) > 0:
+            logger.warning(f"Labels present in the image but not in the label definitions: {undefined.tolist()}")
+
+    return table
+
+
+def stratified_label_stats_table(accumulators, scalar_descriptions, label_defs, stratum_columns, voxel_volume_ml=None):
+    """
+    Convert stratified label stats accumulators into a table with one row per defined label and stratum.
+
+    Args:
+        accumulators (dict): accumulators for one stratified label image, from compute_label_scalar_stats.
+        scalar_descriptions (list): descriptions of the scalars, in accumulator order.
+        label_defs (DataFrame): label definitions from read_label_definitions.
+        stratum_columns (dict): column name -> list of values, one per stratum, describing the strata, eg the depth
+            range of each bin from cortical_depth_bins.
+        voxel_volume_ml (float, optional): voxel volume in ml. If provided, a volume_ml column is added.
+
+    Returns:
+        DataFrame: columns label, name, the stratum columns, then the columns of label_stats_table. Rows are ordered by
+            stratum, then label.
+    """
+    tables = list()
+
+    for stratum in range(accumulators['voxels'].shape[-1]):
+        stratum_accumulators = {stat: values[..., stratum] for stat, values in accumulators.items()}
+        table = label_stats_table(stratum_accumulators, scalar_descriptions, label_defs,
+                                  voxel_volume_ml=voxel_volume_ml, warn_undefined=stratum == 0)
+        for position, (column, values) in enumerate(stratum_columns.items()):
+            table.insert(2 + position, column, values[stratum])
+        tables.append(table)
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def write_label_scalar_stats(label_images, label_defs, scalar_images, output_files, chunk_slices=16, strata=None):
+    """
+    Compute label stats for several label images and scalars in one pass, and write one TSV per label image.
+
+    Args:
+        label_images (dict): name -> path of label images.
+        label_defs (dict): name -> DataFrame of label definitions for each label image.
+        scalar_images (dict): description -> path of scalar images.
+        output_files (dict): name -> output TSV path for each label image.
+        chunk_slices (int): number of slices per slab.
+        strata (dict, optional): name -> (strata, stratum_columns) for label images summarized by stratum, where strata
+            is an integer array of stratum indices, and stratum_columns describes the strata as in
+            stratified_label_stats_table.
+
+    Returns:
+        list: paths to the output files.
+    """
+    strata = strata if strata is not None else dict()
+
+    label_strata = {name: (stratum_array, len(next(iter(stratum_columns.values()))))
+                    for name, (stratum_array, stratum_columns) in strata.items()}
+
+    accumulators = compute_label_scalar_stats(label_images, scalar_images, chunk_slices=chunk_slices,
+                                              label_strata=label_strata)
+
+    scalar_descriptions = list(scalar_images.keys())
+
+    written = list()
+
+    for name, label_image in label_images.items():
+        voxel_volume_ml = float(np.prod(nib.load(label_image).header.get_zooms()[:3])) / 1000.0
+        if name in strata:
+            table = stratified_label_stats_table(accumulators[name], scalar_descriptions, label_defs[name],
+                                                 strata[name][1], voxel_volume_ml=voxel_volume_ml)
+        else:
+            table = label_stats_table(accumulators[name], scalar_descriptions, label_defs[name],
+                                      voxel_volume_ml=voxel_volume_ml)
+        os.makedirs(os.path.dirname(output_files[name]), exist_ok=True)
+        table.to_csv(output_files[name], sep='\t', index=False, float_format='%.6g', na_rep='NaN')
+        written.append(output_files[name])
+
+    return written
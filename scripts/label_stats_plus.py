@@ -1,20 +1,27 @@
 #!/usr/bin/env python
 
-import antsnetct
-
-from antsnetct import ants_helpers,bids_helpers,system_helpers
-from ants import image_read as ants_image_read
-from ants import image_write as ants_image_write
-
-
 import argparse
 import glob
 import json
 import logging
 import os
 import sys
-import tempfile
-import pandas as pd
+
+import atlas_registry
+import label_def_compiler
+import label_stats_helpers
+import lazy_imports
+import manifest_helpers
+import memory_helpers
+import partial_volume_helpers
+import scratch_helpers
+import work_dir_helpers
+
+# antsnetct, ANTsPy and pandas are imported on first use, so --help, --dry-run and sessions that are up to date are quick
+antsnetct = lazy_imports.lazy_module('antsnetct')
+bids_helpers = lazy_imports.lazy_module('antsnetct.bids_helpers')
+system_helpers = lazy_imports.lazy_module('antsnetct.system_helpers')
+ants_image_read = lazy_imports.lazy_function('ants', 'image_read')
 
 # Helps with CLI help formatting
 class RawDefaultsHelpFormatter(
@@ -33,15 +40,69 @@ def t1w_to_ihmt_pipeline():
 
     Output is to the same dataset.
 
+    Atlases are read from the registry label_def/atlases.tsv. Label stats from antsnetct are computed for every atlas
+    with a label definition, and atlases with a 'map' source (eg dkt31wmlobes) are made here by relabeling another
+    atlas.
+
+    In addition, the mean and SD of every scalar image given with --scalar are computed for every atlas with a label
+    definition in a single pass over the voxels, and written to
+    '_seg-<atlas>_scalarstats.tsv'. Scalars are specified as 'description=pattern', where pattern is a glob relative to
+    the session anat directory, eg
+
+        --scalar ihMTR='*_part-mag_ihMTR.nii.gz' --scalar ihMTsat='*_ihMTsat.nii.gz'
+
+    Patterns may also be absolute paths, with {participant} and {session} substituted. All scalar images must be
+    co-registered to the ihMTR image.
+
+    Superficial WM is affected by partial volume with the cortex at the ihMTR resolution. With --wm-depth-bins, the
+    scalars in the WM atlases (propagated atlases such as dkt31wm, and atlases mapped from them such as dkt31wmlobes)
+    are also summarized by depth below the cortex, in the same pass, and written to '_seg-<atlas>_depthstats.tsv'.
+    Depth is the distance in mm to the nearest voxel of the atlas the WM labels were propagated from, eg dkt31. With
+    '--wm-depth-bins 2.5,5,10', the bins are [0, 2.5), [2.5, 5), [5, 10) and [10, inf) mm.
+
+    Atlases resampled to the ihMTR grid give each voxel a single label. With --partial-volume, the scalars in the
+    atlases transferred from the T1w are also summarized with the partial-volume operator written by the registration
+    with --partial-volume-labels, weighting each voxel by the fraction of it covered by each label, and written to
+    '_seg-<atlas>_desc-partialvolume_scalarstats.tsv'. Volumes are the T1w volumes of the labels within the ihMTR field
+    of view, and the coverage column is the fraction of each label within it.
+
+    A completion manifest is written for each session, and sessions are skipped if their
+    label images, ihMTR and label definitions are unchanged since the stats were computed.
+
+    With --dry-run, the inputs are checked and the outputs listed without computing stats. Use --session-list instead of
+    --participant and --session to check a whole cohort in one process.
+
     ''')
     required_parser = parser.add_argument_group('Required arguments')
     required_parser.add_argument('--input-dataset', help='Input BIDS dataset dir, containing the source images and masks',
                                  type=str, required=True)
-    required_parser.add_argument('--label-def-dir', help='Directory containing label definition files, eg dkt31.tsv',
-                                 type=str, required=True)
-    required_parser.add_argument('--participant', '--subject', help='Participant to process', type=str, required=True)
-    required_parser.add_argument('--session', help='Session to process.', type=str, default=None, required=True)
+    required_parser.add_argument('--label-def-dir', help='Directory containing the atlas registry atlases.tsv and label '
+                                 'definition files, eg dkt31.tsv', type=str, required=True)
+    required_parser.add_argument('--participant', '--subject', help='Participant to process', type=str, default=None)
+    required_parser.add_argument('--session', help='Session to process.', type=str, default=None)
     optional_parser = parser.add_argument_group('Optional arguments')
+    optional_parser.add_argument('--scalar', help='Scalar image to summarize, as description=pattern. May be repeated',
+                                 type=str, action='append', default=None)
+    optional_parser.add_argument('--wm-depth-bins', help='Comma-separated depth bin edges in mm. If set, WM atlas stats '
+                                 'are also written by depth below the cortex', type=str, default=None)
+    optional_parser.add_argument('--partial-volume', help='Also compute partial-volume weighted stats for the atlases '
+                                 'transferred from the T1w, with the operator written by the registration',
+                                 action='store_true')
+    optional_parser.add_argument('--chunk-slices', help='Number of slices of the scalar images to process at a time',
+                                 type=int, default=16)
+    optional_parser.add_argument('--scratch-format', help='Format for intermediate images in the working directory, '
+                                 '"nii" (uncompressed, memory-mapped by readers) or "nii.gz"', type=str, default='nii',
+                                 choices=scratch_helpers.SCRATCH_FORMATS)
+    optional_parser.add_argument('--work-dir-shm-mb', help='RAM in MB that may be used for intermediate files. If '
+                                 '/dev/shm and the job have this much to spare, the working directory is placed on '
+                                 '/dev/shm, otherwise under TMPDIR', type=float, default=0)
+    optional_parser.add_argument('--keep-work-dir', help='Keep the working directory, for debugging',
+                                 action='store_true')
+    optional_parser.add_argument('--force', help='Recompute stats even if they are up to date', action='store_true')
+    optional_parser.add_argument('--dry-run', help='Check the inputs and list the outputs, without computing stats',
+                                 action='store_true')
+    optional_parser.add_argument('--session-list', help='With --dry-run, CSV file with participants and sessions to '
+                                 'check, one per line, no header', type=str, default=None)
     optional_parser.add_argument('-h', '--help', action='help', help='show this help message and exit')
     optional_parser.add_argument('--verbose', help='Verbose output from subcommands', action='store_true')
 
@@ -54,8 +115,6 @@ def t1w_to_ihmt_pipeline():
 
     print('Parsed args: ' + str(args))
 
-    system_helpers.set_verbose(args.verbose)
-
     input_dataset = args.input_dataset
     participant = args.participant
     session = args.session
@@ -68,21 +127,79 @@ def t1w_to_ihmt_pipeline():
     else:
         raise ValueError('Input dataset does not contain a dataset_description.json file')
 
-    if participant is None:
-        raise ValueError('Participant must be defined')
-    if session is None:
-        raise ValueError('Session must be defined')
+    if args.session_list is not None and not args.dry_run:
+        raise ValueError('--session-list requires --dry-run')
+
+    if args.session_list is None:
+        if participant is None:
+            raise ValueError('Participant must be defined')
+        if session is None:
+            raise ValueError('Session must be defined')
 
     print('Input dataset path: ' + input_dataset)
     print('Input dataset name: ' + input_dataset_description['Name'])
 
-    with tempfile.TemporaryDirectory(suffix=f"ihmt_label_stats_{participant}.tmpdir") as work_dir:
-        # get segmentations and compute label stats
-        dkt31_label_def = os.path.join(args.label_def_dir, 'dkt31.tsv')
-        hoa_label_def = os.path.join(args.label_def_dir, 'hoa.tsv')
-        dkt31_to_lobes_label_def = os.path.join(args.label_def_dir, 'tpl-ADNINormalAgingANTs_atlas-DKTandLobes_desc-31_dseg.tsv')
-        dktlobes_label_def = os.path.join(args.label_def_dir, 'dkt31lobes.tsv')
+    scalar_specs = args.scalar if args.scalar is not None else ['ihMTR=*_part-mag_ihMTR.nii.gz']
+
+    scalar_patterns = dict()
+    for scalar_spec in scalar_specs:
+        if '=' not in scalar_spec:
+            raise ValueError(f"Scalar must be specified as description=pattern, got {scalar_spec}")
+        description, pattern = scalar_spec.split('=', 1)
+        scalar_patterns[description] = pattern
+
+    stage_parameters = {'compute_label_geometry': True, 'scalars': scalar_patterns}
+
+    depth_edges = None
+    if args.wm_depth_bins is not None:
+        try:
+            depth_edges = [float(edge) for edge in args.wm_depth_bins.split(',')]
+        except ValueError:
+            raise ValueError(f"Invalid --wm-depth-bins {args.wm_depth_bins}, expected comma-separated depths in mm")
+        if depth_edges[0] <= 0 or any(b <= a for a, b in zip(depth_edges[:-1], depth_edges[1:])):
+            raise ValueError(f"Depth bin edges must be positive and increasing, got {args.wm_depth_bins}")
+        # Only added when set, so that existing stats are not made stale
+        stage_parameters['wm_depth_bin_edges'] = depth_edges
+
+    if args.partial_volume:
+        stage_parameters['partial_volume'] = True
+
+    atlases = atlas_registry.read_atlas_registry(args.label_def_dir)
+    label_def_atlases = atlas_registry.get_atlases(atlases, with_label_def=True)
+    wm_atlases = atlas_registry.get_wm_atlases(atlases) if depth_edges is not None else list()
+    partial_volume_atlases = get_partial_volume_atlases(atlases) if args.partial_volume else list()
+
+    # Label definitions are validated when they are compiled, so mismatches are found before any session is processed
+    label_defs = label_def_compiler.load_label_definitions(args.label_def_dir, atlases)
+
+    if args.dry_run:
+        if args.session_list is not None:
+            from session_lists import read_session_list
+            sessions = read_session_list(args.session_list)
+        else:
+            sessions = [(participant, session)]
+        num_invalid = dry_run(input_dataset, atlases, wm_atlases, partial_volume_atlases, scalar_patterns, sessions,
+                              stage_parameters)
+        sys.exit(1 if num_invalid > 0 else 0)
+
+    session_status, status_reasons = manifest_helpers.check_session(input_dataset, 'labelstats', participant, session,
+                                                                    session_dir_marks_partial=False,
+                                                                    parameters=stage_parameters)
+
+    if session_status == manifest_helpers.STATUS_DONE and not args.force:
+        print(f"Label stats are up to date for participant {participant}, session {session}")
+        return
+
+    if session_status != manifest_helpers.STATUS_MISSING:
+        print(f"Recomputing label stats for participant {participant}, session {session} ({session_status}): " +
+              "; ".join(status_reasons))
+    manifest_helpers.remove_manifest(input_dataset, 'labelstats', participant, session)
 
+    system_helpers.set_verbose(args.verbose)
+
+    with work_dir_helpers.WorkDir(f"ihmt_label_stats_{participant}", shm_budget_mb=args.work_dir_shm_mb,
+                                  keep=args.keep_work_dir) as managed_work_dir:
+        work_dir = managed_work_dir.path
 
         mtr = glob.glob(os.path.join(input_dataset, f"sub-{participant}", f"ses-{session}", 'anat',
                                         f"sub-{participant}_ses-{session}_*_part-mag_ihMTR.nii.gz"))[0]
@@ -91,36 +208,322 @@ def t1w_to_ihmt_pipeline():
 
         mtr_bids = bids_helpers.BIDSImage(input_dataset, mtr_relpath)
 
-        dkt31_bids = mtr_bids.get_derivative_image('_space-ihmt_seg-dkt31_dseg.nii.gz')
+        # Atlases written by the registration are read from the dataset. Mapped atlases are computed here from them,
+        # and only the atlases that are summarized or mapped are needed
+        needed_atlases = get_needed_atlases(atlases, wm_atlases)
+
+        atlas_bids = dict()
+        atlas_label_images = dict()
+        seg_inputs = dict()
+        mapped_outputs = list()
+
+        for atlas in atlases:
+            name = atlas['atlas']
+            if atlas['source_type'] != 'map':
+                if name in needed_atlases:
+                    atlas_bids[name] = mtr_bids.get_derivative_image(f"_space-ihmt_seg-{name}_dseg.nii.gz")
+                    atlas_label_images[name] = atlas_bids[name].get_path()
+                    seg_inputs[f"seg_{name}"] = atlas_bids[name].get_path()
+                continue
+
+            # relabel the source atlas with the compiled mapping table, in one lookup
+            source_img = ants_image_read(atlas_label_images[atlas['source']], pixeltype='unsigned int')
+            mapped_img = source_img.new_image_like(label_def_compiler.map_labels(label_defs, name, source_img.numpy()))
+
+            mapped_image_file = scratch_helpers.write_scratch_image(mapped_img, work_dir, name, args.scratch_format)
+
+            atlas_bids[name] = scratch_helpers.image_to_bids(mapped_image_file, input_dataset,
+                                                             mtr_bids.get_derivative_rel_path_prefix() +
+                                                             f"_space-ihmt_seg-{name}_dseg.nii.gz", work_dir,
+                                                             metadata={'Sources': [
+                                                                 atlas_bids[atlas['source']].get_uri(relative=False)]})
+            atlas_label_images[name] = mapped_image_file
+            mapped_outputs.append(atlas_bids[name].get_path())
+
+        for atlas in label_def_atlases:
+            antsnetct.parcellation_pipeline.make_label_stats(atlas_bids[atlas['atlas']], atlas['label_def'], work_dir,
+                                                             compute_label_geometry=True, scalar_images=[mtr_bids],
+                                                             scalar_descriptions=['ihMTR'])
+
+        # All atlas x scalar stats in one pass
+        scalar_images = find_scalar_images(input_dataset, participant, session, scalar_patterns)
+
+        stats_label_images = {atlas['atlas']: atlas_label_images[atlas['atlas']] for atlas in label_def_atlases}
+        atlas_label_defs = {atlas['atlas']: label_def_compiler.get_label_definitions(label_defs, args.label_def_dir,
+                                                                                     atlas['label_def'])
+                            for atlas in label_def_atlases}
+        scalar_stats_files = {atlas: mtr_bids.get_derivative_path_prefix() + f"_space-ihmt_seg-{atlas}_scalarstats.tsv"
+                              for atlas in stats_label_images}
+
+        # WM atlases by depth, as extra stratified label images in the same pass. Depth is computed once per cortex
+        depth_strata = dict()
+        cortex_depth_bins = dict()
+        for wm_atlas in wm_atlases:
+            cortex = wm_atlas['cortex']
+            if cortex not in cortex_depth_bins:
+                cortex_depth_bins[cortex] = label_stats_helpers.cortical_depth_bins(atlas_label_images[cortex],
+                                                                                    depth_edges)
+            depth_name = f"{wm_atlas['atlas']}_depth"
+            stats_label_images[depth_name] = atlas_label_images[wm_atlas['atlas']]
+            atlas_label_defs[depth_name] = label_def_compiler.get_label_definitions(label_defs, args.label_def_dir,
+                                                                                    wm_atlas['label_def'])
+            scalar_stats_files[depth_name] = get_depth_stats_file(mtr_bids, wm_atlas['atlas'])
+            depth_strata[depth_name] = cortex_depth_bins[cortex]
+
+        label_stats_helpers.write_label_scalar_stats(stats_label_images, atlas_label_defs, scalar_images,
+                                                     scalar_stats_files, chunk_slices=args.chunk_slices,
+                                                     strata=depth_strata)
+        del cortex_depth_bins, depth_strata
+
+        # Partial-volume weighted stats of all atlases and scalars, in one sparse product
+        partial_volume_inputs = dict()
+        if len(partial_volume_atlases) > 0:
+            operator_file = partial_volume_helpers.get_operator_file(mtr_bids.get_derivative_path_prefix())
+            if not os.path.exists(operator_file):
+                raise ValueError(f"Partial-volume operator {operator_file} not found. Run the registration with "
+                                 "--partial-volume-labels")
+            partial_volume_helpers.write_partial_volume_stats(
+                operator_file,
+                {atlas['atlas']: atlas_label_defs[atlas['atlas']] for atlas in partial_volume_atlases},
+                scalar_images,
+                {atlas['atlas']: get_partial_volume_stats_file(mtr_bids, atlas['atlas'])
+                 for atlas in partial_volume_atlases})
+            partial_volume_inputs['partial_volume_operator'] = operator_file
+
+        output_files = list(mapped_outputs)
+        for atlas in label_def_atlases:
+            output_files.extend(get_label_stats_outputs(atlas_bids[atlas['atlas']]))
+        for wm_atlas in wm_atlases:
+            depth_stats_file = get_depth_stats_file(mtr_bids, wm_atlas['atlas'])
+            if depth_stats_file not in output_files:
+                output_files.append(depth_stats_file)
+        for atlas in partial_volume_atlases:
+            partial_volume_stats_file = get_partial_volume_stats_file(mtr_bids, atlas['atlas'])
+            if partial_volume_stats_file not in output_files:
+                output_files.append(partial_volume_stats_file)
+
+        label_def_inputs = dict()
+        for atlas in atlases:
+            if atlas['label_def'] is not None:
+                label_def_inputs[f"label_def_{atlas['atlas']}"] = atlas['label_def']
+            if atlas['mapping'] is not None:
+                label_def_inputs[f"mapping_{atlas['atlas']}"] = atlas['mapping']
+
+        managed_work_dir.report('label stats')
+
+        peak_memory = memory_helpers.peak_memory_report()
+        print(f"Peak memory for participant {participant}, session {session}: {peak_memory['PeakRSSMB']} MB, "
+              f"largest subprocess {peak_memory['PeakChildRSSMB']} MB")
+
+        manifest_helpers.write_manifest(input_dataset, 'labelstats', participant, session, outputs=output_files,
+                                        inputs={'ihMTR': mtr_bids.get_path(),
+                                                'atlas_registry': atlas_registry.get_registry_file(args.label_def_dir),
+                                                **seg_inputs,
+                                                **partial_volume_inputs,
+                                                **label_def_inputs,
+                                                **{f"scalar_{description}": path
+                                                   for description, path in scalar_images.items()}},
+                                        parameters=stage_parameters,
+                                        resources={**peak_memory, **managed_work_dir.resources()})
+
+
+def dry_run(input_dataset, atlases, wm_atlases, partial_volume_atlases, scalar_patterns, sessions, stage_parameters):
+    """
+    Check the inputs of sessions and list their outputs, without computing stats.
+
+    Writes a TSV with columns participant, session, status, outputs and problems to stdout, where outputs is the number
+    of label images and scalar stats files the session would write. For a single session, these are also printed.
+
+    Args:
+        input_dataset (str): BIDS dataset.
+        atlases (list): atlas registry.
+        wm_atlases (list): WM atlases to summarize by depth, from atlas_registry.get_wm_atlases, or an empty list.
+        partial_volume_atlases (list): atlases to summarize with the partial-volume operator, or an empty list.
+        scalar_patterns (dict): description -> glob pattern of the scalar images.
+        sessions (list): (participant, session) tuples.
+        stage_parameters (dict): stage parameters, for the completion status.
+
+    Returns:
+        int: number of sessions with missing or ambiguous inputs.
+    """
+    num_invalid = 0
+
+    print("participant\tsession\tstatus\toutputs\tproblems")
+
+    for participant, session in sessions:
+        session_status, _ = manifest_helpers.check_session(input_dataset, 'labelstats', participant, session,
+                                                           session_dir_marks_partial=False,
+                                                           parameters=stage_parameters)
+        outputs, problems = plan_session(input_dataset, atlases, wm_atlases, partial_volume_atlases, scalar_patterns,
+                                         participant, session)
+        if len(problems) > 0:
+            num_invalid += 1
+        print(f"{participant}\t{session}\t{session_status}\t{len(outputs)}\t{'; '.join(problems)}")
+        if len(sessions) == 1:
+            for output in outputs:
+                print(f"Output: {output}")
+
+    print(f"Checked {len(sessions)} sessions, {num_invalid} with missing or ambiguous inputs")
+
+    return num_invalid
+
+
+def plan_session(input_dataset, atlases, wm_atlases, partial_volume_atlases, scalar_patterns, participant, session):
+    """
+    Find the inputs of a session and the label images and scalar stats files it would write.
+
+    Args:
+        input_dataset (str): BIDS dataset.
+        atlases (list): atlas registry.
+        wm_atlases (list): WM atlases to summarize by depth, or an empty list.
+        partial_volume_atlases (list): atlases to summarize with the partial-volume operator, or an empty list.
+        scalar_patterns (dict): description -> glob pattern of the scalar images.
+        participant (str): Participant ID.
+        session (str): Session ID.
+
+    Returns:
+        tuple: (outputs, problems), output paths and descriptions of any missing or ambiguous inputs.
+    """
+    outputs = list()
+    problems = list()
+
+    try:
+        find_scalar_images(input_dataset, participant, session, scalar_patterns)
+    except ValueError as e:
+        problems.append(str(e))
+
+    mtr = glob.glob(os.path.join(input_dataset, f"sub-{participant}", f"ses-{session}", 'anat',
+                                 f"sub-{participant}_ses-{session}_*_part-mag_ihMTR.nii.gz"))
+    if len(mtr) != 1:
+        problems.append(f"expected one ihMTR image, found {len(mtr)}")
+        return outputs, problems
+
+    mtr_bids = bids_helpers.BIDSImage(input_dataset, os.path.relpath(mtr[0], input_dataset))
+    mtr_prefix = mtr_bids.get_derivative_path_prefix()
+
+    label_def_atlases = atlas_registry.get_atlases(atlases, with_label_def=True)
+    needed_atlases = get_needed_atlases(atlases, wm_atlases)
+
+    for atlas in atlases:
+        label_file = mtr_prefix + f"_space-ihmt_seg-{atlas['atlas']}_dseg.nii.gz"
+        if atlas['source_type'] == 'map':
+            outputs.append(label_file)
+        elif atlas['atlas'] in needed_atlases and not os.path.exists(label_file):
+            problems.append(f"missing {atlas['atlas']} atlas {label_file}")
+
+    outputs.extend([mtr_prefix + f"_space-ihmt_seg-{atlas['atlas']}_scalarstats.tsv" for atlas in label_def_atlases])
+    outputs.extend([get_depth_stats_file(mtr_bids, wm_atlas['atlas']) for wm_atlas in wm_atlases])
+
+    if len(partial_volume_atlases) > 0:
+        operator_file = partial_volume_helpers.get_operator_file(mtr_bids.get_derivative_path_prefix())
+        if not os.path.exists(operator_file):
+            problems.append(f"missing partial-volume operator {operator_file}")
+        outputs.extend([get_partial_volume_stats_file(mtr_bids, atlas['atlas']) for atlas in partial_volume_atlases])
+
+    return outputs, problems
+
+
+def get_needed_atlases(atlases, wm_atlases):
+    """
+    Get the atlases that are read by the label stats: those summarized, mapped to other atlases, or defining the cortex
+    for the depth of a WM atlas.
+
+    Args:
+        atlases (list): atlas registry.
+        wm_atlases (list): WM atlases to summarize by depth, or an empty list.
+
+    Returns:
+        set: atlas names.
+    """
+    needed_atlases = {atlas['atlas'] for atlas in atlas_registry.get_atlases(atlases, with_label_def=True)}
+    needed_atlases.update(atlas['source'] for atlas in atlas_registry.get_atlases(atlases, source_type='map'))
+    for wm_atlas in wm_atlases:
+        needed_atlases.update((wm_atlas['atlas'], wm_atlas['cortex']))
+    return needed_atlases
+
+
+def get_depth_stats_file(mtr_bids, atlas):
+    """
+    Get the path of the depth-stratified stats of a WM atlas.
+
+    Args:
+        mtr_bids (BIDSImage): ihMTR image.
+        atlas (str): WM atlas name.
+
+    Returns:
+        str: path to the TSV file.
+    """
+    return mtr_bids.get_derivative_path_prefix() + f"_space-ihmt_seg-{atlas}_depthstats.tsv"
+
+
+def get_partial_volume_atlases(atlases):
+    """
+    Get the atlases summarized with the partial-volume operator: those transferred from the T1w, with a label
+    definition. Atlases made in the ihMT space have no T1w-resolution labels.
+
+    Args:
+        atlases (list): atlas registry.
+
+    Returns:
+        list: atlases, in registry order.
+    """
+    return atlas_registry.get_atlases(atlases, source_type='antsnetct', with_label_def=True)
+
+
+def get_partial_volume_stats_file(mtr_bids, atlas):
+    """
+    Get the path of the partial-volume weighted stats of an atlas.
+
+    Args:
+        mtr_bids (BIDSImage): ihMTR image.
+        atlas (str): atlas name.
+
+    Returns:
+        str: path to the TSV file.
+    """
+    return mtr_bids.get_derivative_path_prefix() + f"_space-ihmt_seg-{atlas}_desc-partialvolume_scalarstats.tsv"
+
+
+def find_scalar_images(input_dataset, participant, session, scalar_patterns):
+    """
+    Find the scalar images for a session.
+
+    Args:
+        input_dataset (str): BIDS dataset.
+        participant (str): Participant ID.
+        session (str): Session ID.
+        scalar_patterns (dict): description -> glob pattern, relative to the session anat directory or absolute. Absolute
+            patterns may contain {participant} and {session}.
+
+    Returns:
+        dict: description -> path of the scalar image.
+    """
+    anat_dir = os.path.join(input_dataset, f"sub-{participant}", f"ses-{session}", 'anat')
 
-        hoa_bids = mtr_bids.get_derivative_image('_space-ihmt_seg-hoa_dseg.nii.gz')
+    scalar_images = dict()
 
-        dkt31_wm_bids = mtr_bids.get_derivative_image('_space-ihmt_seg-dkt31wm_dseg.nii.gz')
-        dkt31_wm_img = ants_image_read(dkt31_wm_bids.get_path())
-        # labels to lobes
-        dkt31_and_lobes = pd.read_csv(dkt31_to_lobes_label_def, sep = "\t")
-        replace_dict = dict(zip(dkt31_and_lobes['index'],dkt31_and_lobes['lobe_index']))
-        for key, value in replace_dict.items ():
-            dkt31_wm_img[dkt31_wm_img == key] = value
-        
-        # save dkt wm labels
-        wm_dktlobe_image_file = system_helpers.get_temp_file(work_dir, prefix='wm_dktlobes') + '_wm_dktlobes.nii.gz'
+    for description, pattern in scalar_patterns.items():
+        pattern = pattern.format(participant=participant, session=session)
+        matches = sorted(glob.glob(os.path.join(anat_dir, pattern)))
+        if len(matches) != 1:
+            raise ValueError(f"Expected one {description} image matching {pattern} for participant {participant}, "
+                             f"session {session}, found {len(matches)}")
+        scalar_images[description] = matches[0]
 
-        ants_image_write(dkt31_wm_img, wm_dktlobe_image_file)
+    return scalar_images
 
-        wm_dktlobes_masked_bids = bids_helpers.image_to_bids(wm_dktlobe_image_file, input_dataset,
-                                                   mtr_bids.get_derivative_rel_path_prefix() + \
-                                                    '_space-ihmt_seg-dkt31wmlobes_dseg.nii.gz',
-                                                   metadata={'Sources': [dkt31_bids.get_uri(relative=False)]})
 
-        antsnetct.parcellation_pipeline.make_label_stats(dkt31_bids, dkt31_label_def, work_dir, compute_label_geometry=True,
-                                                         scalar_images=[mtr_bids], scalar_descriptions=['ihMTR'])
+def get_label_stats_outputs(label_bids):
+    """
+    Get the label stats files written by make_label_stats for a label image.
 
-        antsnetct.parcellation_pipeline.make_label_stats(hoa_bids, hoa_label_def, work_dir, compute_label_geometry=True,
-                                                         scalar_images=[mtr_bids], scalar_descriptions=['ihMTR'])
+    Args:
+        label_bids (BIDSImage): label image the stats were computed on.
 
-        antsnetct.parcellation_pipeline.make_label_stats(wm_dktlobes_masked_bids, dktlobes_label_def, work_dir, compute_label_geometry=True,
-                                                         scalar_images=[mtr_bids], scalar_descriptions=['ihMTR'])
+    Returns:
+        list: paths to the label stats TSV files.
+    """
+    return sorted(glob.glob(label_bids.get_derivative_path_prefix() + '_*.tsv'))
 
 
 if __name__ == '__main__':
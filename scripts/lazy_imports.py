@@ -0,0 +1,61 @@
+"""
+Deferred imports of the heavy libraries.
+
+Importing antsnetct, ANTsPy, pandas, scipy and nibabel takes several seconds on a shared filesystem. The stage scripts
+and their helpers refer to these libraries through the proxies here, which import them on first use, so that --help,
+argument errors, dry runs and sessions that are already done return without loading them.
+
+    ants_helpers = lazy_imports.lazy_module('antsnetct.ants_helpers')
+    ants_image_read = lazy_imports.lazy_function('ants', 'image_read')
+
+This module only uses the standard library.
+"""
+
+import importlib
+import types
+
+
+class _LazyModule(types.ModuleType):
+    """
+    A module proxy that imports the module when one of its attributes is first used.
+    """
+    def __getattr__(self, name):
+        # Only called for attributes not set on the proxy. The proxy is not in sys.modules, so this gets the real module
+        return getattr(importlib.import_module(self.__name__), name)
+
+    def __repr__(self):
+        return f"<lazy module '{self.__name__}'>"
+
+
+def lazy_module(module_name):
+    """
+    Get a proxy for a module, which imports it on first attribute access.
+
+    Args:
+        module_name (str): module name, eg 'antsnetct.ants_helpers'.
+
+    Returns:
+        module: the proxy.
+    """
+    return _LazyModule(module_name)
+
+
+def lazy_function(module_name, function_name):
+    """
+    Get a proxy for a function in a module, which imports the module on first call.
+
+    Args:
+        module_name (str): module name, eg 'ants'.
+        function_name (str): function name, eg 'image_read'.
+
+    Returns:
+        callable: the proxy.
+    """
+    def function(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), function_name)(*args, **kwargs)
+
+    function.__name__ = function_name
+    function.__qualname__ = function_name
+    function.__module__ = module_name
+
+    return function
@@ -0,0 +1,282 @@
+"""
+Within-subject T1w templates for longitudinal registration.
+
+In longitudinal mode, each participant's session T1w images are rigidly aligned to a single-subject template (SST), which
+is built once per participant and shared by all of their sessions. Each session's ihMTR is then registered to the SST,
+starting from the inverse of the session's T1w -> SST transform. The T1w and ihMTR of a session share scanner
+coordinates, so this start is already close, and only the fine levels of the registration are run. Labels are
+transferred with the composed T1w -> SST -> ihMTR transform, in a single resampling.
+
+The SST is built from the sessions available when it is first needed. Sessions added later are registered to the
+existing template, so the outputs of earlier sessions stay valid. Sessions of a participant may run as concurrent jobs,
+so the SST is built and extended under a per-participant lock.
+
+The template can also be an existing one, eg from antsnetct longitudinal processing, given with its brain mask.
+
+Each T1w -> SST transform has a JSON sidecar with the paths and fingerprints of the SST, its mask, and the session T1w
+and mask it was computed from. A transform is only reused if its sidecar matches the current inputs, so switching
+between a built and an existing SST, or gathering a new T1w, recomputes it.
+"""
+
+import contextlib
+import fcntl
+import json
+import logging
+import os
+
+import numpy as np
+
+import lazy_imports
+import manifest_helpers
+import registration_helpers
+
+ants_helpers = lazy_imports.lazy_module('antsnetct.ants_helpers')
+system_helpers = lazy_imports.lazy_module('antsnetct.system_helpers')
+ants_image_read = lazy_imports.lazy_function('ants', 'image_read')
+ants_image_write = lazy_imports.lazy_function('ants', 'image_write')
+
+logger = logging.getLogger(__name__)
+
+
+def get_sst_path(dataset, participant):
+    """
+    Get the path of the SST in a dataset.
+
+    Args:
+        dataset (str): BIDS dataset.
+        participant (str): participant ID.
+
+    Returns:
+        tuple: (image, mask), paths to the SST and its brain mask.
+    """
+    prefix = os.path.join(dataset, f"sub-{participant}", 'anat', f"sub-{participant}_desc-sst")
+    return prefix + '_T1w.nii.gz', prefix + '_mask.nii.gz'
+
+
+def get_sst_transform_path(dataset, participant, session):
+    """
+    Get the path of a session's T1w -> SST transform.
+
+    The transforms are stored at the participant level, with the SST, so that building the SST does not create
+    directories for sessions that have not run yet.
+
+    Args:
+        dataset (str): BIDS dataset.
+        participant (str): participant ID.
+        session (str): session ID.
+
+    Returns:
+        str: path to the transform.
+    """
+    return os.path.join(dataset, f"sub-{participant}", 'anat',
+                        f"sub-{participant}_ses-{session}_from-T1w_to-sst_mode-image_xfm.mat")
+
+
+def get_sst_transform_sidecar_path(transform_file):
+    """
+    Get the path of the sidecar recording the inputs of a T1w -> SST transform.
+
+    Args:
+        transform_file (str): path to the transform.
+
+    Returns:
+        str: path to the sidecar.
+    """
+    return os.path.splitext(transform_file)[0] + '.json'
+
+
+def _sst_transform_inputs(sst_image, sst_mask, t1w, t1w_mask):
+    return {'SST': sst_image, 'SST_mask': sst_mask, 'T1w': t1w, 'T1w_mask': t1w_mask}
+
+
+def write_sst_transform_sidecar(transform_file, sst_image, sst_mask, t1w, t1w_mask):
+    """
+    Record the inputs of a T1w -> SST transform, in the format of the manifest inputs.
+
+    Args:
+        transform_file (str): path to the transform.
+        sst_image (str): SST the transform maps to.
+        sst_mask (str): brain mask of the SST.
+        t1w (str): session T1w the transform maps from.
+        t1w_mask (str): brain mask of the session T1w.
+    """
+    records = dict()
+    for name, path in _sst_transform_inputs(sst_image, sst_mask, t1w, t1w_mask).items():
+        records[name] = {'path': os.path.abspath(path)}
+        records[name].update(manifest_helpers.fingerprint_file(os.path.realpath(path), checksum=True))
+
+    with open(get_sst_transform_sidecar_path(transform_file), 'w') as f:
+        json.dump({'Inputs': records}, f, indent=2, sort_keys=True)
+
+
+def sst_transform_mismatches(transform_file, sst_image, sst_mask, t1w, t1w_mask):
+    """
+    Check if a T1w -> SST transform was computed from the current inputs.
+
+    Args:
+        transform_file (str): path to the transform.
+        sst_image (str): SST in use.
+        sst_mask (str): brain mask of the SST.
+        t1w (str): current session T1w.
+        t1w_mask (str): current brain mask of the session T1w.
+
+    Returns:
+        list: reasons the transform can not be reused, empty if it can.
+    """
+    if not os.path.exists(transform_file):
+        return ['no transform']
+
+    try:
+        with open(get_sst_transform_sidecar_path(transform_file), 'r') as f:
+            recorded_inputs = json.load(f)['Inputs']
+    except (OSError, ValueError, KeyError):
+        return ['no record of the transform inputs']
+
+    reasons = list()
+    for name, path in _sst_transform_inputs(sst_image, sst_mask, t1w, t1w_mask).items():
+        recorded = recorded_inputs.get(name)
+        if recorded is None:
+            reasons.append(f"{name} not recorded")
+        elif recorded.get('path') != os.path.abspath(path):
+            reasons.append(f"{name} was {recorded.get('path')}, now {os.path.abspath(path)}")
+        elif not manifest_helpers.file_unchanged(os.path.realpath(path), recorded):
+            reasons.append(f"{name} changed ({path})")
+    return reasons
+
+
+@contextlib.contextmanager
+def participant_lock(dataset, participant):
+    """
+    Hold an exclusive lock for a participant's SST, across processes.
+
+    Args:
+        dataset (str): BIDS dataset.
+        participant (str): participant ID.
+    """
+    lock_dir = os.path.join(dataset, 'code', 'locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, f"sub-{participant}_sst.lock"), 'w') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def build_sst(dataset, participant, session_inputs, work_dir):
+    """
+    Build an SST by rigidly aligning session T1w images to one of them and averaging.
+
+    The reference is the first session in sorted order. Each image is scaled by its mean within the brain mask before
+    averaging, so that differences in overall intensity between sessions do not bias the template. The SST mask is
+    the majority vote of the aligned session masks.
+
+    Args:
+        dataset (str): BIDS dataset to write the SST to.
+        participant (str): participant ID.
+        session_inputs (dict): session -> (T1w, T1w brain mask) paths.
+        work_dir (str): working directory.
+
+    Returns:
+        tuple: (image, mask), paths to the SST and its brain mask.
+    """
+    if len(session_inputs) == 0:
+        raise ValueError(f"No sessions to build an SST for participant {participant}")
+
+    sessions = sorted(session_inputs)
+    reference_session = sessions[0]
+    reference_t1w, reference_mask = session_inputs[reference_session]
+
+    logger.info(f"Building SST for participant {participant} from sessions {sessions}, reference {reference_session}")
+
+    sst_image_file, sst_mask_file = get_sst_path(dataset, participant)
+
+    registration_helpers.write_identity_transform(get_sst_transform_path(dataset, participant, reference_session))
+
+    aligned_t1w = {reference_session: reference_t1w}
+    aligned_masks = {reference_session: reference_mask}
+
+    for session in sessions[1:]:
+        t1w, mask = session_inputs[session]
+        output_prefix = os.path.join(work_dir, f"sub-{participant}_ses-{session}_t1w_to_sst_")
+        transform, warped = registration_helpers.rigid_registration(reference_t1w, t1w, reference_mask, mask,
+                                                                    output_prefix)
+        system_helpers.copy_file(transform, get_sst_transform_path(dataset, participant, session))
+        aligned_t1w[session] = warped
+        aligned_masks[session] = ants_helpers.apply_transforms(reference_t1w, mask, [transform], work_dir,
+                                                              interpolation='GenericLabel')
+
+    reference_image = ants_image_read(reference_t1w)
+    sst_sum = np.zeros(reference_image.shape)
+    mask_votes = np.zeros(reference_image.shape)
+
+    for session in sessions:
+        t1w_array = ants_image_read(aligned_t1w[session]).numpy()
+        mask_array = ants_image_read(aligned_masks[session]).numpy() > 0
+        sst_sum += t1w_array / t1w_array[mask_array].mean()
+        mask_votes += mask_array
+        del t1w_array, mask_array
+
+    os.makedirs(os.path.dirname(sst_image_file), exist_ok=True)
+
+    ants_image_write(reference_image.new_image_like((sst_sum / len(sessions)).astype(np.float32)), sst_image_file)
+    ants_image_write(reference_image.new_image_like((2 * mask_votes > len(sessions)).astype(np.uint8)), sst_mask_file)
+
+    with open(sst_image_file[:-len('.nii.gz')] + '.json', 'w') as f:
+        json.dump({'Sources': [os.path.abspath(session_inputs[session][0]) for session in sessions],
+                   'ReferenceSession': reference_session}, f, indent=4, sort_keys=True)
+
+    # The transforms can only be fingerprinted against the SST once it is written
+    for session in sessions:
+        write_sst_transform_sidecar(get_sst_transform_path(dataset, participant, session), sst_image_file,
+                                    sst_mask_file, *session_inputs[session])
+
+    return sst_image_file, sst_mask_file
+
+
+def get_session_sst_transform(dataset, participant, session, session_inputs, work_dir, sst_image=None, sst_mask=None):
+    """
+    Get the SST and a session's T1w -> SST transform, building the SST or registering the session to it if needed.
+
+    An existing transform is reused only if it was computed from the same SST and session T1w and mask, see
+    sst_transform_mismatches.
+
+    Args:
+        dataset (str): BIDS dataset the SST and transforms are written to.
+        participant (str): participant ID.
+        session (str): session to get the transform for.
+        session_inputs (dict): session -> (T1w, T1w brain mask) paths, for every session of the participant that can
+            be used to build the SST. Must include `session`.
+        work_dir (str): working directory.
+        sst_image (str, optional): existing SST to use instead of building one.
+        sst_mask (str, optional): brain mask of the existing SST. Required if sst_image is provided.
+
+    Returns:
+        tuple: (SST image, SST mask, T1w -> SST transform) paths.
+    """
+    if sst_image is not None and sst_mask is None:
+        raise ValueError('An existing SST requires its brain mask')
+
+    transform_file = get_sst_transform_path(dataset, participant, session)
+
+    with participant_lock(dataset, participant):
+        if sst_image is None:
+            sst_image, sst_mask = get_sst_path(dataset, participant)
+            if not (os.path.exists(sst_image) and os.path.exists(sst_mask)):
+                build_sst(dataset, participant, session_inputs, work_dir)
+
+        t1w, mask = session_inputs[session]
+        mismatches = sst_transform_mismatches(transform_file, sst_image, sst_mask, t1w, mask)
+
+        if len(mismatches) > 0:
+            if os.path.exists(transform_file):
+                logger.info(f"Recomputing the T1w -> SST transform of participant {participant}, session {session}: "
+                            f"{'; '.join(mismatches)}")
+            logger.info(f"Registering participant {participant}, session {session} to the SST")
+            output_prefix = os.path.join(work_dir, f"sub-{participant}_ses-{session}_t1w_to_sst_")
+            transform, _ = registration_helpers.rigid_registration(sst_image, t1w, sst_mask, mask, output_prefix,
+                                                                   warped_image=False)
+            system_helpers.copy_file(transform, transform_file)
+            write_sst_transform_sidecar(transform_file, sst_image, sst_mask, t1w, mask)
+
+    return sst_image, sst_mask, transform_file
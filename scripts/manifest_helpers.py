@@ -0,0 +1,333 @@
+"""
+Completion manifests for the pipeline stages.
+
+Each stage writes one manifest per session when it finishes, under
+
+    <dataset>/code/manifests/<stage>/sub-<participant>_ses-<session>_manifest.json
+
+The manifest records the outputs the stage produced (path, size, mtime, sha256), fingerprints of the inputs it read
+(path, size, mtime, sha256) and the parameters it was run with. Skip decisions and the cohort status report are made
+from the manifest alone, so a crash partway through a session leaves no manifest and the session is rerun, rather than
+being silently blocked by a half-populated directory.
+
+Input fingerprints make recomputation incremental. When an upstream file is regenerated (a new synthstrip mask, a rerun
+of antsnetct, an edited label definition), the stages that read it are reported as stale and rerun, and their new
+outputs in turn make the stages downstream of them stale. Inputs are compared by size and mtime first; only if those
+differ is the checksum recomputed, so a file that was touched or copied without changing is not treated as new.
+
+This module only uses the standard library, so that status checks can run outside the container.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+STATUS_DONE = 'done'
+STATUS_PARTIAL = 'partial'
+STATUS_STALE = 'stale'
+STATUS_MISSING = 'missing'
+
+
+def get_manifest_dir(dataset, stage):
+    """
+    Get the directory containing the manifests for a stage.
+
+    Args:
+        dataset (str): BIDS dataset the stage writes to.
+        stage (str): Stage name, eg 'gather', 'register'.
+
+    Returns:
+        str: manifest directory for the stage.
+    """
+    return os.path.join(dataset, 'code', 'manifests', stage)
+
+
+def get_manifest_path(dataset, stage, participant, session):
+    """
+    Get the path to the manifest for one session of a stage.
+
+    Args:
+        dataset (str): BIDS dataset the stage writes to.
+        stage (str): Stage name.
+        participant (str): Participant ID, without the 'sub-' prefix.
+        session (str): Session ID, without the 'ses-' prefix.
+
+    Returns:
+        str: manifest path.
+    """
+    return os.path.join(get_manifest_dir(dataset, stage), f"sub-{participant}_ses-{session}_manifest.json")
+
+
+def compute_checksum(path, block_size=1 << 20):
+    """
+    Compute the sha256 checksum of a file, reading it in blocks.
+
+    Args:
+        path (str): file to checksum.
+        block_size (int): read size in bytes.
+
+    Returns:
+        str: hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint_file(path, checksum=False):
+    """
+    Fingerprint a file by size and modification time, and optionally its checksum.
+
+    Args:
+        path (str): file to fingerprint.
+        checksum (bool): if True, also compute the sha256 of the file contents.
+
+    Returns:
+        dict: fingerprint with keys 'size', 'mtime_ns', and optionally 'sha256'.
+    """
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if checksum:
+        fingerprint['sha256'] = compute_checksum(path)
+    return fingerprint
+
+
+def file_unchanged(path, recorded):
+    """
+    Check if a file matches a recorded fingerprint.
+
+    If size and mtime match, the file is unchanged. If they do not, and the recorded fingerprint has a checksum, the
+    checksum of the file is computed and compared, so that a file rewritten with identical contents is unchanged.
+
+    Args:
+        path (str): file to check.
+        recorded (dict): fingerprint stored in a manifest.
+
+    Returns:
+        bool: True if the file is unchanged.
+    """
+    current = fingerprint_file(path)
+    if recorded.get('size') == current['size'] and recorded.get('mtime_ns') == current['mtime_ns']:
+        return True
+    if 'sha256' in recorded and recorded.get('size') == current['size']:
+        return compute_checksum(path) == recorded['sha256']
+    return False
+
+
+def normalize_parameters(parameters):
+    """
+    Normalize a parameter dictionary to its JSON representation, so that recorded and current parameters compare equal.
+
+    Args:
+        parameters (dict): parameters, containing only JSON-serializable values.
+
+    Returns:
+        dict: normalized parameters.
+    """
+    if parameters is None:
+        return dict()
+    return json.loads(json.dumps(parameters, sort_keys=True))
+
+
+def write_manifest(dataset, stage, participant, session, outputs, inputs=None, parameters=None, checksums=None,
+                   resources=None):
+    """
+    Atomically write the completion manifest for a session.
+
+    Call this only after every output of the stage has been written. The manifest is written to a temporary file in the
+    manifest directory and renamed into place, so readers never see a partial manifest.
+
+    Args:
+        dataset (str): BIDS dataset the stage writes to.
+        stage (str): Stage name.
+        participant (str): Participant ID.
+        session (str): Session ID.
+        outputs (list): paths of the output files. Paths inside the dataset are stored relative to it.
+        inputs (dict, optional): input name -> path of the input files, stored as absolute paths. Include every file the
+            stage reads, so that a change to any of them marks the session stale.
+        parameters (dict, optional): parameters the outputs depend on. A change to any of them marks the session stale.
+        checksums (dict, optional): path -> sha256 of any files whose checksum is already known, eg from a verified
+            copy, so they are not read again.
+        resources (dict, optional): resource usage of the stage, eg peak memory. Recorded for information only.
+
+    Returns:
+        str: path to the manifest.
+    """
+    dataset_root = os.path.realpath(dataset)
+
+    known_checksums = dict()
+    if checksums is not None:
+        known_checksums = {os.path.realpath(path): checksum for path, checksum in checksums.items()}
+
+    def fingerprint(path):
+        real_path = os.path.realpath(path)
+        if real_path in known_checksums:
+            fingerprint = fingerprint_file(real_path)
+            fingerprint['sha256'] = known_checksums[real_path]
+            return fingerprint
+        return fingerprint_file(real_path, checksum=True)
+
+    output_records = dict()
+    for output in outputs:
+        output_path = os.path.realpath(output)
+        if os.path.commonpath([dataset_root, output_path]) == dataset_root:
+            key = os.path.relpath(output_path, dataset_root)
+        else:
+            key = output_path
+        output_records[key] = fingerprint(output_path)
+
+    input_records = dict()
+    if inputs is not None:
+        for name, input_path in inputs.items():
+            input_records[name] = {'path': os.path.abspath(input_path)}
+            input_records[name].update(fingerprint(input_path))
+
+    manifest = {
+        'ManifestVersion': MANIFEST_VERSION,
+        'Stage': stage,
+        'Participant': participant,
+        'Session': session,
+        'Completed': datetime.datetime.now().isoformat(timespec='seconds'),
+        'Outputs': output_records,
+        'Inputs': input_records,
+        'Parameters': normalize_parameters(parameters),
+        'Resources': resources if resources is not None else dict()
+    }
+
+    manifest_dir = get_manifest_dir(dataset, stage)
+    os.makedirs(manifest_dir, exist_ok=True)
+    manifest_path = get_manifest_path(dataset, stage, participant, session)
+
+    with tempfile.NamedTemporaryFile('w', dir=manifest_dir, prefix='.tmp_', suffix='.json', delete=False) as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+        tmp_path = f.name
+
+    os.replace(tmp_path, manifest_path)
+
+    logger.info(f"Wrote {stage} manifest: {manifest_path}")
+
+    return manifest_path
+
+
+def read_manifest(dataset, stage, participant, session):
+    """
+    Read the manifest for a session.
+
+    Args:
+        dataset (str): BIDS dataset the stage writes to.
+        stage (str): Stage name.
+        participant (str): Participant ID.
+        session (str): Session ID.
+
+    Returns:
+        dict: the manifest, or None if it does not exist or cannot be parsed.
+    """
+    manifest_path = get_manifest_path(dataset, stage, participant, session)
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read manifest {manifest_path}: {e}")
+        return None
+
+
+def remove_manifest(dataset, stage, participant, session):
+    """
+    Remove the manifest for a session, marking it as not complete. Call this before overwriting outputs.
+
+    Args:
+        dataset (str): BIDS dataset the stage writes to.
+        stage (str): Stage name.
+        participant (str): Participant ID.
+        session (str): Session ID.
+    """
+    try:
+        os.remove(get_manifest_path(dataset, stage, participant, session))
+    except FileNotFoundError:
+        pass
+
+
+def check_session(dataset, stage, participant, session, verify_checksums=False, session_dir_marks_partial=True,
+                  parameters=None):
+    """
+    Check the completion status of one session of a stage.
+
+    Status is one of
+
+        'done'    : manifest present, all outputs present and unchanged, all inputs unchanged.
+        'partial' : outputs missing or modified, or outputs exist for the session without a manifest.
+        'stale'   : outputs complete, but one or more inputs have changed or gone since the stage ran, or the stage
+                    parameters have changed.
+        'missing' : no manifest and no outputs.
+
+    Args:
+        dataset (str): BIDS dataset the stage writes to.
+        stage (str): Stage name.
+        participant (str): Participant ID.
+        session (str): Session ID.
+        verify_checksums (bool): if True, recompute output checksums rather than comparing size and mtime.
+        session_dir_marks_partial (bool): if True, a session directory in the dataset without a manifest is reported as
+            'partial'. Set to False for stages that write into a dataset where the session directory already exists.
+        parameters (dict, optional): the parameters the stage would run with now. If provided, they are compared to the
+            recorded parameters.
+
+    Returns:
+        tuple: (status, reasons), where reasons is a list of strings explaining a status other than 'done'.
+    """
+    manifest = read_manifest(dataset, stage, participant, session)
+
+    if manifest is None:
+        session_dir = os.path.join(dataset, f"sub-{participant}", f"ses-{session}")
+        if session_dir_marks_partial and os.path.isdir(session_dir):
+            return STATUS_PARTIAL, [f"{session_dir} exists but there is no {stage} manifest"]
+        return STATUS_MISSING, [f"no {stage} manifest"]
+
+    reasons = list()
+
+    for rel_path, recorded in manifest.get('Outputs', dict()).items():
+        output_path = os.path.join(dataset, rel_path)
+        if not os.path.exists(output_path):
+            reasons.append(f"output missing: {rel_path}")
+            continue
+        current = fingerprint_file(output_path, checksum=verify_checksums)
+        if verify_checksums:
+            if current['sha256'] != recorded.get('sha256'):
+                reasons.append(f"output checksum mismatch: {rel_path}")
+        elif current['size'] != recorded.get('size'):
+            reasons.append(f"output size changed: {rel_path}")
+
+    if len(reasons) > 0:
+        return STATUS_PARTIAL, reasons
+
+    for name, recorded in manifest.get('Inputs', dict()).items():
+        input_path = recorded['path']
+        if not os.path.exists(input_path):
+            reasons.append(f"input missing: {name} ({input_path})")
+        elif not file_unchanged(input_path, recorded):
+            reasons.append(f"input changed: {name} ({input_path})")
+
+    if parameters is not None:
+        recorded_parameters = manifest.get('Parameters', dict())
+        current_parameters = normalize_parameters(parameters)
+        for name in sorted(set(recorded_parameters) | set(current_parameters)):
+            if recorded_parameters.get(name) != current_parameters.get(name):
+                reasons.append(f"parameter changed: {name} ({recorded_parameters.get(name)} -> "
+                               f"{current_parameters.get(name)})")
+
+    if len(reasons) > 0:
+        return STATUS_STALE, reasons
+
+    return STATUS_DONE, reasons
@@ -0,0 +1,157 @@
+"""
+Validity checks for brain masks, reading the NIfTI files directly.
+
+A mask that exists is not necessarily usable: a job killed while writing leaves a truncated file, a failed brain
+extraction can leave an empty or whole-image mask, and a mask made before its image was regenerated no longer matches
+it. check_mask reads the mask itself and checks that it is complete, on the grid of its image, newer than the image, and
+of a plausible brain volume.
+
+This module only uses the standard library, so masks can be checked outside the container. Only NIfTI-1 files, which
+is what synthstrip writes, are supported.
+"""
+
+import array
+import gzip
+import math
+import os
+import struct
+
+NIFTI1_HEADER_SIZE = 348
+
+# NIfTI datatype code -> array typecode
+_NIFTI_TYPECODES = {2: 'B', 4: 'h', 8: 'i', 16: 'f', 64: 'd', 256: 'b', 512: 'H', 768: 'I'}
+
+
+def _open_image(image_file):
+    return gzip.open(image_file, 'rb') if image_file.endswith('.gz') else open(image_file, 'rb')
+
+
+def _read_header(f, image_file):
+    header = f.read(NIFTI1_HEADER_SIZE)
+    if len(header) < NIFTI1_HEADER_SIZE:
+        raise ValueError(f"Truncated NIfTI header in {image_file}")
+
+    for endian in ('<', '>'):
+        if struct.unpack(endian + 'i', header[:4])[0] == NIFTI1_HEADER_SIZE:
+            break
+    else:
+        raise ValueError(f"Not a NIfTI-1 image: {image_file}")
+
+    dims = struct.unpack(endian + '8h', header[40:56])
+    pixdim = struct.unpack(endian + '8f', header[76:108])
+
+    return {
+        'endian': endian,
+        'shape': tuple(dims[1:1 + dims[0]]),
+        'datatype': struct.unpack(endian + 'h', header[70:72])[0],
+        'spacing': tuple(abs(p) for p in pixdim[1:4]),
+        'vox_offset': int(struct.unpack(endian + 'f', header[108:112])[0]),
+        'sform_code': struct.unpack(endian + 'h', header[254:256])[0],
+        'srow': struct.unpack(endian + '12f', header[280:328])
+    }
+
+
+def read_nifti_header(image_file):
+    """
+    Read the fields of a NIfTI-1 header needed to compare grids.
+
+    Args:
+        image_file (str): .nii or .nii.gz file.
+
+    Returns:
+        dict: 'shape', 'datatype', 'spacing', 'vox_offset', 'sform_code', 'srow' (the 12 sform values) and 'endian'.
+    """
+    with _open_image(image_file) as f:
+        return _read_header(f, image_file)
+
+
+def count_nonzero_voxels(image_file):
+    """
+    Count the non-zero voxels in a NIfTI-1 image, reading all of its data.
+
+    Args:
+        image_file (str): .nii or .nii.gz file.
+
+    Returns:
+        tuple: (header, count), the header from read_nifti_header and the number of non-zero voxels.
+
+    Raises:
+        ValueError: if the file is truncated or has an unsupported datatype.
+    """
+    with _open_image(image_file) as f:
+        header = _read_header(f, image_file)
+
+        typecode = _NIFTI_TYPECODES.get(header['datatype'])
+        if typecode is None:
+            raise ValueError(f"Unsupported NIfTI datatype {header['datatype']} in {image_file}")
+
+        f.read(max(header['vox_offset'] - NIFTI1_HEADER_SIZE, 0))
+
+        num_voxels = math.prod(header['shape'])
+        data = array.array(typecode)
+        expected_bytes = num_voxels * data.itemsize
+
+        try:
+            raw = f.read(expected_bytes)
+        except (EOFError, OSError) as e:
+            raise ValueError(f"Truncated image data in {image_file}: {e}")
+
+    if len(raw) < expected_bytes:
+        raise ValueError(f"Truncated image data in {image_file}: {len(raw)} of {expected_bytes} bytes")
+
+    if data.itemsize == 1:
+        return header, num_voxels - raw.count(0)
+
+    data.frombytes(raw)
+    del raw
+    # Zero is the same in either byte order, so no byteswap is needed to count it
+    return header, num_voxels - data.count(0)
+
+
+def check_mask(mask_file, image_file, min_volume_ml=None, max_volume_ml=None):
+    """
+    Check that a brain mask is complete, matches its image, and has a plausible volume.
+
+    Args:
+        mask_file (str): mask image.
+        image_file (str): image the mask was made from.
+        min_volume_ml (float, optional): smallest plausible mask volume in ml.
+        max_volume_ml (float, optional): largest plausible mask volume in ml.
+
+    Returns:
+        list: descriptions of the problems found. The mask is valid if the list is empty.
+    """
+    if not os.path.exists(mask_file):
+        return ['mask does not exist']
+
+    problems = list()
+
+    if os.path.getmtime(mask_file) < os.path.getmtime(image_file):
+        problems.append('mask is older than the image')
+
+    try:
+        mask_header, num_nonzero = count_nonzero_voxels(mask_file)
+        image_header = read_nifti_header(image_file)
+    except (ValueError, OSError, EOFError) as e:
+        return problems + [str(e)]
+
+    if mask_header['shape'][:3] != image_header['shape'][:3]:
+        problems.append(f"mask shape {mask_header['shape'][:3]} does not match image shape {image_header['shape'][:3]}")
+    elif any(abs(a - b) > 1e-3 for a, b in zip(mask_header['spacing'], image_header['spacing'])):
+        problems.append(f"mask spacing {mask_header['spacing']} does not match image spacing {image_header['spacing']}")
+    elif mask_header['sform_code'] > 0 and image_header['sform_code'] > 0 and \
+            any(abs(a - b) > 1e-2 for a, b in zip(mask_header['srow'], image_header['srow'])):
+        problems.append('mask orientation does not match the image')
+
+    volume_ml = num_nonzero * math.prod(mask_header['spacing']) / 1000.0
+
+    if num_nonzero == 0:
+        problems.append('mask is empty')
+    elif num_nonzero == math.prod(mask_header['shape']):
+        problems.append('mask covers the whole image')
+    elif min_volume_ml is not None and volume_ml < min_volume_ml:
+        problems.append(f"mask volume {volume_ml:.0f} ml is below {min_volume_ml} ml")
+    elif max_volume_ml is not None and volume_ml > max_volume_ml:
+        problems.append(f"mask volume {volume_ml:.0f} ml is above {max_volume_ml} ml")
+
+    return problems
@@ -0,0 +1,93 @@
+"""
+Memory footprint of label and mask data, and peak memory reporting.
+
+Label images are read as float by default, and numpy operations on them often promote to float64, so a label volume
+can take four or eight times the memory it needs. Labels here are held in the narrowest unsigned integer type that fits
+them, and masks as uint8 or bool.
+
+Peak resident set size is reported for the process and for its child processes (ANTs command-line tools) separately,
+since they do not overlap, and used to size job memory requests.
+"""
+
+import os
+import resource
+import sys
+
+import numpy as np
+
+LABEL_DTYPES = (np.uint8, np.uint16, np.uint32)
+
+
+def to_label_array(array, min_dtype=np.uint16):
+    """
+    Convert a label array to the narrowest unsigned integer type that holds its labels.
+
+    Args:
+        array (ndarray): label array, of any numeric type, containing non-negative integer values.
+        min_dtype (dtype): narrowest type to return. The default uint16 covers all the atlases used here, so the label
+            dtype does not vary between sessions.
+
+    Returns:
+        ndarray: label array. If it already has a suitable type, it is returned without a copy.
+    """
+    array = np.asarray(array)
+
+    if array.size == 0:
+        return array.astype(min_dtype)
+
+    min_label = array.min()
+    max_label = array.max()
+
+    if min_label < 0:
+        raise ValueError(f"Label array contains negative labels (minimum {min_label})")
+
+    if np.issubdtype(array.dtype, np.floating) and not np.array_equal(array, np.round(array)):
+        raise ValueError("Label array contains non-integer values")
+
+    for dtype in LABEL_DTYPES:
+        if np.dtype(dtype).itemsize < np.dtype(min_dtype).itemsize:
+            continue
+        if max_label <= np.iinfo(dtype).max:
+            return array.astype(dtype, copy=False)
+
+    raise ValueError(f"Maximum label {max_label} does not fit in {LABEL_DTYPES[-1].__name__}")
+
+
+def peak_rss_mb():
+    """
+    Get the peak resident set size of this process and of its largest child process.
+
+    Returns:
+        tuple: (self_mb, children_mb), peak memory in MB.
+    """
+    # ru_maxrss is in KB on Linux, and in bytes on macOS
+    scale = 1.0 / 1024.0 if sys.platform != 'darwin' else 1.0 / (1024.0 * 1024.0)
+    self_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return self_mb, children_mb
+
+
+def current_rss_mb():
+    """
+    Get the current resident set size of this process.
+
+    Returns:
+        float: memory in MB. Where /proc is not available, the peak memory is returned instead.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()[0]
+
+
+def peak_memory_report():
+    """
+    Get the peak memory of this process and its children, for logging and for the completion manifest.
+
+    Returns:
+        dict: PeakRSSMB and PeakChildRSSMB, peak memory in MB, rounded to 0.1 MB.
+    """
+    self_mb, children_mb = peak_rss_mb()
+    return {'PeakRSSMB': round(self_mb, 1), 'PeakChildRSSMB': round(children_mb, 1)}
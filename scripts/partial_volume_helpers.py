@@ -0,0 +1,393 @@
+"""
+Partial-volume label transfer, from the T1w resolution to the ihMTR grid, as a sparse linear operator.
+
+Atlases are resampled to the 2.5 mm ihMTR grid with GenericLabel interpolation, which gives each ihMTR voxel a single
+label, drops small labels, and makes label volumes depend on the grid. Here, each ihMTR voxel instead gets the fraction
+of its volume covered by each label of the 1 mm atlases. Each T1w voxel is split into supersample^3 points, and each
+point is mapped through the rigid T1w -> ihMT transform and adds its share of the T1w voxel volume to the ihMTR voxel it
+lands in. The fractions are stored as a sparse matrix with one row per (atlas, label) and one column per ihMTR voxel that
+any label reaches, so all atlases share one operator.
+
+Because every point carries an exact share of the T1w voxel volume, the sum of a row, times the ihMTR voxel volume, is
+the volume of the label in the T1w space, less any part outside the ihMTR field of view. The T1w volume of each label is
+stored with the operator, so this coverage can be reported.
+
+Weighted label means of a scalar image on the ihMTR grid are then one sparse product,
+
+    mean = (W @ scalar) / (W @ valid)
+
+and the sums, sums of squares and weights of all scalars for all atlases are computed in a single product with a dense
+matrix of one column per scalar and statistic.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+import crop_helpers
+import label_stats_helpers
+import lazy_imports
+import memory_helpers
+
+nib = lazy_imports.lazy_module('nibabel')
+sparse = lazy_imports.lazy_module('scipy.sparse')
+ants_read_transform = lazy_imports.lazy_function('ants', 'read_transform')
+
+logger = logging.getLogger(__name__)
+
+# Suffix of the operator, after the derivative prefix of the ihMTR image
+OPERATOR_SUFFIX = '_space-ihmt_desc-partialvolume_labelweights.npz'
+
+# Increment when the contents of the operator file change
+OPERATOR_VERSION = 1
+
+# Points per T1w voxel along each axis
+DEFAULT_SUPERSAMPLE = 2
+
+# ITK physical space is LPS, nibabel affines are RAS
+_LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def get_operator_file(ihmt_derivative_prefix):
+    """
+    Get the path of the partial-volume operator of an ihMTR image.
+
+    Args:
+        ihmt_derivative_prefix (str): derivative path prefix of the ihMTR image.
+
+    Returns:
+        str: path to the .npz operator.
+    """
+    return ihmt_derivative_prefix + OPERATOR_SUFFIX
+
+
+def transform_to_ras_matrix(transform):
+    """
+    Get the 4x4 matrix of a linear ANTs transform, in RAS physical coordinates.
+
+    The transform is evaluated at four points, so any linear transform type is supported.
+
+    Args:
+        transform (str): linear transform file, eg from-T1w_to-ihmt, which maps points in the fixed (ihMT) space to
+            the moving (T1w) space.
+
+    Returns:
+        ndarray: 4x4 matrix mapping RAS points in the fixed space to the moving space.
+    """
+    ants_transform = ants_read_transform(transform)
+
+    origin = np.asarray(ants_transform.apply_to_point((0.0, 0.0, 0.0)), dtype=np.float64)
+    matrix = np.eye(4)
+    matrix[:3, 3] = origin
+    for axis in range(3):
+        point = np.zeros(3)
+        point[axis] = 1.0
+        matrix[:3, axis] = np.asarray(ants_transform.apply_to_point(tuple(point)), dtype=np.float64) - origin
+
+    return _LPS_TO_RAS @ matrix @ _LPS_TO_RAS
+
+
+def build_partial_volume_operator(reference_image, label_images, transform, masks=None,
+                                  supersample=DEFAULT_SUPERSAMPLE, chunk_slices=16):
+    """
+    Build the sparse partial-volume operator of T1w-space label images on the ihMTR grid.
+
+    Args:
+        reference_image (str): ihMTR image, defining the output grid.
+        label_images (dict): atlas name -> path of label images on the T1w grid.
+        transform (str): T1w -> ihMT transform, as used to resample the atlases with antsApplyTransforms.
+        masks (dict, optional): atlas name -> (mask image, classes). Labels of the atlas are only counted in T1w voxels
+            where the mask image, eg the antsnetct segmentation, has one of the classes.
+        supersample (int): points per T1w voxel along each axis.
+        chunk_slices (int): number of T1w slices to map at a time.
+
+    Returns:
+        dict: the operator, with keys 'matrix', a CSR matrix of the fraction of each ihMTR voxel in each label, with
+            one row per (atlas, label) and one column per entry of 'columns', 'columns', the flat (C order) ihMTR voxel
+            index of each column, 'row_atlas' and 'row_label', the atlas and label of each row, 'source_volume_ml', the
+            T1w volume of the label of each row, 'atlases', the atlas names, 'shape' and 'affine', the ihMTR grid,
+            and 'supersample'.
+    """
+    if len(label_images) == 0:
+        raise ValueError("At least one label image is required")
+    if supersample < 1:
+        raise ValueError(f"Supersampling must be at least 1, got {supersample}")
+
+    masks = masks if masks is not None else dict()
+
+    reference = nib.load(reference_image)
+    ref_shape = tuple(int(n) for n in reference.shape[:3])
+    ref_affine = reference.affine
+
+    label_proxies = {name: nib.load(path) for name, path in label_images.items()}
+    source_path = next(iter(label_images.values()))
+    source = label_proxies[next(iter(label_images))]
+
+    for name, proxy in label_proxies.items():
+        if proxy.shape[:3] != source.shape[:3] or not np.allclose(proxy.affine, source.affine, atol=1e-4):
+            raise ValueError(f"Image {label_images[name]} is not on the same voxel grid as {source_path}")
+
+    label_arrays = dict()
+    for name, proxy in label_proxies.items():
+        try:
+            labels = memory_helpers.to_label_array(np.asanyarray(proxy.dataobj))
+        except ValueError as e:
+            raise ValueError(f"Invalid label image {label_images[name]}: {e}")
+        if name in masks:
+            mask_image, classes = masks[name]
+            mask_proxy = nib.load(mask_image)
+            if mask_proxy.shape[:3] != source.shape[:3] or not np.allclose(mask_proxy.affine, source.affine, atol=1e-4):
+                raise ValueError(f"Image {mask_image} is not on the same voxel grid as {source_path}")
+            labels = np.where(np.isin(np.asanyarray(mask_proxy.dataobj), classes), labels, 0).astype(labels.dtype)
+        label_arrays[name] = labels
+
+    # Rows are (atlas, label), in atlas order, with a block of max label + 1 rows per atlas. Empty rows are dropped at
+    # the end
+    row_offsets = dict()
+    num_rows = 0
+    for name, labels in label_arrays.items():
+        row_offsets[name] = num_rows
+        num_rows += int(labels.max()) + 1
+
+    source_voxel_ml = float(abs(np.linalg.det(source.affine[:3, :3]))) / 1000.0
+    reference_voxel_ml = float(abs(np.linalg.det(ref_affine[:3, :3]))) / 1000.0
+
+    source_voxels = np.zeros(num_rows)
+    for name, labels in label_arrays.items():
+        counts = np.bincount(labels.reshape(-1), minlength=int(labels.max()) + 1)
+        source_voxels[row_offsets[name]:row_offsets[name] + len(counts)] = counts
+
+    # T1w voxel index -> ihMTR continuous voxel index. The transform maps ihMT points to T1w points, so it is inverted
+    t1w_from_ihmt = transform_to_ras_matrix(transform)
+    source_to_reference = np.linalg.inv(ref_affine) @ np.linalg.inv(t1w_from_ihmt) @ source.affine
+
+    offsets = (np.arange(supersample) + 0.5) / supersample - 0.5
+    point_weight = source_voxel_ml / reference_voxel_ml / supersample ** 3
+
+    num_columns = int(np.prod(ref_shape))
+    matrix = sparse.csr_matrix((num_rows, num_columns))
+
+    (x_start, y_start, z_start), (x_end, y_end, z_end) = crop_helpers.union_bounding_box(
+        *[crop_helpers.bounding_box(labels) for labels in label_arrays.values()])
+
+    for slab_start in range(z_start, z_end, chunk_slices):
+        slab_end = min(slab_start + chunk_slices, z_end)
+
+        slab_labels = {name: labels[x_start:x_end, y_start:y_end, slab_start:slab_end]
+                       for name, labels in label_arrays.items()}
+        in_any = np.zeros(next(iter(slab_labels.values())).shape, dtype=bool)
+        for labels in slab_labels.values():
+            in_any |= labels > 0
+        if not np.any(in_any):
+            continue
+
+        voxels = np.nonzero(in_any)
+        voxel_index = np.stack([voxels[0] + x_start, voxels[1] + y_start, voxels[2] + slab_start]).astype(np.float64)
+        voxel_labels = {name: labels[voxels] for name, labels in slab_labels.items()}
+
+        rows = list()
+        cols = list()
+
+        for dx in offsets:
+            for dy in offsets:
+                for dz in offsets:
+                    points = voxel_index + np.array([[dx], [dy], [dz]])
+                    target = np.rint(source_to_reference[:3, :3] @ points + source_to_reference[:3, 3:]).astype(np.int64)
+                    inside = np.all((target >= 0) & (target < np.array(ref_shape)[:, None]), axis=0)
+                    flat = np.ravel_multi_index(tuple(target[:, inside]), ref_shape)
+                    for name, labels in voxel_labels.items():
+                        point_labels = labels[inside]
+                        labeled = point_labels > 0
+                        rows.append(row_offsets[name] + point_labels[labeled].astype(np.int64))
+                        cols.append(flat[labeled])
+
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        matrix = matrix + sparse.csr_matrix((np.full(len(rows), point_weight), (rows, cols)),
+                                            shape=(num_rows, num_columns))
+
+    # Keep the labels present in the T1w space, and the ihMTR voxels that any label reaches
+    row_atlas = np.concatenate([np.full(int(labels.max()) + 1, name) for name, labels in label_arrays.items()])
+    row_label = np.concatenate([np.arange(int(labels.max()) + 1) for labels in label_arrays.values()])
+    keep_rows = np.flatnonzero((source_voxels > 0) & (row_label > 0))
+
+    matrix = matrix.tocsc()
+    columns = np.flatnonzero(np.diff(matrix.indptr) > 0)
+    matrix = matrix[:, columns].tocsr()[keep_rows]
+
+    return {'matrix': matrix, 'columns': columns, 'row_atlas': row_atlas[keep_rows], 'row_label': row_label[keep_rows],
+            'source_volume_ml': source_voxels[keep_rows] * source_voxel_ml, 'atlases': list(label_images),
+            'shape': ref_shape, 'affine': ref_affine, 'supersample': supersample}
+
+
+def write_partial_volume_operator(operator, operator_file):
+    """
+    Write a partial-volume operator.
+
+    The operator is written to a temporary file and renamed into place, so readers never see a partial file.
+
+    Args:
+        operator (dict): operator from build_partial_volume_operator.
+        operator_file (str): output .npz file.
+
+    Returns:
+        str: path to the operator.
+    """
+    matrix = operator['matrix'].tocsr()
+
+    metadata = {'version': OPERATOR_VERSION, 'atlases': operator['atlases'], 'shape': list(operator['shape']),
+                'num_rows': int(matrix.shape[0]), 'supersample': int(operator['supersample'])}
+
+    arrays = {'data': matrix.data.astype(np.float32), 'indices': matrix.indices, 'indptr': matrix.indptr,
+              'columns': operator['columns'], 'row_atlas': np.asarray(operator['row_atlas'], dtype=str),
+              'row_label': operator['row_label'], 'source_volume_ml': operator['source_volume_ml'],
+              'affine': operator['affine'], 'metadata': np.asarray(json.dumps(metadata, sort_keys=True))}
+
+    os.makedirs(os.path.dirname(os.path.abspath(operator_file)), exist_ok=True)
+
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(operator_file)), prefix='.tmp_',
+                                    suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_file, operator_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+    return operator_file
+
+
+def read_partial_volume_operator(operator_file):
+    """
+    Read a partial-volume operator.
+
+    Args:
+        operator_file (str): .npz file from write_partial_volume_operator.
+
+    Returns:
+        dict: the operator, as from build_partial_volume_operator.
+    """
+    with np.load(operator_file, allow_pickle=False) as arrays:
+        metadata = json.loads(str(arrays['metadata']))
+        if metadata.get('version') != OPERATOR_VERSION:
+            raise ValueError(f"Partial-volume operator {operator_file} is from another version, rerun the registration")
+        columns = arrays['columns']
+        matrix = sparse.csr_matrix((arrays['data'].astype(np.float64), arrays['indices'], arrays['indptr']),
+                                   shape=(metadata['num_rows'], len(columns)))
+        return {'matrix': matrix, 'columns': columns, 'row_atlas': arrays['row_atlas'],
+                'row_label': arrays['row_label'], 'source_volume_ml': arrays['source_volume_ml'],
+                'atlases': metadata['atlases'], 'shape': tuple(metadata['shape']), 'affine': arrays['affine'],
+                'supersample': metadata['supersample']}
+
+
+def compute_partial_volume_stats(operator, scalar_images):
+    """
+    Compute partial-volume weighted label stats of scalar images, for every atlas of an operator at once.
+
+    Non-finite scalar values are excluded, and the weights of the remaining voxels renormalized.
+
+    Args:
+        operator (dict): operator from build_partial_volume_operator or read_partial_volume_operator.
+        scalar_images (dict): description -> path of scalar images on the ihMTR grid of the operator.
+
+    Returns:
+        dict: atlas name -> accumulators as from label_stats_helpers.compute_label_scalar_stats, where 'voxels' and
+            'count' are the sums of the partial-volume weights, in ihMTR voxels, and with an extra 'source_volume_ml',
+            the T1w volume of each label.
+    """
+    if len(scalar_images) == 0:
+        raise ValueError("At least one scalar image is required")
+
+    columns = operator['columns']
+    num_scalars = len(scalar_images)
+
+    # One column per scalar and statistic: value, value^2 and valid
+    stacked = np.zeros((len(columns), 3 * num_scalars))
+
+    for scalar_index, path in enumerate(scalar_images.values()):
+        proxy = nib.load(path)
+        if tuple(proxy.shape[:3]) != tuple(operator['shape']) or \
+                not np.allclose(proxy.affine, operator['affine'], atol=1e-4):
+            raise ValueError(f"Image {path} is not on the grid of the partial-volume operator")
+        values = np.asarray(proxy.dataobj, dtype=np.float64).reshape(-1)[columns]
+        valid = np.isfinite(values)
+        values[~valid] = 0.0
+        stacked[:, 3 * scalar_index] = values
+        stacked[:, 3 * scalar_index + 1] = values * values
+        stacked[:, 3 * scalar_index + 2] = valid
+
+    products = operator['matrix'] @ stacked
+    weights = np.asarray(operator['matrix'].sum(axis=1)).reshape(-1)
+
+    accumulators = dict()
+
+    for atlas in operator['atlases']:
+        rows = np.flatnonzero(operator['row_atlas'] == atlas)
+        labels = operator['row_label'][rows].astype(np.int64)
+        num_bins = int(labels.max()) + 1 if len(labels) > 0 else 1
+
+        acc = {stat: np.zeros((num_scalars, num_bins)) for stat in ('count', 'sum', 'sum_sq')}
+        acc['voxels'] = np.zeros(num_bins)
+        acc['source_volume_ml'] = np.zeros(num_bins)
+
+        acc['voxels'][labels] = weights[rows]
+        acc['source_volume_ml'][labels] = operator['source_volume_ml'][rows]
+        for scalar_index in range(num_scalars):
+            acc['sum'][scalar_index, labels] = products[rows, 3 * scalar_index]
+            acc['sum_sq'][scalar_index, labels] = products[rows, 3 * scalar_index + 1]
+            acc['count'][scalar_index, labels] = products[rows, 3 * scalar_index + 2]
+
+        accumulators[atlas] = acc
+
+    return accumulators
+
+
+def write_partial_volume_stats(operator_file, label_defs, scalar_images, output_files):
+    """
+    Compute partial-volume weighted label stats for the atlases of an operator, and write one TSV per atlas.
+
+    The tables have the columns of label_stats_helpers.label_stats_table, where volume_ml is the T1w volume of the
+    label within the ihMTR field of view and the voxel counts are fractional, and a coverage column, the fraction of
+    the T1w volume of the label within the field of view.
+
+    Args:
+        operator_file (str): operator from write_partial_volume_operator.
+        label_defs (dict): atlas name -> DataFrame of label definitions, for the atlases to summarize.
+        scalar_images (dict): description -> path of scalar images on the ihMTR grid.
+        output_files (dict): atlas name -> output TSV path, for the atlases to summarize.
+
+    Returns:
+        list: paths to the output files.
+    """
+    operator = read_partial_volume_operator(operator_file)
+
+    missing_atlases = [name for name in output_files if name not in operator['atlases']]
+    if len(missing_atlases) > 0:
+        raise ValueError(f"Atlases {missing_atlases} are not in the partial-volume operator {operator_file}")
+
+    accumulators = compute_partial_volume_stats(operator, scalar_images)
+
+    voxel_volume_ml = float(abs(np.linalg.det(operator['affine'][:3, :3]))) / 1000.0
+    scalar_descriptions = list(scalar_images.keys())
+
+    written = list()
+
+    for name, output_file in output_files.items():
+        acc = accumulators[name]
+        table = label_stats_helpers.label_stats_table(acc, scalar_descriptions, label_defs[name],
+                                                      voxel_volume_ml=voxel_volume_ml, fractional=True)
+        label_index = table['label'].to_numpy()
+        in_range = label_index < len(acc['source_volume_ml'])
+        source_volume_ml = np.where(in_range, acc['source_volume_ml'][np.where(in_range, label_index, 0)], 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            table.insert(3, 'coverage', table['volume_ml'].to_numpy() / source_volume_ml)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        table.to_csv(output_file, sep='\t', index=False, float_format='%.6g', na_rep='NaN')
+        written.append(output_file)
+
+    return written
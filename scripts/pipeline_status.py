@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import json
+import logging
+import os
+import re
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+import manifest_helpers
+import session_lists
+
+logger = logging.getLogger(__name__)
+
+# Stages that write into a dataset where the session directory exists before the stage runs. For these, a session
+# directory without a manifest does not indicate a partial run.
+STAGES_IN_EXISTING_SESSIONS = ('labelstats',)
+
+# Helps with CLI help formatting
+class RawDefaultsHelpFormatter(
+    argparse.RawTextHelpFormatter, argparse.ArgumentDefaultsHelpFormatter
+):
+    pass
+
+def pipeline_status():
+
+    parser = argparse.ArgumentParser(formatter_class=RawDefaultsHelpFormatter, add_help = False,
+                                     description='''Report the completion status of a pipeline stage across a cohort.
+
+    Status is read from the completion manifests written by each stage, under
+
+        <dataset>/code/manifests/<stage>/
+
+    Each session is reported as one of
+
+        done    : all outputs present, inputs unchanged since the stage ran
+        partial : outputs missing or modified, or a session directory exists without a manifest
+        stale   : outputs complete, but inputs have changed since the stage ran, or parameters given with --parameter
+                  differ from the ones the stage ran with
+        missing : not run
+
+    Stages are incremental: after upstream data changes (eg, antsnetct or synthstrip is rerun for some sessions), only
+    sessions whose inputs changed are stale. Use --todo-list to write those sessions, with any partial or missing
+    sessions, to a list that can be passed straight to the stage wrapper in bin/.
+
+    Stage parameters are only checked if they are given with --parameter, using the names recorded under Parameters in
+    the manifests. Parameters that are not given are taken as unchanged. For example, to find the sessions that need
+    rerunning after switching the registration to breadth-first label propagation:
+
+        pipeline_status.py --dataset t1wToihMT --stage register --parameter label_propagation=bfs
+
+    Values are read as JSON where possible, so true, 2.5 and null are not strings.
+
+    Output is a TSV with columns participant, session, status, reasons, followed by a summary on stderr.
+
+    This script only needs the Python standard library, so it can be run outside the container.
+
+    ''')
+    required_parser = parser.add_argument_group('Required arguments')
+    required_parser.add_argument('--dataset', help='BIDS dataset the stage writes to', type=str, required=True)
+    required_parser.add_argument('--stage', help='Stage to report', type=str, required=True,
+                                 choices=['gather', 'register', 'labelstats'])
+
+    optional_parser = parser.add_argument_group('General optional arguments')
+    optional_parser.add_argument('--session-list', help='CSV file with participants and sessions to report, one per line, '
+                                 'no header. If not provided, sessions are found from the manifests and session '
+                                 'directories in the dataset', type=str, default=None)
+    optional_parser.add_argument('--shard', help='Only report shard i of N of the session list, as i/N. See '
+                                 'session_lists.py', type=str, default=None)
+    optional_parser.add_argument('--parameter', help='Stage parameter the stage would now run with, as name=value. May be '
+                                 'repeated. Sessions that ran with a different value are stale', type=str,
+                                 action='append', default=[])
+    optional_parser.add_argument('--verify-checksums', help='Verify output checksums, rather than sizes. This reads every '
+                                 'output file', action='store_true')
+    optional_parser.add_argument('--todo-list', help='Write sessions that are not done to this CSV file, in the session '
+                                 'list format', type=str, default=None)
+    optional_parser.add_argument('--threads', help='Number of sessions to check concurrently', type=int, default=8)
+    optional_parser.add_argument('--output-tsv', help='Write the report to this file instead of stdout', type=str,
+                                 default=None)
+    optional_parser.add_argument('-h', '--help', action='help', help='show this help message and exit')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+        print(f"\nRun {os.path.basename(sys.argv[0])} --help for more information")
+        sys.exit(1)
+
+    args = parser.parse_args()
+
+    if args.session_list is not None:
+        sessions = session_lists.read_session_list(args.session_list, shard=args.shard)
+    else:
+        sessions = find_dataset_sessions(args.dataset, args.stage)
+
+    session_dir_marks_partial = args.stage not in STAGES_IN_EXISTING_SESSIONS
+
+    parameter_overrides = parse_parameters(args.parameter)
+
+    def check(participant_session):
+        participant, session = participant_session
+        parameters = None
+        if len(parameter_overrides) > 0:
+            manifest = manifest_helpers.read_manifest(args.dataset, args.stage, participant, session)
+            recorded_parameters = manifest.get('Parameters', dict()) if manifest is not None else dict()
+            parameters = {**recorded_parameters, **parameter_overrides}
+        return manifest_helpers.check_session(args.dataset, args.stage, participant, session,
+                                              verify_checksums=args.verify_checksums,
+                                              session_dir_marks_partial=session_dir_marks_partial,
+                                              parameters=parameters)
+
+    with ThreadPoolExecutor(max_workers=max(1, args.threads)) as executor:
+        results = list(executor.map(check, sessions))
+
+    counts = {status: 0 for status in (manifest_helpers.STATUS_DONE, manifest_helpers.STATUS_PARTIAL,
+                                       manifest_helpers.STATUS_STALE, manifest_helpers.STATUS_MISSING)}
+
+    out = open(args.output_tsv, 'w') if args.output_tsv is not None else sys.stdout
+
+    try:
+        out.write("participant\tsession\tstatus\treasons\n")
+        for (participant, session), (status, reasons) in zip(sessions, results):
+            counts[status] += 1
+            out.write(f"{participant}\t{session}\t{status}\t{'; '.join(reasons)}\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if args.todo_list is not None:
+        with open(args.todo_list, 'w') as f:
+            for (participant, session), (status, reasons) in zip(sessions, results):
+                if status != manifest_helpers.STATUS_DONE:
+                    f.write(f"{participant},{session}\n")
+
+    summary = ", ".join(f"{status}: {count}" for status, count in counts.items())
+    print(f"{args.stage} status for {len(sessions)} sessions in {args.dataset} - {summary}", file=sys.stderr)
+
+
+def parse_parameters(parameter_args):
+    """
+    Parse stage parameters given on the command line.
+
+    Args:
+        parameter_args (list): strings of the form name=value. Values are parsed as JSON if possible, and are otherwise
+            strings.
+
+    Returns:
+        dict: parameter name -> value.
+    """
+    parameters = dict()
+    for parameter_arg in parameter_args:
+        name, sep, value = parameter_arg.partition('=')
+        if sep == '' or name == '':
+            raise ValueError(f"Invalid parameter {parameter_arg}, expected name=value")
+        try:
+            parameters[name] = json.loads(value)
+        except ValueError:
+            parameters[name] = value
+    return parameters
+
+
+def find_dataset_sessions(dataset, stage):
+    """
+    Find sessions in a dataset from its manifests and session directories.
+
+    Args:
+        dataset (str): BIDS dataset.
+        stage (str): Stage name.
+
+    Returns:
+        list: sorted (participant, session) tuples.
+    """
+    sessions = set()
+
+    manifest_pattern = re.compile(r'^sub-(.+?)_ses-(.+)_manifest\.json$')
+
+    manifest_dir = manifest_helpers.get_manifest_dir(dataset, stage)
+    if os.path.isdir(manifest_dir):
+        for manifest_file in os.listdir(manifest_dir):
+            match = manifest_pattern.match(manifest_file)
+            if match is not None:
+                sessions.add((match.group(1), match.group(2)))
+
+    for session_dir in glob.glob(os.path.join(dataset, 'sub-*', 'ses-*')):
+        if os.path.isdir(session_dir):
+            participant = os.path.basename(os.path.dirname(session_dir))[len('sub-'):]
+            session = os.path.basename(session_dir)[len('ses-'):]
+            sessions.add((participant, session))
+
+    return sorted(sessions)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    pipeline_status()
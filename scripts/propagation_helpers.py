@@ -0,0 +1,133 @@
+"""
+Propagation of labels through a mask, in numpy.
+
+This is a native replacement for iMath_propagate_labels_through_mask, which propagates labels through the mask with
+ITK fast marching. Two methods are provided:
+
+    'bfs' : labels grow outward through the mask one voxel layer at a time, so distance is measured along paths within
+            the mask, as with fast marching. Ties go to the larger label.
+    'edt' : each unlabeled mask voxel takes the label of the nearest labeled voxel, in straight-line physical distance,
+            using one multi-source Euclidean distance transform. The nearest label may be across a sulcus or a gap in
+            the mask, so this differs from fast marching along label boundaries and across thin gyri.
+
+Both only assign labels inside the mask, and only from labels inside or touching the mask. Voxels further than
+`max_distance` mm from any label are left unlabeled; the distance is geodesic, in face-connected steps of the smallest
+voxel size, for 'bfs', and Euclidean for 'edt'.
+
+'bfs' can split each layer step into slabs along the first axis, filtered in parallel threads with a one-voxel halo, so
+the result does not depend on the number of threads. 'edt' runs in a single thread. Both release the GIL, so atlases
+can also be propagated concurrently.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import lazy_imports
+
+ndimage = lazy_imports.lazy_module('scipy.ndimage')
+
+PROPAGATION_METHODS = ('edt', 'bfs')
+
+
+def dilate_mask(mask, radius):
+    """
+    Dilate a binary mask by a ball, matching iMath 'MD'.
+
+    Args:
+        mask (ndarray): mask array, non-zero inside the mask.
+        radius (int): ball radius in voxels.
+
+    Returns:
+        ndarray: dilated mask, as uint8.
+    """
+    # ITK's binary ball includes offsets within radius + 0.5 of the center
+    offsets = np.indices((2 * radius + 1,) * mask.ndim) - radius
+    ball = np.sum(offsets * offsets, axis=0) <= (radius + 0.5) ** 2
+    return ndimage.binary_dilation(np.asarray(mask) > 0, structure=ball).astype(np.uint8)
+
+
+def _maximum_filter(array, structure, executor, num_slabs):
+    if executor is None or array.shape[0] < 2 * num_slabs:
+        return ndimage.maximum_filter(array, footprint=structure, mode='constant', cval=0)
+
+    output = np.empty_like(array)
+    bounds = np.linspace(0, array.shape[0], num_slabs + 1).astype(int)
+
+    def filter_slab(slab):
+        start, end = bounds[slab], bounds[slab + 1]
+        # One voxel of halo on each side, the radius of the structure
+        halo_start, halo_end = max(start - 1, 0), min(end + 1, array.shape[0])
+        filtered = ndimage.maximum_filter(array[halo_start:halo_end], footprint=structure, mode='constant', cval=0)
+        output[start:end] = filtered[start - halo_start:end - halo_start]
+
+    list(executor.map(filter_slab, range(num_slabs)))
+    return output
+
+
+def propagate_labels_through_mask(mask, labels, spacing=(1.0, 1.0, 1.0), method='edt', max_distance=None, threads=1):
+    """
+    Propagate labels through a mask.
+
+    Args:
+        mask (ndarray): mask array, non-zero inside the mask.
+        labels (ndarray): integer label array on the same grid, 0 is unlabeled.
+        spacing (tuple): voxel size in mm.
+        method (str): 'edt' or 'bfs'.
+        max_distance (float, optional): maximum distance in mm that a label is propagated.
+        threads (int): number of threads for 'bfs'.
+
+    Returns:
+        ndarray: labels within the mask, 0 outside it, with the dtype of `labels`.
+    """
+    if method not in PROPAGATION_METHODS:
+        raise ValueError(f"Invalid propagation method: {method}. Options are {PROPAGATION_METHODS}")
+    if mask.shape != labels.shape:
+        raise ValueError(f"Mask shape {mask.shape} does not match label shape {labels.shape}")
+
+    mask = np.asarray(mask) > 0
+    labels = np.asarray(labels)
+
+    # Seeds are labels inside the mask or in contact with it
+    seeds = (labels > 0) & ndimage.binary_dilation(mask)
+
+    output = np.zeros_like(labels)
+
+    if not np.any(seeds) or not np.any(mask):
+        return output
+
+    if method == 'edt':
+        distance, indices = ndimage.distance_transform_edt(~seeds, sampling=spacing, return_distances=True,
+                                                           return_indices=True)
+        nearest_labels = labels[tuple(indices)]
+        assign = mask if max_distance is None else mask & (distance <= max_distance)
+        output[assign] = nearest_labels[assign]
+        return output
+
+    # Breadth-first growth, one face-connected layer per step
+    grown = np.where(seeds, labels, 0)
+    unassigned = mask & ~seeds
+    structure = ndimage.generate_binary_structure(labels.ndim, 1)
+
+    max_steps = None
+    if max_distance is not None:
+        max_steps = int(np.floor(max_distance / min(spacing)))
+
+    executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+
+    try:
+        step = 0
+        while np.any(unassigned) and (max_steps is None or step < max_steps):
+            neighbor_labels = _maximum_filter(grown, structure, executor, threads)
+            newly_assigned = unassigned & (neighbor_labels > 0)
+            if not np.any(newly_assigned):
+                break
+            grown[newly_assigned] = neighbor_labels[newly_assigned]
+            unassigned &= ~newly_assigned
+            step += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    output[mask] = grown[mask]
+    return output
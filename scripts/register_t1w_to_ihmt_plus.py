@@ -1,23 +1,41 @@
 #!/usr/bin/env python
 
-import antsnetct
-
-from antsnetct import ants_helpers,bids_helpers,system_helpers
-from ants import image_read as ants_image_read
-from ants import image_write as ants_image_write
-from ants import pad_image, image_clone, iMath, morphology, iMath_propagate_labels_through_mask
-
 import argparse
 import glob
 import json
 import logging
+import functools
 import os
 import sys
-import tempfile
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+
+import atlas_registry
+import bids_writer
+import crop_helpers
+import lazy_imports
+import longitudinal_helpers
+import manifest_helpers
+import memory_helpers
+import partial_volume_helpers
+import propagation_helpers
+import registration_cache
+import registration_helpers
+import scratch_helpers
+import work_dir_helpers
+
+# antsnetct and ANTsPy are imported on first use, so --help, --dry-run and sessions that are already done are quick
+ants_helpers = lazy_imports.lazy_module('antsnetct.ants_helpers')
+bids_helpers = lazy_imports.lazy_module('antsnetct.bids_helpers')
+system_helpers = lazy_imports.lazy_module('antsnetct.system_helpers')
+ants_image_read = lazy_imports.lazy_function('ants', 'image_read')
+iMath_propagate_labels_through_mask = lazy_imports.lazy_function('ants', 'iMath_propagate_labels_through_mask')
+
 logger = logging.getLogger(__name__)
 
+REGISTRATION_MASK_STRATEGIES = ('synthstrip', 'synthstrip_no_csf', 'no_synthstrip')
+
 # Helps with CLI help formatting
 class RawDefaultsHelpFormatter(
     argparse.RawTextHelpFormatter, argparse.ArgumentDefaultsHelpFormatter
@@ -37,9 +55,22 @@ def t1w_to_ihmt_pipeline():
 
     The T1w image is registered to the ihMTR, using ANTs, with a rigid transform.
 
-    The DKT31 labels are masked by GM in the T1w space, and then resampled into the ihMT space.
-    HOA labels are masked by not CSF and resampled into the ihMT space.
-    antsnetct segmentation is resampled into the ihMT space.
+    With --longitudinal, the T1w images of all of a participant's sessions are rigidly aligned to a single-subject
+    template (SST), which is built once per participant, or taken from --sst-image. Each session's ihMTR is registered to
+    the SST, starting from the session's T1w -> SST transform, and the T1w -> ihMT transform is the composition of the
+    two, so labels are still resampled once.
+
+    With --sweep-mask-strategies or --sweep-metrics, the T1w is registered with each combination of mask strategy and
+    metric, concurrently, and only the outputs of the registration with the highest NMI are written. Candidates are
+    scored on the same voxels, within all of their ihMTR masks, and the scores are written to a TSV with the QC outputs.
+
+    The atlases listed in label_def/atlases.tsv are resampled into the ihMT space. By default these are
+    the DKT31 labels, masked by GM in the T1w space, the HOA labels, masked by not CSF, and the antsnetct segmentation.
+    Derived atlases in the registry, eg the DKT31 labels propagated into the WM, are made in the ihMT space.
+
+    With --partial-volume-labels, the fraction of each ihMT voxel covered by each label of the transferred atlases with
+    a label definition is also computed from the T1w-resolution atlases, and written as a sparse operator,
+    '_space-ihmt_desc-partialvolume_labelweights.npz', for partial-volume weighted label stats.
 
     QC processes also run:
         ihMTR heatmap pngs
@@ -51,14 +82,17 @@ def t1w_to_ihmt_pipeline():
 
     To get suitable inputs, see `gather_t1w_ihmt_inputs.py`.
 
+    With --dry-run, the inputs are checked and the outputs listed without running ANTs. Use --session-list instead of
+    --participant and --session to check a whole cohort in one process.
+
     ''')
     required_parser = parser.add_argument_group('Required arguments')
     required_parser.add_argument('--input-dataset', help='Input BIDS dataset dir, containing the source images and masks',
                                  type=str, required=True)
     required_parser.add_argument('--antsnetct-dataset', help='BIDS dataset dir containing the ANTsNetCT derivatives',
                                  type=str, required=True)
-    required_parser.add_argument('--participant', '--subject', help='Participant to process', type=str, required=True)
-    required_parser.add_argument('--session', help='Session to process.', type=str, default=None, required=True)
+    required_parser.add_argument('--participant', '--subject', help='Participant to process', type=str, default=None)
+    required_parser.add_argument('--session', help='Session to process.', type=str, default=None)
     required_parser.add_argument('--output-dataset', help='Output BIDS dataset dir', type=str, required=True)
 
     optional_parser = parser.add_argument_group('General optional arguments')
@@ -66,9 +100,80 @@ def t1w_to_ihmt_pipeline():
                                  'one of "synthstrip" (default), "synthstrip_no_csf", or "no_synthstrip". If no_synthstrip '
                                  'is selected, the original antsnetct brain mask is used for T1w and the nothing brain mask is '
                                  'used for the ihMTR image.', type=str, default='synthstrip')
+    optional_parser.add_argument('--label-def-dir', help='Directory containing the atlas registry, atlases.tsv, which lists '
+                                 'the atlases to transfer to ihMT space', type=str,
+                                 default=os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                                      'label_def'))
+    optional_parser.add_argument('--atlas-threads', help='Number of atlases to resample concurrently', type=int,
+                                 default=2)
+    optional_parser.add_argument('--scratch-format', help='Format for intermediate images in the working directory, '
+                                 '"nii" (uncompressed, memory-mapped by readers) or "nii.gz". Images are always compressed '
+                                 'in the output dataset', type=str, default='nii', choices=scratch_helpers.SCRATCH_FORMATS)
+    optional_parser.add_argument('--crop-padding', help='Voxels of padding around the brain mask bounding box when cropping '
+                                 'images for N4, registration and WM labeling', type=int, default=8)
+    optional_parser.add_argument('--no-crop', help='Process images at their full field of view', action='store_true')
+    optional_parser.add_argument('--label-propagation', help='Method for propagating cortical labels through the dilated '
+                                 'WM mask. "itk" uses ITK fast marching. "bfs" grows labels through the mask layer by '
+                                 'layer, following paths within the mask like fast marching. "edt" assigns each voxel '
+                                 'the nearest label in straight-line distance, which may cross outside the mask, so it '
+                                 'labels some WM voxels differently', type=str, default='itk',
+                                 choices=('itk',) + propagation_helpers.PROPAGATION_METHODS)
+    optional_parser.add_argument('--propagation-threads', help='Number of threads for each "bfs" propagation. Atlases '
+                                 'are also propagated concurrently, in --atlas-threads', type=int, default=2)
+    optional_parser.add_argument('--label-propagation-max-distance', help='Maximum distance in mm to propagate labels '
+                                 'into the WM. Deeper WM voxels are left unlabeled. Measured along paths within the mask '
+                                 'with "bfs", and in a straight line with "edt". Not used with "itk"', type=float,
+                                 default=None)
+    optional_parser.add_argument('--partial-volume-labels', help='Also write a sparse partial-volume operator of the '
+                                 'transferred atlases with a label definition, for partial-volume weighted label stats',
+                                 action='store_true')
+    optional_parser.add_argument('--registration-cache-dir', help='Directory of cached registrations. If set, a session '
+                                 'whose registration inputs, masks and parameters match a cached registration reuses '
+                                 'its transform, and new registrations are added to the cache', type=str, default=None)
+    optional_parser.add_argument('--work-dir-shm-mb', help='RAM in MB that may be used for intermediate files. If '
+                                 '/dev/shm and the job have this much to spare, the working directory is placed on '
+                                 '/dev/shm, otherwise under TMPDIR. The size of the working directory is logged and '
+                                 'recorded in the manifest', type=float, default=0)
+    optional_parser.add_argument('--keep-work-dir', help='Keep the working directory, for debugging',
+                                 action='store_true')
+    optional_parser.add_argument('--dry-run', help='Check the inputs and list the outputs, without running ANTs',
+                                 action='store_true')
+    optional_parser.add_argument('--session-list', help='With --dry-run, CSV file with participants and sessions to '
+                                 'check, one per line, no header', type=str, default=None)
     optional_parser.add_argument('-h', '--help', action='help', help='show this help message and exit')
     optional_parser.add_argument('--verbose', help='Verbose output from subcommands', action='store_true')
 
+    init_parser = parser.add_argument_group('Registration initialization arguments')
+    init_parser.add_argument('--registration-init', help='Initial transform for the T1w to ihMT registration: "header" '
+                             'aligns the images in physical space, "moments" matches their centers of mass, "cached" '
+                             'starts from the transform of a previous run in the output dataset, if any, and "best" uses '
+                             'whichever of these gives the highest normalized mutual information (NMI). Not used with '
+                             '--longitudinal', type=str, default='header',
+                             choices=registration_helpers.INITIALIZATION_METHODS)
+    init_parser.add_argument('--fine-only-nmi', help='Skip the coarse registration level if the NMI after the initial '
+                             'transform is at least this value. NMI ranges from 1 (unrelated) to 2 (identical). The '
+                             'initial NMI is logged for each session, to help choose a threshold', type=float,
+                             default=None)
+
+    sweep_parser = parser.add_argument_group('Registration sweep arguments')
+    sweep_parser.add_argument('--sweep-mask-strategies', help='Comma-separated registration mask strategies to compare, '
+                              'eg "synthstrip,synthstrip_no_csf,no_synthstrip". Replaces --registration-mask-strategy',
+                              type=str, default=None)
+    sweep_parser.add_argument('--sweep-metrics', help='Comma-separated registration metrics to compare, from '
+                              f"{', '.join(registration_helpers.METRICS)}", type=str, default=None)
+    sweep_parser.add_argument('--sweep-threads', help='Number of candidate registrations to run concurrently', type=int,
+                              default=2)
+
+    longitudinal_parser = parser.add_argument_group('Longitudinal arguments')
+    longitudinal_parser.add_argument('--longitudinal', help='Register the ihMTR to a single-subject T1w template (SST) '
+                                     'shared by all sessions of the participant', action='store_true')
+    longitudinal_parser.add_argument('--sst-image', help='Existing SST to use, eg from antsnetct longitudinal '
+                                     'processing. May contain {participant}. If not provided, an SST is built from the '
+                                     'participant\'s sessions in the input dataset, and written to the output dataset',
+                                     type=str, default=None)
+    longitudinal_parser.add_argument('--sst-mask', help='Brain mask of the existing SST. May contain {participant}',
+                                     type=str, default=None)
+
     if len(sys.argv) == 1:
         parser.print_usage()
         print(f"\nRun {os.path.basename(sys.argv[0])} --help for more information")
@@ -78,9 +183,6 @@ def t1w_to_ihmt_pipeline():
 
     logger.info('Parsed args: ' + str(args))
 
-    system_helpers.set_verbose(args.verbose)
-
-    antsnetct_dataset = args.antsnetct_dataset
     input_dataset = args.input_dataset
     output_dataset = args.output_dataset
     participant = args.participant
@@ -89,10 +191,65 @@ def t1w_to_ihmt_pipeline():
     if (os.path.realpath(input_dataset) == os.path.realpath(output_dataset)):
         raise ValueError('Input and output datasets cannot be the same')
 
-    if os.path.exists(os.path.join(output_dataset, f"sub-{participant}", f"ses-{session}", "anat")):
+    if args.sst_image is not None and (not args.longitudinal or args.sst_mask is None):
+        raise ValueError('--sst-image requires --longitudinal and --sst-mask')
+
+    sweep_candidates = get_sweep_candidates(args)
+
+    if sweep_candidates is not None and (args.longitudinal or args.registration_cache_dir is not None):
+        raise ValueError('A registration sweep cannot be used with --longitudinal or --registration-cache-dir')
+
+    if args.session_list is not None and not args.dry_run:
+        raise ValueError('--session-list requires --dry-run')
+
+    if args.session_list is None:
+        if participant is None:
+            raise ValueError('Participant must be defined')
+        if session is None:
+            raise ValueError('Session must be defined')
+
+    atlases = atlas_registry.read_atlas_registry(args.label_def_dir)
+
+    if 'antsnetct' not in [atlas['atlas'] for atlas in atlas_registry.get_atlases(atlases, source_type='antsnetct')]:
+        raise ValueError('The atlas registry must include the antsnetct segmentation, which defines the tissue masks')
+
+    stage_parameters = {'registration_mask_strategy': args.registration_mask_strategy,
+                        'label_propagation': args.label_propagation,
+                        'label_propagation_max_distance': args.label_propagation_max_distance,
+                        'registration_init': args.registration_init,
+                        'fine_only_nmi': args.fine_only_nmi,
+                        'longitudinal': args.longitudinal,
+                        'sst_image': args.sst_image,
+                        'no_crop': args.no_crop,
+                        'crop_padding': args.crop_padding}
+
+    if sweep_candidates is not None:
+        stage_parameters['sweep_candidates'] = sweep_candidates
+
+    if args.partial_volume_labels:
+        stage_parameters['partial_volume_supersample'] = partial_volume_helpers.DEFAULT_SUPERSAMPLE
+
+    if args.dry_run:
+        if args.session_list is not None:
+            from session_lists import read_session_list
+            sessions = read_session_list(args.session_list)
+        else:
+            sessions = [(participant, session)]
+        num_invalid = dry_run(args, atlases, sessions, stage_parameters)
+        sys.exit(1 if num_invalid > 0 else 0)
+
+    session_status, status_reasons = manifest_helpers.check_session(output_dataset, 'register', participant, session,
+                                                                    parameters=stage_parameters)
+
+    if session_status == manifest_helpers.STATUS_DONE:
         logger.info(f"Outputs already exist for participant {participant}, session {session}")
         return
 
+    if session_status != manifest_helpers.STATUS_MISSING:
+        logger.info(f"Rerunning participant {participant}, session {session} ({session_status}): " +
+                    "; ".join(status_reasons))
+        manifest_helpers.remove_manifest(output_dataset, 'register', participant, session)
+
     input_dataset_description = None
 
     if os.path.exists(os.path.join(input_dataset, 'dataset_description.json')):
@@ -101,11 +258,7 @@ def t1w_to_ihmt_pipeline():
     else:
         raise ValueError('Input dataset does not contain a dataset_description.json file')
 
-
-    if participant is None:
-        raise ValueError('Participant must be defined')
-    if session is None:
-        raise ValueError('Session must be defined')
+    system_helpers.set_verbose(args.verbose)
 
     logger.info('Input dataset path: ' + input_dataset)
     logger.info('Input dataset name: ' + input_dataset_description['Name'])
@@ -121,9 +274,598 @@ def t1w_to_ihmt_pipeline():
     logger.info('Output dataset path: ' + output_dataset)
     logger.info('Output dataset name: ' + output_dataset_description['Name'])
 
-    work_dir_tempfile = tempfile.TemporaryDirectory(suffix=f"antsnetct_bids_{participant}.tmpdir")
-    work_dir = work_dir_tempfile.name
+    # The working directory is removed when the session finishes or fails, unless it is kept for debugging
+    with work_dir_helpers.WorkDir(f"antsnetct_bids_{participant}", shm_budget_mb=args.work_dir_shm_mb,
+                                  keep=args.keep_work_dir) as managed_work_dir:
+        register_session(args, atlases, sweep_candidates, stage_parameters, managed_work_dir)
+
+
+def register_session(args, atlases, sweep_candidates, stage_parameters, managed_work_dir):
+    """Register the T1w to the ihMTR for one session, transfer the atlases and write the outputs and manifest
+
+    Parameters:
+    -----------
+    args : Namespace
+        Parsed command line arguments.
+    atlases : list
+        Atlas registry.
+    sweep_candidates : list
+        Registration sweep candidates from get_sweep_candidates, or None.
+    stage_parameters : dict
+        Stage parameters, for the completion manifest.
+    managed_work_dir : WorkDir
+        Working directory for intermediate files.
+    """
+    antsnetct_dataset = args.antsnetct_dataset
+    input_dataset = args.input_dataset
+    output_dataset = args.output_dataset
+    participant = args.participant
+    session = args.session
+
+    work_dir = managed_work_dir.path
+
+    # Without a sweep, there is a single mask strategy
+    mask_strategies = [candidate[0] for candidate in sweep_candidates] if sweep_candidates is not None else \
+        [args.registration_mask_strategy]
+
+    t1w_bids, t1w_mask = get_t1w_registration_inputs(input_dataset, participant, session, mask_strategies[0],
+                                                     work_dir)
+
+    ihmt_image_relpath, ihmt_mask_relpath = get_ihmt_registration_inputs(participant, session, mask_strategies[0])
+    ihmt_image_bids = bids_helpers.BIDSImage(input_dataset, ihmt_image_relpath)
+
+    # Register T1w to ihMT
+    t1w_to_ihmt_reg_output_prefix = os.path.join(work_dir, f"sub-{participant}_ses-{session}_t1w_to_ihmt_")
+    t1w_to_ihmt_reg_transform = f"{t1w_to_ihmt_reg_output_prefix}0GenericAffine.mat"
+
+    # The transform from a previous run, which may be used to initialize the registration
+    previous_transform = os.path.join(output_dataset, t1w_bids.get_derivative_rel_path_prefix() +
+                                      '_from-T1w_to-ihmt_mode-image_xfm.mat')
+
+    sweep_results = None
+
+    if sweep_candidates is not None:
+        sweep_results, best = run_registration_sweep(args, t1w_bids, ihmt_image_bids, sweep_candidates,
+                                                     previous_transform, work_dir)
+        t1w_mask, ihmt_mask, ihmt_n4_masked, t1w_warped = best['t1w_mask'], best['ihmt_mask'], \
+            best['ihmt_n4_masked'], best['t1w_warped']
+        system_helpers.copy_file(best['transform'], t1w_to_ihmt_reg_transform)
+    else:
+        ihmt_mask = bids_helpers.BIDSImage(input_dataset, ihmt_mask_relpath)
+
+        ihmt_reg_input = ihmt_image_bids.get_path()
+        ihmt_reg_mask = ihmt_mask.get_path()
+
+        # Crop to the padded mask bounding boxes, so N4 and registration skip the background. Cropping preserves
+        # physical space, so the transform applies to the full images
+        if not args.no_crop:
+            ihmt_box = crop_helpers.image_bounding_box(ihmt_reg_mask, args.crop_padding)
+            ihmt_reg_input = crop_helpers.crop_image_file(ihmt_reg_input, ihmt_box, work_dir, 'ihmt_crop',
+                                                          args.scratch_format)
+            ihmt_reg_mask = crop_helpers.crop_image_file(ihmt_reg_mask, ihmt_box, work_dir, 'ihmt_mask_crop',
+                                                         args.scratch_format)
+
+        # N4 bias correct - do this on the fly for consistency with the brain masks
+        ihmt_n4 = ants_helpers.n4_bias_correction(ihmt_reg_input, ihmt_reg_mask, work_dir)
+        ihmt_n4_masked = ants_helpers.apply_mask(ihmt_n4, ihmt_reg_mask, work_dir)
+
+        # The T1w or SST is the moving image for registration
+        if args.longitudinal:
+            sst_image, sst_mask = None, None
+            if args.sst_image is not None:
+                sst_image = args.sst_image.format(participant=participant)
+                sst_mask = args.sst_mask.format(participant=participant) if args.sst_mask is not None else None
+
+            session_inputs = find_participant_t1w_registration_inputs(input_dataset, participant,
+                                                                      args.registration_mask_strategy, work_dir)
+            session_inputs[session] = (t1w_bids.get_path(), t1w_mask.get_path())
+
+            sst_image, sst_mask, t1w_to_sst_transform = longitudinal_helpers.get_session_sst_transform(
+                output_dataset, participant, session, session_inputs, work_dir, sst_image=sst_image, sst_mask=sst_mask)
+
+            moving_reg_input = sst_image
+            moving_reg_mask = sst_mask
+        else:
+            moving_reg_input = t1w_bids.get_path()
+            moving_reg_mask = t1w_mask.get_path()
+
+        if not args.no_crop:
+            moving_box = crop_helpers.image_bounding_box(moving_reg_mask, args.crop_padding)
+            moving_reg_input = crop_helpers.crop_image_file(moving_reg_input, moving_box, work_dir, 'moving_crop',
+                                                            args.scratch_format)
+            moving_reg_mask = crop_helpers.crop_image_file(moving_reg_mask, moving_box, work_dir, 'moving_mask_crop',
+                                                           args.scratch_format)
+
+        # Registrations are cached by the contents of the N4 inputs and masks, and the registration parameters
+        cache_key = None
+        cached_registration = None
+
+        if args.registration_cache_dir is not None:
+            cache_inputs = {'fixed': ihmt_reg_input, 'fixed_mask': ihmt_reg_mask, 'moving': moving_reg_input,
+                            'moving_mask': moving_reg_mask}
+            if args.longitudinal:
+                cache_inputs['t1w_to_sst'] = t1w_to_sst_transform
+            elif args.registration_init in ('cached', 'best') and os.path.exists(previous_transform):
+                cache_inputs['initial'] = previous_transform
+            cache_parameters = {'longitudinal': args.longitudinal,
+                                'registration_init': args.registration_init,
+                                'fine_only_nmi': args.fine_only_nmi,
+                                'rigid': registration_helpers.RIGID_PARAMETERS,
+                                'full_schedule': registration_helpers.FULL_SCHEDULE,
+                                'fine_schedule': registration_helpers.FINE_SCHEDULE}
+            cache_key, cache_checksums = registration_cache.get_cache_key(cache_inputs, cache_parameters)
+            cached_registration, cache_entry = registration_cache.get_cached_registration(args.registration_cache_dir,
+                                                                                          cache_key)
+
+        if cached_registration is not None:
+            logger.info(f"Using cached registration {cache_key}, NMI {cache_entry['NMI']}")
+            system_helpers.copy_file(cached_registration, t1w_to_ihmt_reg_transform)
+
+            if not args.longitudinal:
+                # The same image as the registration output, with the cached transform
+                t1w_warped = warp_t1w_n4_masked(args, moving_reg_input, moving_reg_mask, ihmt_n4_masked,
+                                                t1w_to_ihmt_reg_transform, ihmt_image_bids.get_path(), work_dir)
+        else:
+            moving_n4 = ants_helpers.n4_bias_correction(moving_reg_input, moving_reg_mask, work_dir)
+            moving_n4_masked = ants_helpers.apply_mask(moving_n4, moving_reg_mask, work_dir)
+
+            if args.longitudinal:
+                # The session T1w and ihMTR share scanner space, so the inverse of the T1w -> SST transform is a close
+                # start for SST -> ihMT, and the coarse level is skipped. The output includes the initial transform
+                sst_to_ihmt_transform, _ = registration_helpers.rigid_registration(
+                    ihmt_n4_masked, moving_n4_masked, ihmt_reg_mask, moving_reg_mask,
+                    os.path.join(work_dir, f"sub-{participant}_ses-{session}_sst_to_ihmt_"),
+                    initial_moving_transform=f"[{t1w_to_sst_transform},1]", schedule=registration_helpers.FINE_SCHEDULE,
+                    warped_image=False)
+
+                registration_helpers.compose_linear_transforms(ihmt_image_bids.get_path(),
+                                                               [sst_to_ihmt_transform, t1w_to_sst_transform],
+                                                               t1w_to_ihmt_reg_transform)
+                registered_transform = sst_to_ihmt_transform
+            else:
+                registered_transform, t1w_warped = register_t1w_to_ihmt(
+                    ihmt_n4_masked, moving_n4_masked, ihmt_reg_mask, moving_reg_mask, t1w_to_ihmt_reg_output_prefix,
+                    args.registration_init, args.fine_only_nmi, previous_transform, work_dir)
+
+                # Put the registration output on the cropped ihMT grid back on the full grid
+                if not args.no_crop:
+                    t1w_warped = crop_helpers.uncrop_image_file(t1w_warped, ihmt_image_bids.get_path(), work_dir,
+                                                                't1w_warped', args.scratch_format)
+
+            if cache_key is not None:
+                registered_nmi = registration_helpers.normalized_mutual_information(ihmt_n4_masked, moving_n4_masked,
+                                                                                    ihmt_reg_mask, registered_transform)
+                logger.info(f"NMI after registration {registered_nmi:.4f}")
+                registration_cache.store_registration(args.registration_cache_dir, cache_key, t1w_to_ihmt_reg_transform,
+                                                      cache_checksums, cache_parameters, nmi=registered_nmi)
+
+        if args.longitudinal:
+            # The SST was the moving image, so the session T1w is N4 corrected and masked here, as in cross-sectional
+            # mode, and resampled with the composed transform
+            t1w_reg_input, t1w_reg_mask = t1w_bids.get_path(), t1w_mask.get_path()
+            if not args.no_crop:
+                t1w_box = crop_helpers.image_bounding_box(t1w_reg_mask, args.crop_padding)
+                t1w_reg_input = crop_helpers.crop_image_file(t1w_reg_input, t1w_box, work_dir, 't1w_crop',
+                                                             args.scratch_format)
+                t1w_reg_mask = crop_helpers.crop_image_file(t1w_reg_mask, t1w_box, work_dir, 't1w_mask_crop',
+                                                            args.scratch_format)
+            t1w_warped = warp_t1w_n4_masked(args, t1w_reg_input, t1w_reg_mask, ihmt_n4_masked,
+                                            t1w_to_ihmt_reg_transform, ihmt_image_bids.get_path(), work_dir)
+
+        if not args.no_crop:
+            ihmt_n4_masked = crop_helpers.uncrop_image_file(ihmt_n4_masked, ihmt_image_bids.get_path(), work_dir,
+                                                            'ihmt_n4_masked', args.scratch_format)
+
+    managed_work_dir.report('registration')
+
+    # Outputs are compressed and copied to the output dataset in the background, while the next ones are computed. The
+    # results are BIDSImage futures. The writer waits for them and writes the sidecars when the block exits; on an
+    # error it cancels the pending writes, so none are still running when the working directory is removed
+    with bids_writer.BIDSWriter(work_dir, scratch_format=args.scratch_format) as writer:
+        t1w_warped_bids = writer.submit(t1w_warped, output_dataset,
+                                        t1w_bids.get_derivative_rel_path_prefix() + '_space-ihmt_T1w.nii.gz',
+                                        metadata={'Sources': [t1w_bids.get_uri(relative=False)],
+                                                  'SkullStripped': False})
+
+        t1w_to_ihmt_transform = os.path.join(output_dataset, t1w_bids.get_derivative_rel_path_prefix() +
+                                             '_from-T1w_to-ihmt_mode-image_xfm.mat')
+
+        system_helpers.copy_file(t1w_to_ihmt_reg_transform, t1w_to_ihmt_transform)
+
+        # Register T1w to ihMT
+        t1w_to_ihmt_reg_output_prefix = os.path.join(work_dir, f"sub-{participant}_ses-{session}_t1w_to_ihmt_")
+
+        # copy the n4-ed registration ref image to output dataset
+        ihmt_n4_bids = writer.submit(ihmt_n4_masked,
+                                  output_dataset,
+                                  os.path.join(output_dataset, f"sub-{participant}", f"ses-{session}", "anat", 
+                                               f"sub-{participant}_ses-{session}_acq-ihMTgre2500um_part-mag_desc-N4_ihMTR.nii.gz"),
+                                  metadata={'Sources': [ihmt_image_bids.get_uri(relative=False)]})
+
+        ihmt_masked = ants_helpers.apply_mask(ihmt_image_bids.get_path(), ihmt_mask.get_path(), work_dir)
+
+        # copy the masked ihMT image to output dataset
+        ihmt_masked_bids = writer.submit(ihmt_masked,
+                                  output_dataset,
+                                  ihmt_image_bids.get_rel_path(),
+                                  metadata={'Sources': [ihmt_image_bids.get_uri(relative=False)]})
+    
+        # Transfer the atlases in the registry to ihMT space. Each resampling is a separate antsApplyTransforms process,
+        # so they run concurrently
+        transferred_atlases = atlas_registry.get_atlases(atlases, source_type='antsnetct')
+
+        atlas_source_bids = {atlas['atlas']: bids_helpers.BIDSImage(antsnetct_dataset,
+                                                                    t1w_bids.get_derivative_rel_path_prefix() +
+                                                                    atlas['source'])
+                             for atlas in transferred_atlases}
+
+        def transfer_atlas(atlas):
+            return ants_helpers.apply_transforms(ihmt_image_bids.get_path(),
+                                                 atlas_source_bids[atlas['atlas']].get_path(),
+                                                 [t1w_to_ihmt_reg_transform],
+                                                 work_dir,
+                                                 interpolation=atlas['interpolation'],
+                                                 single_precision=True)
+
+        with ThreadPoolExecutor(max_workers=max(1, args.atlas_threads)) as executor:
+            atlas_in_ihmt_space = dict(zip([atlas['atlas'] for atlas in transferred_atlases],
+                                           executor.map(transfer_atlas, transferred_atlases)))
+
+        # The antsnetct segmentation defines the tissue masks
+        seg_in_ihmt_space = atlas_in_ihmt_space['antsnetct']
+
+        # Labels are read as integers and masks are made as uint8, rather than as float copies of the label volumes
+        seg_in_ihmt_space_img = ants_image_read(seg_in_ihmt_space, pixeltype='unsigned int')
+        ihmt_space_reference_img = seg_in_ihmt_space_img
+
+        # Crop to the segmentation, with enough padding for the dilation
+        seg_box = None
+        if not args.no_crop:
+            seg_box = crop_helpers.bounding_box(seg_in_ihmt_space_img.numpy(), max(args.crop_padding, 3))
+            seg_in_ihmt_space_img = crop_helpers.crop_image(seg_in_ihmt_space_img, seg_box)
+
+        seg_array = seg_in_ihmt_space_img.numpy()
+
+        def crop_label_image(label_image_file):
+            if not isinstance(label_image_file, str):
+                # An atlas made here is read back from the output dataset, once the writer has written it
+                label_image_file = label_image_file.result().get_path()
+            label_image = ants_image_read(label_image_file, pixeltype='unsigned int')
+            if args.no_crop:
+                return label_image
+            return crop_helpers.crop_image(label_image, seg_box)
+
+        def uncrop_label_image(image):
+            if args.no_crop:
+                return image
+            return crop_helpers.uncrop_image(image, ihmt_space_reference_img)
+
+        def publish_label_image(image, name, sources):
+            return writer.submit(uncrop_label_image(image), output_dataset,
+                                 ihmt_image_bids.get_derivative_rel_path_prefix() +
+                                 f"_space-ihmt_seg-{name}_dseg.nii.gz",
+                                 metadata={'Sources': sources})
+
+        atlas_sources = {name: [source_bids.get_uri(relative=False)] for name, source_bids in atlas_source_bids.items()}
+
+        atlas_bids = dict()
+        tissue_mask_bids = dict()
+
+        # Publish the transferred atlases, masked to tissue classes if required
+        for atlas in transferred_atlases:
+            name = atlas['atlas']
+            if atlas['mask'] is None:
+                atlas_bids[name] = writer.submit(atlas_in_ihmt_space[name], output_dataset,
+                                                 ihmt_image_bids.get_derivative_rel_path_prefix() +
+                                                 f"_space-ihmt_seg-{name}_dseg.nii.gz",
+                                                 metadata={'Sources': atlas_sources[name]})
+                continue
+            atlas_img = crop_label_image(atlas_in_ihmt_space[name])
+            atlas_array = atlas_img.numpy()
+            atlas_array[~np.isin(seg_array, atlas['mask']['classes'])] = 0
+            atlas_bids[name] = publish_label_image(atlas_img.new_image_like(atlas_array), name, atlas_sources[name])
+            atlas_in_ihmt_space[name] = atlas_bids[name]
+            del atlas_img, atlas_array
+
+        # Propagate atlases through dilated tissue masks, eg cortical labels into the WM. Atlases that do not depend on
+        # each other's propagated labels are propagated concurrently, in --atlas-threads
+        def propagate_atlas(atlas, seg_array, seg_img):
+            tissue_mask_array = np.isin(seg_array, atlas['mask']['classes']).astype(np.uint8)
+
+            # dilate mask to overlap cortical labels
+            tissue_maskmd_array = propagation_helpers.dilate_mask(tissue_mask_array, 2)
+
+            source_img = crop_label_image(atlas_in_ihmt_space[atlas['source']])
+
+            # propagate the labels into the mask
+            if args.label_propagation == 'itk':
+                # ITK fast marching needs float images
+                propagated = iMath_propagate_labels_through_mask(
+                    seg_img.new_image_like(tissue_maskmd_array).clone('float'), source_img.clone('float'))
+                propagated_array = memory_helpers.to_label_array(propagated.numpy())
+                del propagated
+            else:
+                propagated_array = propagation_helpers.propagate_labels_through_mask(
+                    tissue_maskmd_array, memory_helpers.to_label_array(source_img.numpy()),
+                    spacing=seg_img.spacing, method=args.label_propagation,
+                    max_distance=args.label_propagation_max_distance, threads=args.propagation_threads)
+            del source_img
+
+            return tissue_mask_array, tissue_maskmd_array, propagated_array
+
+        # An atlas propagated from a propagated atlas is in the level after its source
+        atlas_levels = dict()
+        propagation_levels = list()
+        for atlas in atlas_registry.get_atlases(atlases, source_type='propagate'):
+            level = atlas_levels.get(atlas['source'], -1) + 1
+            atlas_levels[atlas['atlas']] = level
+            if level == len(propagation_levels):
+                propagation_levels.append(list())
+            propagation_levels[level].append(atlas)
+
+        for level_atlases in propagation_levels:
+            with ThreadPoolExecutor(max_workers=max(1, args.atlas_threads)) as executor:
+                propagated_arrays = list(executor.map(functools.partial(propagate_atlas, seg_array=seg_array,
+                                                                        seg_img=seg_in_ihmt_space_img),
+                                                      level_atlases))
+
+            for atlas, (tissue_mask_array, tissue_maskmd_array, propagated_array) in zip(level_atlases,
+                                                                                         propagated_arrays):
+                name = atlas['atlas']
+                mask_name = atlas['mask']['name']
+                atlas_sources[name] = atlas_sources[atlas['source']]
+
+                tissue_mask = seg_in_ihmt_space_img.new_image_like(tissue_mask_array)
+
+                if mask_name not in tissue_mask_bids:
+                    tissue_mask_bids[mask_name] = publish_label_image(tissue_mask, mask_name,
+                                                                      atlas_sources['antsnetct'])
+                    tissue_mask_bids[mask_name + 'md'] = publish_label_image(
+                        tissue_mask.new_image_like(tissue_maskmd_array), mask_name + 'md', atlas_sources['antsnetct'])
+
+                tissue_mask_bids[atlas['dilated_name']] = publish_label_image(
+                    tissue_mask.new_image_like(propagated_array.astype(np.uint32)), atlas['dilated_name'],
+                    atlas_sources['antsnetct'])
+
+                # re-mask without the dilation
+                propagated_array[tissue_mask_array == 0] = 0
+                atlas_bids[name] = publish_label_image(tissue_mask.new_image_like(propagated_array.astype(np.uint32)),
+                                                       name, atlas_sources[name])
+                atlas_in_ihmt_space[name] = atlas_bids[name]
+
+            del propagated_arrays, tissue_mask, tissue_mask_array, tissue_maskmd_array, propagated_array
+
+        del seg_in_ihmt_space_img, seg_array
+
+        # Partial-volume fractions of the atlases with label definitions, from the T1w-resolution atlases. Tissue masks
+        # are applied with the T1w-resolution segmentation
+        partial_volume_file = None
+
+        if args.partial_volume_labels:
+            partial_volume_atlases = [atlas for atlas in transferred_atlases if atlas['label_def'] is not None]
+            partial_volume_masks = {atlas['atlas']: (atlas_source_bids['antsnetct'].get_path(),
+                                                     atlas['mask']['classes'])
+                                    for atlas in partial_volume_atlases if atlas['mask'] is not None}
+            partial_volume_operator = partial_volume_helpers.build_partial_volume_operator(
+                ihmt_image_bids.get_path(),
+                {atlas['atlas']: atlas_source_bids[atlas['atlas']].get_path() for atlas in partial_volume_atlases},
+                t1w_to_ihmt_reg_transform, masks=partial_volume_masks)
+            partial_volume_file = partial_volume_helpers.write_partial_volume_operator(
+                partial_volume_operator,
+                partial_volume_helpers.get_operator_file(
+                    os.path.join(output_dataset, ihmt_image_bids.get_derivative_rel_path_prefix())))
+            del partial_volume_operator
+
+        managed_work_dir.report('label transfer')
+
+    t1w_warped_bids, ihmt_n4_bids, ihmt_masked_bids = [future.result() for future in
+                                                       (t1w_warped_bids, ihmt_n4_bids, ihmt_masked_bids)]
+    atlas_bids = {name: future.result() for name, future in atlas_bids.items()}
+    tissue_mask_bids = {name: future.result() for name, future in tissue_mask_bids.items()}
+
+    seg_in_ihmt_bids = atlas_bids['antsnetct']
+
+    qc_stats_file = compute_qc_stats(ihmt_masked_bids, ihmt_mask, seg_in_ihmt_bids, work_dir, t1w_warped_bids)
+    qc_plot_files = make_ihMTR_qc_plots(ihmt_masked_bids, ihmt_mask.get_path(), work_dir)
+
+    output_files = [bids_image.get_path() for bids_image in [t1w_warped_bids, ihmt_n4_bids, ihmt_masked_bids] +
+                    list(atlas_bids.values()) + list(tissue_mask_bids.values())]
+    output_files.extend([t1w_to_ihmt_transform, qc_stats_file])
+    output_files.extend(qc_plot_files)
+
+    if partial_volume_file is not None:
+        output_files.append(partial_volume_file)
+
+    if sweep_results is not None:
+        output_files.append(write_sweep_table(sweep_results, os.path.join(
+            output_dataset, ihmt_image_bids.get_derivative_rel_path_prefix() + '_desc-qc_regsweep.tsv')))
+
+    peak_memory = memory_helpers.peak_memory_report()
+    logger.info(f"Peak memory for participant {participant}, session {session}: {peak_memory['PeakRSSMB']} MB, "
+                f"largest subprocess {peak_memory['PeakChildRSSMB']} MB")
+
+    manifest_inputs = {'T1w': t1w_bids.get_path(),
+                       'T1w_mask': t1w_mask.get_path(),
+                       'ihMTR': ihmt_image_bids.get_path(),
+                       'ihMTR_mask': ihmt_mask.get_path(),
+                       'atlas_registry': atlas_registry.get_registry_file(args.label_def_dir),
+                       **{f"atlas_{name}": source_bids.get_path() for name, source_bids in atlas_source_bids.items()}}
+
+    if sweep_results is not None:
+        for result in sweep_results:
+            manifest_inputs[f"T1w_mask_{result['mask_strategy']}"] = result['t1w_mask'].get_path()
+            manifest_inputs[f"ihMTR_mask_{result['mask_strategy']}"] = result['ihmt_mask'].get_path()
+
+    if args.longitudinal:
+        manifest_inputs.update({'SST': sst_image, 'SST_mask': sst_mask, 'T1w_to_SST': t1w_to_sst_transform})
+
+    manifest_helpers.write_manifest(output_dataset, 'register', participant, session, outputs=output_files,
+                                    inputs=manifest_inputs,
+                                    parameters=stage_parameters,
+                                    resources={**peak_memory, **managed_work_dir.resources()})
+
+
+
+def dry_run(args, atlases, sessions, stage_parameters):
+    """Check the inputs of sessions and list their outputs, without running ANTs
+
+    Writes a TSV with columns participant, session, status, outputs and problems to stdout, where status is the
+    completion status of the session and outputs is the number of files it would write. For a single session, the
+    output files are also logged.
+
+    Parameters:
+    -----------
+    args : Namespace
+        Parsed command line arguments.
+    atlases : list
+        Atlas registry.
+    sessions : list
+        (participant, session) tuples.
+    stage_parameters : dict
+        Stage parameters, for the completion status.
+
+    Returns:
+    --------
+    num_invalid : int
+        Number of sessions with missing or ambiguous inputs.
+    """
+    if not os.path.exists(os.path.join(args.input_dataset, 'dataset_description.json')):
+        raise ValueError('Input dataset does not contain a dataset_description.json file')
+
+    num_invalid = 0
+
+    print("participant\tsession\tstatus\toutputs\tproblems")
+
+    for participant, session in sessions:
+        session_status, _ = manifest_helpers.check_session(args.output_dataset, 'register', participant, session,
+                                                           parameters=stage_parameters)
+        outputs, problems = plan_session(args, atlases, participant, session)
+        if len(problems) > 0:
+            num_invalid += 1
+        print(f"{participant}\t{session}\t{session_status}\t{len(outputs)}\t{'; '.join(problems)}")
+        if len(sessions) == 1:
+            for output in outputs:
+                logger.info(f"Output: {output}")
+
+    logger.info(f"Checked {len(sessions)} sessions, {num_invalid} with missing or ambiguous inputs")
+
+    return num_invalid
+
+
+def plan_session(args, atlases, participant, session):
+    """Find the inputs of a session and the outputs it would write
+
+    Inputs are found by file name, so this does not need a BIDS layout of the input dataset.
+
+    Parameters:
+    -----------
+    args : Namespace
+        Parsed command line arguments.
+    atlases : list
+        Atlas registry.
+    participant : str
+        Participant ID.
+    session : str
+        Session ID.
+
+    Returns:
+    --------
+    outputs, problems : tuple of list
+        Output paths, and descriptions of any missing or ambiguous inputs.
+    """
+    outputs = list()
+    problems = list()
+
+    anat_dir = os.path.join(args.input_dataset, f"sub-{participant}", f"ses-{session}", 'anat')
+    t1w_files = sorted(glob.glob(os.path.join(anat_dir, f"sub-{participant}_ses-{session}_*desc-preproc_T1w.nii.gz")))
+
+    sweep_candidates = get_sweep_candidates(args)
+    mask_strategies = list(dict.fromkeys(candidate[0] for candidate in sweep_candidates)) \
+        if sweep_candidates is not None else [args.registration_mask_strategy]
+
+    t1w_bids = None
+    if len(t1w_files) != 1:
+        problems.append(f"expected one T1w image, found {len(t1w_files)}")
+    else:
+        t1w_bids = bids_helpers.BIDSImage(args.input_dataset, os.path.relpath(t1w_files[0], args.input_dataset))
+        for strategy in mask_strategies:
+            if get_t1w_registration_mask(args.input_dataset, t1w_bids, strategy) is None:
+                problems.append(f"T1w mask not found for {strategy}" if sweep_candidates is not None else
+                                'T1w mask not found')
+
+    ihmt_relpath = None
+    for strategy in mask_strategies:
+        ihmt_relpath, ihmt_mask_relpath = get_ihmt_registration_inputs(participant, session, strategy)
+        for relpath in (ihmt_relpath, ihmt_mask_relpath):
+            if not os.path.exists(os.path.join(args.input_dataset, relpath)) and f"missing {relpath}" not in problems:
+                problems.append(f"missing {relpath}")
+
+    if args.sst_image is not None:
+        for sst_file in (args.sst_image, args.sst_mask):
+            if not os.path.exists(sst_file.format(participant=participant)):
+                problems.append(f"missing {sst_file.format(participant=participant)}")
+
+    if t1w_bids is None or not os.path.exists(os.path.join(args.input_dataset, ihmt_relpath)):
+        return outputs, problems
+
+    for atlas in atlas_registry.get_atlases(atlases, source_type='antsnetct'):
+        source_file = os.path.join(args.antsnetct_dataset, t1w_bids.get_derivative_rel_path_prefix() + atlas['source'])
+        if not os.path.exists(source_file):
+            problems.append(f"missing {atlas['atlas']} atlas {source_file}")
+
+    t1w_prefix = os.path.join(args.output_dataset, t1w_bids.get_derivative_rel_path_prefix())
+    ihmt_prefix = os.path.join(args.output_dataset,
+                               bids_helpers.BIDSImage(args.input_dataset, ihmt_relpath).get_derivative_rel_path_prefix())
+
+    outputs.extend([t1w_prefix + '_space-ihmt_T1w.nii.gz', t1w_prefix + '_from-T1w_to-ihmt_mode-image_xfm.mat',
+                    os.path.join(args.output_dataset, ihmt_relpath),
+                    os.path.join(args.output_dataset, os.path.dirname(ihmt_relpath),
+                                 f"sub-{participant}_ses-{session}_acq-ihMTgre2500um_part-mag_desc-N4_ihMTR.nii.gz")])
+
+    seg_names = list()
+    for atlas in atlases:
+        if atlas['source_type'] == 'map':
+            continue
+        if atlas['source_type'] == 'propagate':
+            for name in (atlas['mask']['name'], atlas['mask']['name'] + 'md', atlas['dilated_name']):
+                if name not in seg_names:
+                    seg_names.append(name)
+        seg_names.append(atlas['atlas'])
+
+    outputs.extend([ihmt_prefix + f"_space-ihmt_seg-{name}_dseg.nii.gz" for name in seg_names])
+    outputs.extend([ihmt_prefix + suffix for suffix in ('_desc-qc_brainstats.tsv', '_desc-qcihMTRAx.png',
+                                                        '_desc-qcihMTRCor.png')])
+
+    if sweep_candidates is not None:
+        outputs.append(ihmt_prefix + '_desc-qc_regsweep.tsv')
+
+    if args.partial_volume_labels:
+        outputs.append(partial_volume_helpers.get_operator_file(ihmt_prefix))
+
+    return outputs, problems
+
+
+def get_t1w_registration_inputs(input_dataset, participant, session, registration_mask_strategy, work_dir):
+    """Find the T1w image and its registration mask for a session
 
+    Parameters:
+    -----------
+    input_dataset : str
+        Input BIDS dataset, from gather_t1w_ihmt_inputs.py.
+    participant : str
+        Participant ID.
+    session : str
+        Session ID.
+    registration_mask_strategy : str
+        One of "synthstrip", "synthstrip_no_csf", or "no_synthstrip".
+    work_dir : str
+        Path to the working directory.
+
+    Returns:
+    --------
+    t1w_bids, t1w_mask : tuple of BIDSImage
+        The T1w image and its registration mask.
+    """
     # Get input t1w - this is from the "input t1w" dataset, from gather_t1w_ihmt_inputs.py, and thus only one should exist
     # This is a copy of one of the T1w images from antsnetct - but other T1w might exist in the same session.
     bids_t1w_filter = bids_helpers.get_modality_filter_query('t1w')
@@ -139,194 +881,351 @@ def t1w_to_ihmt_pipeline():
 
     t1w_bids = t1w_bids[0]
 
-    ihmt_image_bids = bids_helpers.BIDSImage(input_dataset,
-                                            os.path.join(f"sub-{participant}", f"ses-{session}", "anat",
-                                                         f"sub-{participant}_ses-{session}_acq-ihMTgre2500um_part-mag_ihMTR.nii.gz"))
+    t1w_mask = get_t1w_registration_mask(input_dataset, t1w_bids, registration_mask_strategy)
 
-    # Register T1w to ihMT
-    t1w_to_ihmt_reg_output_prefix = os.path.join(work_dir, f"sub-{participant}_ses-{session}_t1w_to_ihmt_")
+    if t1w_mask is None or not os.path.exists(t1w_mask.get_path()):
+        raise ValueError(f"T1w mask not found for participant {participant}, session {session}")
+
+    return t1w_bids, t1w_mask
+
+
+def get_t1w_registration_mask(input_dataset, t1w_bids, registration_mask_strategy):
+    """Get the registration mask for a T1w image
 
-    ihmt_mask = None
-    t1w_mask = None
-
-    if (args.registration_mask_strategy == 'synthstrip'):
-        ihmt_mask = bids_helpers.BIDSImage(
-            input_dataset,
-            os.path.join(f"sub-{participant}", f"ses-{session}", "anat",
-                         f"sub-{participant}_ses-{session}_desc-ihMTRSynthstrip_mask.nii.gz")
-            )
-        t1w_mask = t1w_bids.get_derivative_image('_desc-synthstrip_mask.nii.gz')
-
-    elif (args.registration_mask_strategy == 'synthstrip_no_csf'):
-        ihmt_mask = bids_helpers.BIDSImage(
-            input_dataset,
-            os.path.join(f"sub-{participant}", f"ses-{session}", "anat",
-                         f"sub-{participant}_ses-{session}_desc-ihMTRSynthstripNoCSF_mask.nii.gz")
-            )
-        t1w_mask = t1w_bids.get_derivative_image('_desc-synthstripNoCSF_mask.nii.gz')
-
-    elif (args.registration_mask_strategy == 'no_synthstrip'):
-        ihmt_mask = bids_helpers.BIDSImage(
-            input_dataset,
-            os.path.join(f"sub-{participant}", f"ses-{session}", "anat",
-                         f"sub-{participant}_ses-{session}_desc-sepia_mask.nii.gz")
-            )
-        t1w_mask = bids_helpers.BIDSImage(input_dataset,
-                                          t1w_bids.get_derivative_rel_path_prefix() + "_desc-antsnetct_mask.nii.gz")
+    Parameters:
+    -----------
+    input_dataset : str
+        Input BIDS dataset, from gather_t1w_ihmt_inputs.py.
+    t1w_bids : BIDSImage
+        The T1w image.
+    registration_mask_strategy : str
+        One of "synthstrip", "synthstrip_no_csf", or "no_synthstrip".
+
+    Returns:
+    --------
+    t1w_mask : BIDSImage
+        The registration mask, or None if it does not exist.
+    """
+    if (registration_mask_strategy == 'synthstrip'):
+        return t1w_bids.get_derivative_image('_desc-synthstrip_mask.nii.gz')
+    elif (registration_mask_strategy == 'synthstrip_no_csf'):
+        return t1w_bids.get_derivative_image('_desc-synthstripNoCSF_mask.nii.gz')
+    elif (registration_mask_strategy == 'no_synthstrip'):
+        mask_relpath = t1w_bids.get_derivative_rel_path_prefix() + "_desc-antsnetct_mask.nii.gz"
+        if not os.path.exists(os.path.join(input_dataset, mask_relpath)):
+            return None
+        return bids_helpers.BIDSImage(input_dataset, mask_relpath)
     else:
-        raise ValueError(f"Invalid registration mask strategy: {args.registration_mask_strategy}. "
+        raise ValueError(f"Invalid registration mask strategy: {registration_mask_strategy}. "
                          f"Options are 'synthstrip', 'synthstrip_no_csf', or 'no_synthstrip'.")
 
-    if t1w_mask is None or not os.path.exists(t1w_mask.get_path()):
-        raise ValueError(f"T1w mask not found for participant {participant}, session {session}")
 
-    # N4 bias correct - do this on the fly for consistency with the brain masks
-    t1w_n4 = ants_helpers.n4_bias_correction(t1w_bids.get_path(), t1w_mask.get_path(), work_dir)
-    ihmt_n4 = ants_helpers.n4_bias_correction(ihmt_image_bids.get_path(), ihmt_mask.get_path(), work_dir)
-
-    # apply masks
-    t1w_n4_masked = ants_helpers.apply_mask(t1w_n4, t1w_mask.get_path(), work_dir)
-    ihmt_n4_masked = ants_helpers.apply_mask(ihmt_n4, ihmt_mask.get_path(), work_dir)
-
-    system_helpers.run_command(
-        ['antsRegistration',
-        '--dimensionality', '3',
-        '--float', '0',
-        '--output', f'[{t1w_to_ihmt_reg_output_prefix},{t1w_to_ihmt_reg_output_prefix}Warped.nii.gz]',
-        '--interpolation', 'Linear',
-        '--winsorize-image-intensities', '[0.0,0.999]',
-        '--masks', f"[{ihmt_mask.get_path()},{t1w_mask.get_path()}]",
-        '--transform', 'Rigid[0.1]',
-        '--metric', f'MI[{ihmt_n4_masked},{t1w_n4_masked},1,32,Regular]',
-        '--convergence', '[500x250x50,1e-6,10]',
-        '--shrink-factors', '4x2x1',
-        '--smoothing-sigmas','2x1x0vox'])
-
-    t1w_warped_bids = bids_helpers.image_to_bids(f"{t1w_to_ihmt_reg_output_prefix}Warped.nii.gz", output_dataset,
-                                                 t1w_bids.get_derivative_rel_path_prefix() + '_space-ihmt_T1w.nii.gz',
-                                                 metadata={'Sources': [t1w_bids.get_uri(relative=False)],
-                                                          'SkullStripped': False})
-
-    t1w_to_ihmt_transform = os.path.join(output_dataset,
-                                        t1w_bids.get_derivative_rel_path_prefix() + '_from-T1w_to-ihmt_mode-image_xfm.mat')
-
-    system_helpers.copy_file(f"{t1w_to_ihmt_reg_output_prefix}0GenericAffine.mat", t1w_to_ihmt_transform)
+def get_ihmt_registration_inputs(participant, session, registration_mask_strategy):
+    """Get the paths of the ihMTR image and its registration mask for a session
 
-    # Register T1w to ihMT
-    t1w_to_ihmt_reg_output_prefix = os.path.join(work_dir, f"sub-{participant}_ses-{session}_t1w_to_ihmt_")
+    Parameters:
+    -----------
+    participant : str
+        Participant ID.
+    session : str
+        Session ID.
+    registration_mask_strategy : str
+        One of "synthstrip", "synthstrip_no_csf", or "no_synthstrip".
 
-    # copy the n4-ed registration ref image to output dataset
-    bids_helpers.image_to_bids(ihmt_n4_masked,
-                              output_dataset,
-                              os.path.join(output_dataset, f"sub-{participant}", f"ses-{session}", "anat", 
-                                           f"sub-{participant}_ses-{session}_acq-ihMTgre2500um_part-mag_desc-N4_ihMTR.nii.gz"),
-                              metadata={'Sources': [ihmt_image_bids.get_uri(relative=False)]})
+    Returns:
+    --------
+    ihmt_relpath, ihmt_mask_relpath : tuple of str
+        Paths of the ihMTR image and its mask, relative to the input dataset.
+    """
+    anat_dir = os.path.join(f"sub-{participant}", f"ses-{session}", "anat")
 
-    ihmt_masked = ants_helpers.apply_mask(ihmt_image_bids.get_path(), ihmt_mask.get_path(), work_dir)
+    if (registration_mask_strategy == 'synthstrip'):
+        mask_desc = 'ihMTRSynthstrip'
+    elif (registration_mask_strategy == 'synthstrip_no_csf'):
+        mask_desc = 'ihMTRSynthstripNoCSF'
+    else:
+        mask_desc = 'sepia'
 
-    # copy the masked ihMT image to output dataset
-    ihmt_masked_bids = bids_helpers.image_to_bids(ihmt_masked,
-                              output_dataset,
-                              ihmt_image_bids.get_rel_path(),
-                              metadata={'Sources': [ihmt_image_bids.get_uri(relative=False)]})
-    
-    # Mask DKT31 labels by GM in T1w space, then resample to ihMT space
-    dkt31_bids = bids_helpers.BIDSImage(antsnetct_dataset,
-                                        t1w_bids.get_derivative_rel_path_prefix() + '_seg-dkt31Propagated_dseg.nii.gz')
-
-    hoa_seg_bids = bids_helpers.BIDSImage(antsnetct_dataset, t1w_bids.get_derivative_rel_path_prefix() +
-                                          '_seg-hoaMasked_dseg.nii.gz')
-
-    seg_bids = bids_helpers.BIDSImage(antsnetct_dataset,
-                                        t1w_bids.get_derivative_rel_path_prefix() + '_seg-antsnetct_dseg.nii.gz')
-
-    dkt31_in_ihmt_space = ants_helpers.apply_transforms(ihmt_image_bids.get_path(), dkt31_bids.get_path(),
-                                                           [f"{t1w_to_ihmt_reg_output_prefix}0GenericAffine.mat"],
-                                                           work_dir,
-                                                           interpolation='GenericLabel',
-                                                           single_precision=True)
-
-    dkt31_in_ihmt_bids = bids_helpers.image_to_bids(dkt31_in_ihmt_space, output_dataset,
-                                                   ihmt_image_bids.get_derivative_rel_path_prefix() + \
-                                                    '_space-ihmt_seg-dkt31_dseg.nii.gz',
-                                                   metadata={'Sources': [dkt31_bids.get_uri(relative=False)]})
-
-    hoa_in_ihmt_space = ants_helpers.apply_transforms(ihmt_image_bids.get_path(), hoa_seg_bids.get_path(),
-                                                         [f"{t1w_to_ihmt_reg_output_prefix}0GenericAffine.mat"],
-                                                         work_dir,
-                                                         interpolation='GenericLabel',
-                                                         single_precision=True)
-
-    hoa_in_ihmt_bids = bids_helpers.image_to_bids(hoa_in_ihmt_space, output_dataset,
-                                                 ihmt_image_bids.get_derivative_rel_path_prefix() +
-                                                 '_space-ihmt_seg-hoa_dseg.nii.gz',
-                                                 metadata={'Sources': [hoa_seg_bids.get_uri(relative=False)]})
-    
-    seg_in_ihmt_space = ants_helpers.apply_transforms(ihmt_image_bids.get_path(), seg_bids.get_path(),
-                                                           [f"{t1w_to_ihmt_reg_output_prefix}0GenericAffine.mat"],
-                                                           work_dir,
-                                                           interpolation='GenericLabel',
-                                                           single_precision=True)
-
-    seg_in_ihmt_bids = bids_helpers.image_to_bids(seg_in_ihmt_space, output_dataset,
-                                                   ihmt_image_bids.get_derivative_rel_path_prefix() + \
-                                                    '_space-ihmt_seg-antsnetct_dseg.nii.gz',
-                                                   metadata={'Sources': [seg_bids.get_uri(relative=False)]})
-
-    # get WM segmentation mask
-    seg_in_ihmt_space_img = ants_image_read(seg_in_ihmt_bids.get_path())
-    dkt31_in_ihmt_space_img = ants_image_read(dkt31_in_ihmt_bids.get_path())
-
-
-    wm_mask = image_clone(seg_in_ihmt_space_img)
-    wm_mask[wm_mask > 2] = 0
-    wm_mask[wm_mask < 2] = 0
-    wm_mask[wm_mask == 2] = 1
-
-    # save wm mask
-    wm_mask_image_file = system_helpers.get_temp_file(work_dir, prefix='wm_mask') + '_wm_mask.nii.gz'
-    ants_image_write(wm_mask, wm_mask_image_file)
-    wm_mask_bids = bids_helpers.image_to_bids(wm_mask_image_file, output_dataset,
-                                                   ihmt_image_bids.get_derivative_rel_path_prefix() + \
-                                                    '_space-ihmt_seg-wm_dseg.nii.gz',
-                                                   metadata={'Sources': [seg_bids.get_uri(relative=False)]})
-
- 
-    # dilate mask to overlap cortical labels
-    # wm_maskmd = morphology(wm_mask, operation='dilate', radius=2)
-    wm_maskmd = iMath(wm_mask, 'MD', 2)
-    wm_maskmd_image_file = system_helpers.get_temp_file(work_dir, prefix='wm_maskmd') + '_wm_maskmd.nii.gz'
-    ants_image_write(wm_maskmd, wm_maskmd_image_file)
-    wm_maskmd_bids = bids_helpers.image_to_bids(wm_maskmd_image_file, output_dataset,
-                                                   ihmt_image_bids.get_derivative_rel_path_prefix() + \
-                                                    '_space-ihmt_seg-wmmd_dseg.nii.gz',
-                                                   metadata={'Sources': [seg_bids.get_uri(relative=False)]})
-
-    # propagate the labels into the wm
-    wmmd_dkt = iMath_propagate_labels_through_mask(wm_maskmd, dkt31_in_ihmt_space_img)
-    wmmd_dkt_image_file = system_helpers.get_temp_file(work_dir, prefix='wm_propdkt') + '_wm_propdkt.nii.gz'
-    ants_image_write(wmmd_dkt, wmmd_dkt_image_file)
-    wmmd_dkt_bids = bids_helpers.image_to_bids(wmmd_dkt_image_file, output_dataset,
-                                                   ihmt_image_bids.get_derivative_rel_path_prefix() + \
-                                                    '_space-ihmt_seg-wmmddkt_dseg.nii.gz',
-                                                   metadata={'Sources': [seg_bids.get_uri(relative=False)]})    
-
-    # we just want white matter, so re-mask without the dilation
-    # wm_dkt_masked = wmmd_dkt * wm_mask
-    wm_dkt_masked = ants_helpers.apply_mask(wmmd_dkt_bids.get_path(), wm_mask_bids.get_path(), work_dir)
-
-    # save dkt wm labels
-    # wm_dkt_masked_image_file = system_helpers.get_temp_file(work_dir, prefix='wm_dkt_masked') + '_wm_dkt_masked.nii.gz'
-    # ants_image_write(wm_dkt_masked, wm_dkt_masked_image_file)
-
-    wm_dkt_masked_bids = bids_helpers.image_to_bids(wm_dkt_masked, output_dataset,
-                                                   ihmt_image_bids.get_derivative_rel_path_prefix() + \
-                                                    '_space-ihmt_seg-dkt31wm_dseg.nii.gz',
-                                                   metadata={'Sources': [dkt31_bids.get_uri(relative=False)]})
-
-    compute_qc_stats(ihmt_masked_bids, ihmt_mask, seg_in_ihmt_bids, work_dir, t1w_warped_bids)
-    make_ihMTR_qc_plots(ihmt_masked_bids, ihmt_mask.get_path(), work_dir)
+    return (os.path.join(anat_dir, f"sub-{participant}_ses-{session}_acq-ihMTgre2500um_part-mag_ihMTR.nii.gz"),
+            os.path.join(anat_dir, f"sub-{participant}_ses-{session}_desc-{mask_desc}_mask.nii.gz"))
+
+
+def find_participant_t1w_registration_inputs(input_dataset, participant, registration_mask_strategy, work_dir):
+    """Find the T1w images and registration masks for all sessions of a participant
+
+    Sessions without a T1w image or mask are skipped.
+
+    Parameters:
+    -----------
+    input_dataset : str
+        Input BIDS dataset, from gather_t1w_ihmt_inputs.py.
+    participant : str
+        Participant ID.
+    registration_mask_strategy : str
+        One of "synthstrip", "synthstrip_no_csf", or "no_synthstrip".
+    work_dir : str
+        Path to the working directory.
+
+    Returns:
+    --------
+    session_inputs : dict
+        session -> (T1w path, T1w mask path).
+    """
+    session_inputs = dict()
+
+    session_dirs = sorted(glob.glob(os.path.join(input_dataset, f"sub-{participant}", 'ses-*')))
+
+    for session_dir in session_dirs:
+        session = os.path.basename(session_dir)[len('ses-'):]
+        try:
+            t1w_bids, t1w_mask = get_t1w_registration_inputs(input_dataset, participant, session,
+                                                             registration_mask_strategy, work_dir)
+        except ValueError as e:
+            logger.warning(f"Not using participant {participant}, session {session} for the SST: {e}")
+            continue
+        session_inputs[session] = (t1w_bids.get_path(), t1w_mask.get_path())
+
+    return session_inputs
+
+
+def get_sweep_candidates(args):
+    """Get the candidate registrations of a registration sweep
+
+    Parameters:
+    -----------
+    args : Namespace
+        Parsed command line arguments.
+
+    Returns:
+    --------
+    candidates : list
+        [mask strategy, metric] for each candidate registration, or None if no sweep was requested. Without
+        --sweep-mask-strategies, the candidates use --registration-mask-strategy, and without --sweep-metrics, the
+        default metric.
+    """
+    if args.sweep_mask_strategies is None and args.sweep_metrics is None:
+        return None
+
+    def split_list(value, default, choices, name):
+        if value is None:
+            return [default]
+        items = list(dict.fromkeys(item.strip() for item in value.split(',') if item.strip() != ''))
+        for item in items:
+            if item not in choices:
+                raise ValueError(f"Invalid {name}: {item}. Options are {choices}")
+        return items
+
+    strategies = split_list(args.sweep_mask_strategies, args.registration_mask_strategy, REGISTRATION_MASK_STRATEGIES,
+                            'registration mask strategy')
+    metrics = split_list(args.sweep_metrics, registration_helpers.RIGID_PARAMETERS['metric'],
+                         registration_helpers.METRICS, 'registration metric')
+
+    return [[strategy, metric] for strategy in strategies for metric in metrics]
+
+
+def register_t1w_to_ihmt(fixed_image, moving_image, fixed_mask, moving_mask, output_prefix, registration_init,
+                         fine_only_nmi, previous_transform, work_dir, metric=None):
+    """Rigidly register a T1w image to an ihMTR image, from the initial transform chosen by registration_init
+
+    Parameters:
+    -----------
+    fixed_image, moving_image : str
+        N4 corrected and masked ihMTR and T1w images.
+    fixed_mask, moving_mask : str
+        Registration masks of the ihMTR and T1w images.
+    output_prefix : str
+        Output prefix for antsRegistration.
+    registration_init : str
+        Initialization method, one of registration_helpers.INITIALIZATION_METHODS.
+    fine_only_nmi : float
+        Skip the coarse level if the initial NMI is at least this value. May be None.
+    previous_transform : str
+        Transform from a previous run, for the "cached" and "best" initialization.
+    work_dir : str
+        Path to the working directory.
+    metric : str, optional
+        Registration metric. Default is the metric in registration_helpers.RIGID_PARAMETERS.
+
+    Returns:
+    --------
+    transform, warped : tuple of str
+        The T1w to ihMT transform, and the T1w resampled onto the ihMTR grid.
+    """
+    initial_transform = None
+    schedule = registration_helpers.FULL_SCHEDULE
+
+    if registration_init != 'header' or fine_only_nmi is not None:
+        init_method, initial_transform, initial_nmi = registration_helpers.get_initial_transform(
+            fixed_image, moving_image, fixed_mask, registration_init, work_dir, cached_transform=previous_transform)
+        logger.info(f"Initializing registration from {init_method}, NMI {initial_nmi:.4f}")
+        if fine_only_nmi is not None and initial_nmi >= fine_only_nmi:
+            logger.info('Initial alignment is good, skipping the coarse registration level')
+            schedule = registration_helpers.FINE_SCHEDULE
+
+    return registration_helpers.rigid_registration(fixed_image, moving_image, fixed_mask, moving_mask, output_prefix,
+                                                   initial_moving_transform=initial_transform, schedule=schedule,
+                                                   metric=metric)
+
+
+def warp_t1w_n4_masked(args, t1w_reg_input, t1w_reg_mask, ihmt_n4_masked, transform, ihmt_image, work_dir):
+    """Resample the N4 corrected and masked T1w onto the ihMTR grid with an existing transform
+
+    This makes the same image as the Warped output of register_t1w_to_ihmt, for transforms that are not computed by a
+    registration of the T1w, eg from the registration cache.
+
+    Parameters:
+    -----------
+    args : Namespace
+        Parsed command line arguments.
+    t1w_reg_input, t1w_reg_mask : str
+        T1w image and registration mask, cropped unless args.no_crop is set.
+    ihmt_n4_masked : str
+        N4 corrected and masked ihMTR, on the registration grid.
+    transform : str
+        T1w to ihMT transform.
+    ihmt_image : str
+        ihMTR image, defining the full grid.
+    work_dir : str
+        Path to the working directory.
+
+    Returns:
+    --------
+    t1w_warped : str
+        The N4 corrected and masked T1w on the full ihMTR grid.
+    """
+    t1w_n4 = ants_helpers.n4_bias_correction(t1w_reg_input, t1w_reg_mask, work_dir)
+    t1w_n4_masked = ants_helpers.apply_mask(t1w_n4, t1w_reg_mask, work_dir)
+
+    t1w_warped = ants_helpers.apply_transforms(ihmt_n4_masked, t1w_n4_masked, [transform], work_dir,
+                                               interpolation=registration_helpers.RIGID_PARAMETERS['interpolation'])
+
+    if not args.no_crop:
+        t1w_warped = crop_helpers.uncrop_image_file(t1w_warped, ihmt_image, work_dir, 't1w_warped', args.scratch_format)
+
+    return t1w_warped
+
+
+def run_registration_sweep(args, t1w_bids, ihmt_image_bids, candidates, previous_transform, work_dir):
+    """Register the T1w to the ihMTR with each candidate mask strategy and metric, and select the best
+
+    The images are cropped and N4 corrected once per mask strategy, and shared by the candidates using it. The candidate
+    registrations run concurrently. Each is scored by the NMI of the ihMTR and the T1w resampled by its transform,
+    within all of the candidate ihMTR masks, so that the candidates are scored on the same voxels.
+
+    Parameters:
+    -----------
+    args : Namespace
+        Parsed command line arguments.
+    t1w_bids : BIDSImage
+        The T1w image.
+    ihmt_image_bids : BIDSImage
+        The ihMTR image.
+    candidates : list
+        [mask strategy, metric] of each candidate, from get_sweep_candidates.
+    previous_transform : str
+        Transform from a previous run, for the "cached" and "best" initialization.
+    work_dir : str
+        Path to the working directory.
 
+    Returns:
+    --------
+    results, best : tuple
+        A dict for each candidate, with keys 'mask_strategy', 'metric', 'nmi', 'correlation', 'selected', 'transform',
+        't1w_mask' and 'ihmt_mask', and the selected candidate, which also has 'ihmt_n4_masked' and 't1w_warped' on the
+        full ihMTR grid.
+    """
+    strategies = list(dict.fromkeys(candidate[0] for candidate in candidates))
+
+    masks = dict()
+
+    for strategy in strategies:
+        t1w_mask = get_t1w_registration_mask(args.input_dataset, t1w_bids, strategy)
+        if t1w_mask is None or not os.path.exists(t1w_mask.get_path()):
+            raise ValueError(f"T1w mask not found for participant {args.participant}, session {args.session}, "
+                             f"mask strategy {strategy}")
+        _, ihmt_mask_relpath = get_ihmt_registration_inputs(args.participant, args.session, strategy)
+        masks[strategy] = (t1w_mask, bids_helpers.BIDSImage(args.input_dataset, ihmt_mask_relpath))
+
+    score_masks = [ihmt_mask.get_path() for _, ihmt_mask in masks.values()]
+
+    def preprocess(strategy):
+        strategy_dir = os.path.join(work_dir, f"sweep_{strategy}")
+        os.makedirs(strategy_dir, exist_ok=True)
+        t1w_mask, ihmt_mask = masks[strategy]
+        preprocessed = dict()
+        for name, image, mask in (('ihmt', ihmt_image_bids.get_path(), ihmt_mask.get_path()),
+                                  ('t1w', t1w_bids.get_path(), t1w_mask.get_path())):
+            if not args.no_crop:
+                box = crop_helpers.image_bounding_box(mask, args.crop_padding)
+                image = crop_helpers.crop_image_file(image, box, strategy_dir, f"{name}_crop", args.scratch_format)
+                mask = crop_helpers.crop_image_file(mask, box, strategy_dir, f"{name}_mask_crop", args.scratch_format)
+            n4 = ants_helpers.n4_bias_correction(image, mask, strategy_dir)
+            preprocessed[name] = (ants_helpers.apply_mask(n4, mask, strategy_dir), mask)
+        return preprocessed
+
+    def register(candidate):
+        strategy, metric = candidate
+        candidate_dir = os.path.join(work_dir, f"sweep_{strategy}_{metric}")
+        os.makedirs(candidate_dir, exist_ok=True)
+        (ihmt_n4_masked, ihmt_reg_mask), (t1w_n4_masked, t1w_reg_mask) = (preprocessed[strategy]['ihmt'],
+                                                                          preprocessed[strategy]['t1w'])
+        transform, t1w_warped = register_t1w_to_ihmt(ihmt_n4_masked, t1w_n4_masked, ihmt_reg_mask, t1w_reg_mask,
+                                                     os.path.join(candidate_dir, 't1w_to_ihmt_'),
+                                                     args.registration_init, args.fine_only_nmi, previous_transform,
+                                                     candidate_dir, metric=metric)
+        scores = registration_helpers.alignment_metrics(ihmt_image_bids.get_path(), t1w_bids.get_path(), score_masks,
+                                                        transform)
+        logger.info(f"Registration with mask strategy {strategy}, metric {metric}: NMI {scores['nmi']:.4f}, "
+                    f"correlation {scores['correlation']:.4f}")
+        return {'mask_strategy': strategy, 'metric': metric, 'nmi': scores['nmi'],
+                'correlation': scores['correlation'], 'transform': transform, 't1w_warped': t1w_warped,
+                't1w_mask': masks[strategy][0], 'ihmt_mask': masks[strategy][1]}
+
+    with ThreadPoolExecutor(max_workers=max(1, args.sweep_threads)) as executor:
+        preprocessed = dict(zip(strategies, executor.map(preprocess, strategies)))
+        results = list(executor.map(register, candidates))
+
+    best = max(results, key=lambda result: result['nmi'])
+
+    for result in results:
+        result['selected'] = result is best
+
+    logger.info(f"Selected mask strategy {best['mask_strategy']}, metric {best['metric']}")
+
+    best['ihmt_n4_masked'] = preprocessed[best['mask_strategy']]['ihmt'][0]
+
+    # Put the selected registration output on the cropped ihMT grid back on the full grid
+    if not args.no_crop:
+        best['ihmt_n4_masked'] = crop_helpers.uncrop_image_file(best['ihmt_n4_masked'], ihmt_image_bids.get_path(),
+                                                                work_dir, 'ihmt_n4_masked', args.scratch_format)
+        best['t1w_warped'] = crop_helpers.uncrop_image_file(best['t1w_warped'], ihmt_image_bids.get_path(), work_dir,
+                                                            't1w_warped', args.scratch_format)
+
+    return results, best
+
+
+def write_sweep_table(results, sweep_file):
+    """Write the scores of the candidate registrations of a sweep to a TSV file
+
+    Parameters:
+    -----------
+    results : list
+        Candidate results from run_registration_sweep.
+    sweep_file : str
+        Output TSV file.
+
+    Returns:
+    --------
+    sweep_file : str
+        Path to the TSV file.
+    """
+    with open(sweep_file, 'w') as f:
+        f.write("mask_strategy\tmetric\tnmi\tcorrelation\tselected\n")
+        for result in results:
+            f.write(f"{result['mask_strategy']}\t{result['metric']}\t{result['nmi']:.4f}\t"
+                    f"{result['correlation']:.4f}\t{int(result['selected'])}\n")
+
+    return sweep_file
 
 
 def make_ihMTR_qc_plots(ihmt_bids, mask_image, work_dir):
@@ -342,6 +1241,11 @@ def make_ihMTR_qc_plots(ihmt_bids, mask_image, work_dir):
         Brain mask for the preprocessed ihMTR image.
     work_dir : str
         Path to the working directory.
+
+    Returns:
+    --------
+    qc_plots : list
+        Paths to the axial and coronal QC images.
     """
     # winsorize a bit to boost brightness of the brain
     scalar_image = ants_helpers.winsorize_intensity(ihmt_bids.get_path(), mask_image, work_dir, lower_percentile=0.0,
@@ -358,8 +1262,13 @@ def make_ihMTR_qc_plots(ihmt_bids, mask_image, work_dir):
     tiled_ihmtr_cor = ccreate_tiled_mosaic(scalar_image, mask_image, work_dir, overlay=ihmt_rgb,
                                                        overlay_alpha=1, axis=0, pad='mask+5', slice_spec=(3,'mask','mask'))
 
-    system_helpers.copy_file(tiled_ihmtr_ax, ihmt_bids.get_derivative_path_prefix() + f"_desc-{output_desc_ax}.png")
-    system_helpers.copy_file(tiled_ihmtr_cor, ihmt_bids.get_derivative_path_prefix() + f"_desc-{output_desc_cor}.png")
+    qc_plot_ax = ihmt_bids.get_derivative_path_prefix() + f"_desc-{output_desc_ax}.png"
+    qc_plot_cor = ihmt_bids.get_derivative_path_prefix() + f"_desc-{output_desc_cor}.png"
+
+    system_helpers.copy_file(tiled_ihmtr_ax, qc_plot_ax)
+    system_helpers.copy_file(tiled_ihmtr_cor, qc_plot_cor)
+
+    return [qc_plot_ax, qc_plot_cor]
 
 # ihmt_masked_bids = ihmt_bids
 # ihmt_mask = mask_bids
@@ -390,28 +1299,51 @@ def compute_qc_stats(ihmt_bids, mask_bids, seg_bids, work_dir, t1w_brain_ihmt_sp
         template.
     template_brain_mask: TemplateImage, optional
         ignored for now Brain mask for the template. Required if template is provided.
-    """
-    # Read in the images to compute stats
-    ihmt_image = ants_image_read(ihmt_bids.get_path())
-    mask_image = ants_image_read(mask_bids.get_path())
-    seg_image = ants_image_read(seg_bids.get_path())
-
-    mask_vol = mask_image[mask_image > 0].shape[0] * np.prod(mask_image.spacing) / 1000.0 # volume in ml
-    seg_vols = [seg_image[seg_image == i].shape[0] * np.prod(seg_image.spacing) / 1000.0 for i in (2, 3, 8, 9, 10, 11)]
 
-    cgm_mask = seg_image == 8
-    
-    cgm_mean_intensity = ihmt_image[cgm_mask].mean()
-    wm_mean_intensity = ihmt_image[seg_image == 2].mean()
+    Returns:
+    --------
+    qc_stats_file : str
+        Path to the QC stats TSV file.
+    """
+    # Read in the images to compute stats - uncompressed images are memory-mapped
+    ihmt_image, _ = scratch_helpers.load_array(ihmt_bids.get_path())
+    mask_image, mask_spacing = scratch_helpers.load_array(mask_bids.get_path())
+    seg_image, seg_spacing = scratch_helpers.load_array(seg_bids.get_path())
+
+    # All stats are within the mask or segmentation, so crop to them
+    qc_box = crop_helpers.bounding_box_slices(crop_helpers.union_bounding_box(crop_helpers.bounding_box(mask_image),
+                                                                              crop_helpers.bounding_box(seg_image)))
+    ihmt_image = ihmt_image[qc_box]
+    mask_image = mask_image[qc_box]
+    seg_image = seg_image[qc_box]
+
+    mask_vol = np.count_nonzero(mask_image) * np.prod(mask_spacing) / 1000.0 # volume in ml
+    del mask_image
+
+    # Voxel counts and intensity sums for all tissue classes in one pass, rather than a boolean mask per class
+    seg_labels = memory_helpers.to_label_array(seg_image).reshape(-1)
+    del seg_image
+    num_classes = max(int(seg_labels.max()) + 1, 12)
+    seg_counts = np.bincount(seg_labels, minlength=num_classes)
+    seg_sums = np.bincount(seg_labels, weights=ihmt_image.reshape(-1), minlength=num_classes)
+    del seg_labels, ihmt_image
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        seg_means = seg_sums / seg_counts
+
+    seg_vols = [seg_counts[i] * np.prod(seg_spacing) / 1000.0 for i in (2, 3, 8, 9, 10, 11)]
+
+    cgm_mean_intensity = seg_means[8]
+    wm_mean_intensity = seg_means[2]
     wm_gm_contrast = wm_mean_intensity / cgm_mean_intensity
-    csf_mean_intensity = ihmt_image[seg_image == 3].mean()
-    bs_mean_intensity = ihmt_image[seg_image == 10].mean()
-    sgm_mean_intensity = ihmt_image[seg_image == 9].mean()
-    cbm_mean_intensity = ihmt_image[seg_image == 11].mean()
+    csf_mean_intensity = seg_means[3]
+    bs_mean_intensity = seg_means[10]
+    sgm_mean_intensity = seg_means[9]
+    cbm_mean_intensity = seg_means[11]
 
 
     if thick_bids is not None:
-        thick_image = ants_image_read(thick_bids.get_path())
+        thick_image, _ = scratch_helpers.load_array(thick_bids.get_path())
         gm_thickness = thick_image[thick_image > 0.001]
         thick_mean = gm_thickness.mean()
         thick_std = gm_thickness.std()
@@ -425,8 +1357,10 @@ def compute_qc_stats(ihmt_bids, mask_bids, seg_bids, work_dir, t1w_brain_ihmt_sp
 
     non_csf_fraction = 1.0 - csf_vol / mask_vol
 
+    qc_stats_file = ihmt_bids.get_derivative_path_prefix() + '_desc-qc_brainstats.tsv'
+
     # Write the stats to a TSV file
-    with open(ihmt_bids.get_derivative_path_prefix() + '_desc-qc_brainstats.tsv', 'w') as f:
+    with open(qc_stats_file, 'w') as f:
         f.write("metric\tvalue\n")
         f.write(f"cgm_mean_intensity\t{cgm_mean_intensity:.4f}\n")
         f.write(f"wm_mean_intensity\t{wm_mean_intensity:.4f}\n")
@@ -451,6 +1385,8 @@ def compute_qc_stats(ihmt_bids, mask_bids, seg_bids, work_dir, t1w_brain_ihmt_sp
         if t1w_brain_ihmt_space_bids is not None:
             f.write(f"t1w_ihmt_corr\t{t1w_template_corr:.4f}\n")
 
+    return qc_stats_file
+
 
 def ccreate_tiled_mosaic(scalar_image, mask, work_dir, overlay=None, tile_shape=(-1, -1), overlay_alpha=0.25, axis=2,
                         pad='mask+4', slice_spec=(3,'mask+8','mask-8'), flip_spec=(1,1), title_bar_text=None,
@@ -511,11 +1447,11 @@ def ccreate_tiled_mosaic(scalar_image, mask, work_dir, overlay=None, tile_shape=
         pad_amount = 2 * (int(pad.split('+')[-1]) + 1)
         pad_spec = [pad_amount, pad_amount, pad_amount]
 
-        padded_scalar = pad_image(scalar_image, pad_spec, work_dir)
-        padded_mask = pad_image(mask, pad_spec, work_dir)
+        padded_scalar = ants_helpers.pad_image(scalar_image, pad_spec, work_dir)
+        padded_mask = ants_helpers.pad_image(mask, pad_spec, work_dir)
         padded_overlay = None
         if overlay is not None:
-            padded_overlay = pad_image(overlay, pad_spec, work_dir, image_is_rgb=True)
+            padded_overlay = ants_helpers.pad_image(overlay, pad_spec, work_dir, image_is_rgb=True)
 
         scalar_input = padded_scalar
         mask_input = padded_mask
@@ -0,0 +1,147 @@
+"""
+A cache of registration results, keyed by the contents of the registration inputs.
+
+The T1w to ihMT registration is the most expensive step of the registration stage, and it is often rerun with inputs
+that have not changed: after switching to a mask strategy that gives the same masks, or after outputs were removed from
+the output dataset. The cache key is a hash of the images and masks that go into N4 and antsRegistration, after
+cropping, and of the registration parameters, so a rerun with identical inputs reuses the transform and only redoes the
+resampling.
+
+Each entry is a directory
+
+    <cache_dir>/<key[:2]>/<key>/
+        0GenericAffine.mat  : the T1w to ihMT transform
+        entry.json          : the key, input checksums, parameters, and the NMI of the registered images
+
+Entries are written to a temporary directory and renamed into place, so concurrent jobs never see a partial entry. The
+cache does not depend on the output dataset, and may be shared by runs writing to different datasets.
+
+This module only uses the standard library.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import manifest_helpers
+
+logger = logging.getLogger(__name__)
+
+# Increment to invalidate existing entries when the meaning of the key changes
+CACHE_VERSION = 1
+
+TRANSFORM_FILE = '0GenericAffine.mat'
+ENTRY_FILE = 'entry.json'
+
+
+def get_cache_key(inputs, parameters):
+    """
+    Compute the cache key of a registration.
+
+    Args:
+        inputs (dict): name -> path of every file that determines the result, eg the N4 inputs and masks.
+        parameters (dict): JSON-serializable registration parameters.
+
+    Returns:
+        tuple: (key, checksums), the hex key and a dict of name -> sha256 of each input.
+    """
+    checksums = {name: manifest_helpers.compute_checksum(path) for name, path in inputs.items()}
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'version': CACHE_VERSION, 'inputs': checksums, 'parameters': parameters},
+                             sort_keys=True).encode('utf-8'))
+
+    return digest.hexdigest(), checksums
+
+
+def get_entry_dir(cache_dir, key):
+    """
+    Get the directory of a cache entry.
+
+    Args:
+        cache_dir (str): cache directory.
+        key (str): cache key.
+
+    Returns:
+        str: entry directory.
+    """
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def get_cached_registration(cache_dir, key):
+    """
+    Look up a registration in the cache.
+
+    Args:
+        cache_dir (str): cache directory.
+        key (str): cache key from get_cache_key.
+
+    Returns:
+        tuple: (transform, entry), the path to the cached transform and the entry metadata, or (None, None) if there is
+            no valid entry.
+    """
+    entry_dir = get_entry_dir(cache_dir, key)
+    transform = os.path.join(entry_dir, TRANSFORM_FILE)
+
+    try:
+        with open(os.path.join(entry_dir, ENTRY_FILE), 'r') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None, None
+
+    if entry.get('Key') != key or not os.path.exists(transform):
+        logger.warning(f"Ignoring invalid registration cache entry {entry_dir}")
+        return None, None
+
+    return transform, entry
+
+
+def store_registration(cache_dir, key, transform, checksums, parameters, nmi=None):
+    """
+    Add a registration to the cache.
+
+    If another job stored the same key first, its entry is kept.
+
+    Args:
+        cache_dir (str): cache directory.
+        key (str): cache key from get_cache_key.
+        transform (str): transform to store.
+        checksums (dict): input checksums from get_cache_key.
+        parameters (dict): registration parameters.
+        nmi (float, optional): NMI of the fixed image and the moving image after registration.
+
+    Returns:
+        str: entry directory.
+    """
+    entry_dir = get_entry_dir(cache_dir, key)
+
+    if os.path.exists(entry_dir):
+        return entry_dir
+
+    os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir), prefix='.tmp_')
+
+    try:
+        shutil.copyfile(transform, os.path.join(tmp_dir, TRANSFORM_FILE))
+        entry = {'Key': key,
+                 'CacheVersion': CACHE_VERSION,
+                 'Inputs': checksums,
+                 'Parameters': parameters,
+                 'NMI': nmi,
+                 'Created': datetime.datetime.now().isoformat(timespec='seconds')}
+        with open(os.path.join(tmp_dir, ENTRY_FILE), 'w') as f:
+            json.dump(entry, f, indent=2, sort_keys=True)
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.exists(entry_dir):
+            raise
+
+    logger.info(f"Stored registration in cache {entry_dir}")
+
+    return entry_dir
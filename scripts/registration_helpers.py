@@ -0,0 +1,284 @@
+"""
+Rigid registration and linear transform utilities, shared by the cross-sectional and longitudinal registration.
+
+Transforms follow the ANTs convention: a transform from-A_to-B is computed with B as the fixed image and A as the moving
+image, and is applied to images in A to resample them into B.
+
+Registration can be warm-started from an initial transform: the physical-space header alignment (identity), a
+center-of-mass (moments) match, or a transform cached from a previous run. Candidate starts are compared by the
+normalized mutual information (NMI) of the images after applying them, and when the start is already good, the coarse
+level of the registration is skipped.
+
+Registrations made with different masks or metrics are compared by alignment_metrics, which scores each transform on
+the same images and voxels.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+import lazy_imports
+
+system_helpers = lazy_imports.lazy_module('antsnetct.system_helpers')
+ants_apply_transforms = lazy_imports.lazy_function('ants', 'apply_transforms')
+ants_image_read = lazy_imports.lazy_function('ants', 'image_read')
+create_ants_transform = lazy_imports.lazy_function('ants', 'create_ants_transform')
+get_center_of_mass = lazy_imports.lazy_function('ants', 'get_center_of_mass')
+write_transform = lazy_imports.lazy_function('ants', 'write_transform')
+
+logger = logging.getLogger(__name__)
+
+INITIALIZATION_METHODS = ('header', 'moments', 'cached', 'best')
+
+# Settings of every rigid registration. The schedule varies, and is given separately
+RIGID_PARAMETERS = {'transform': 'Rigid[0.1]', 'metric': 'MI', 'metric_bins': 32, 'metric_sampling': 'Regular',
+                    'interpolation': 'Linear', 'winsorize': '[0.0,0.999]'}
+
+# Metrics that may replace the default, taking the same arguments
+METRICS = ('MI', 'Mattes', 'GC')
+
+# Full multi-resolution schedule, for registrations starting from the header alignment
+FULL_SCHEDULE = {'convergence': '[500x250x50,1e-6,10]', 'shrink_factors': '4x2x1', 'smoothing_sigmas': '2x1x0vox'}
+
+# Schedule without the coarse level, for registrations starting from a transform that is already close
+FINE_SCHEDULE = {'convergence': '[250x50,1e-6,10]', 'shrink_factors': '2x1', 'smoothing_sigmas': '1x0vox'}
+
+
+def rigid_registration(fixed_image, moving_image, fixed_mask, moving_mask, output_prefix, initial_moving_transform=None,
+                       schedule=None, warped_image=True, metric=None):
+    """
+    Rigidly register a moving image to a fixed image with antsRegistration.
+
+    Args:
+        fixed_image (str): fixed image.
+        moving_image (str): moving image.
+        fixed_mask (str): mask for the fixed image.
+        moving_mask (str): mask for the moving image.
+        output_prefix (str): output prefix for antsRegistration.
+        initial_moving_transform (str, optional): initial moving transform, as an antsRegistration argument, eg
+            'xfm.mat' or '[xfm.mat,1]' for its inverse. The output transform includes it.
+        schedule (dict, optional): 'convergence', 'shrink_factors' and 'smoothing_sigmas'. Default is FULL_SCHEDULE.
+        warped_image (bool): if True, write the moving image resampled into the fixed space.
+        metric (str, optional): one of METRICS. Default is the metric in RIGID_PARAMETERS.
+
+    Returns:
+        tuple: (transform, warped), paths to the output transform and the warped image, or None for the warped image if
+            it was not written.
+    """
+    if schedule is None:
+        schedule = FULL_SCHEDULE
+
+    if metric is None:
+        metric = RIGID_PARAMETERS['metric']
+    elif metric not in METRICS:
+        raise ValueError(f"Invalid registration metric: {metric}. Options are {METRICS}")
+
+    warped = f"{output_prefix}Warped.nii.gz" if warped_image else None
+    output_spec = f"[{output_prefix},{warped}]" if warped_image else output_prefix
+
+    cmd = ['antsRegistration',
+           '--dimensionality', '3',
+           '--float', '0',
+           '--output', output_spec,
+           '--interpolation', RIGID_PARAMETERS['interpolation'],
+           '--winsorize-image-intensities', RIGID_PARAMETERS['winsorize']]
+
+    if initial_moving_transform is not None:
+        cmd.extend(['--initial-moving-transform', initial_moving_transform])
+
+    cmd.extend(['--masks', f"[{fixed_mask},{moving_mask}]",
+                '--transform', RIGID_PARAMETERS['transform'],
+                '--metric', f"{metric}[{fixed_image},{moving_image},1,"
+                            f"{RIGID_PARAMETERS['metric_bins']},{RIGID_PARAMETERS['metric_sampling']}]",
+                '--convergence', schedule['convergence'],
+                '--shrink-factors', schedule['shrink_factors'],
+                '--smoothing-sigmas', schedule['smoothing_sigmas']])
+
+    system_helpers.run_command(cmd)
+
+    return f"{output_prefix}0GenericAffine.mat", warped
+
+
+def compose_linear_transforms(reference_image, transforms, output_file):
+    """
+    Compose linear transforms into a single affine transform.
+
+    Args:
+        reference_image (str): image in the output space.
+        transforms (list): transforms in antsApplyTransforms order, ie the last is applied first.
+        output_file (str): output .mat file.
+
+    Returns:
+        str: path to the composed transform.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+
+    cmd = ['antsApplyTransforms', '--dimensionality', '3', '--reference-image', reference_image,
+           '--output', f"Linear[{output_file}]"]
+    for transform in transforms:
+        cmd.extend(['--transform', transform])
+
+    system_helpers.run_command(cmd)
+
+    return output_file
+
+
+def write_identity_transform(output_file):
+    """
+    Write an identity affine transform.
+
+    Args:
+        output_file (str): output .mat file.
+
+    Returns:
+        str: path to the transform.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    write_transform(create_ants_transform(transform_type='AffineTransform', dimension=3), output_file)
+    return output_file
+
+
+def write_moments_transform(fixed_image, moving_image, output_file):
+    """
+    Write a translation that aligns the intensity centers of mass of two images.
+
+    Args:
+        fixed_image (str): fixed image.
+        moving_image (str): moving image.
+        output_file (str): output .mat file.
+
+    Returns:
+        str: path to the transform.
+    """
+    fixed_center = np.asarray(get_center_of_mass(ants_image_read(fixed_image)))
+    moving_center = np.asarray(get_center_of_mass(ants_image_read(moving_image)))
+
+    # Transforms map points in the fixed space to the moving space
+    transform = create_ants_transform(transform_type='AffineTransform', dimension=3,
+                                      translation=tuple(moving_center - fixed_center))
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    write_transform(transform, output_file)
+    return output_file
+
+
+def normalized_mutual_information(fixed_image, moving_image, fixed_mask, transform, bins=32):
+    """
+    Compute the normalized mutual information between a fixed image and a moving image resampled by a transform.
+
+    NMI is (H(fixed) + H(moving)) / H(fixed, moving), which is 1 for independent images and 2 for identical ones.
+
+    Args:
+        fixed_image (str): fixed image.
+        moving_image (str): moving image.
+        fixed_mask (str): mask for the fixed image. NMI is computed over the voxels in the mask.
+        transform (str): transform from the moving to the fixed space.
+        bins (int): number of histogram bins per image.
+
+    Returns:
+        float: NMI.
+    """
+    fixed = ants_image_read(fixed_image)
+    warped = ants_apply_transforms(fixed, ants_image_read(moving_image), [transform])
+
+    in_mask = ants_image_read(fixed_mask).numpy() > 0
+
+    return _histogram_nmi(fixed.numpy()[in_mask], warped.numpy()[in_mask], bins)
+
+
+def alignment_metrics(fixed_image, moving_image, fixed_masks, transform, bins=32):
+    """
+    Score the alignment of a moving image resampled by a transform to a fixed image.
+
+    Transforms from registrations with different masks are scored over the voxels in all of their masks, so that they
+    are compared on the same voxels.
+
+    Args:
+        fixed_image (str): fixed image.
+        moving_image (str): moving image.
+        fixed_masks (list): masks for the fixed image. Metrics are computed over the voxels in all of them.
+        transform (str): transform from the moving to the fixed space.
+        bins (int): number of histogram bins per image, for the NMI.
+
+    Returns:
+        dict: 'nmi', the normalized mutual information, and 'correlation', the Pearson correlation of the intensities.
+    """
+    fixed = ants_image_read(fixed_image)
+    warped = ants_apply_transforms(fixed, ants_image_read(moving_image), [transform])
+
+    in_mask = np.ones(fixed.shape, dtype=bool)
+    for fixed_mask in fixed_masks:
+        in_mask &= ants_image_read(fixed_mask).numpy() > 0
+
+    fixed_values = fixed.numpy()[in_mask]
+    moving_values = warped.numpy()[in_mask]
+
+    if fixed_values.size < 2 or fixed_values.std() == 0 or moving_values.std() == 0:
+        correlation = 0.0
+    else:
+        correlation = float(np.corrcoef(fixed_values, moving_values)[0, 1])
+
+    return {'nmi': _histogram_nmi(fixed_values, moving_values, bins), 'correlation': correlation}
+
+
+def _histogram_nmi(fixed_values, moving_values, bins):
+    joint, _, _ = np.histogram2d(fixed_values, moving_values, bins=bins)
+    joint = joint / max(joint.sum(), 1)
+
+    def entropy(p):
+        p = p[p > 0]
+        return -np.sum(p * np.log(p))
+
+    joint_entropy = entropy(joint.ravel())
+    if joint_entropy == 0:
+        return 1.0
+
+    return float((entropy(joint.sum(axis=1)) + entropy(joint.sum(axis=0))) / joint_entropy)
+
+
+def get_initial_transform(fixed_image, moving_image, fixed_mask, method, work_dir, cached_transform=None):
+    """
+    Get an initial transform for registration, and its NMI.
+
+    Args:
+        fixed_image (str): fixed image.
+        moving_image (str): moving image.
+        fixed_mask (str): mask for the fixed image.
+        method (str): 'header' for the physical-space header alignment, 'moments' for a center-of-mass match, 'cached'
+            for `cached_transform`, or 'best' for whichever of these gives the highest NMI.
+        work_dir (str): working directory.
+        cached_transform (str, optional): transform from a previous registration of the same images. If method is
+            'cached' and it does not exist, the header alignment is used.
+
+    Returns:
+        tuple: (method, transform, nmi), the method used, the path to the initial transform, and its NMI.
+    """
+    if method not in INITIALIZATION_METHODS:
+        raise ValueError(f"Invalid initialization method: {method}. Options are {INITIALIZATION_METHODS}")
+
+    cached_available = cached_transform is not None and os.path.exists(cached_transform)
+
+    if method == 'best':
+        candidates = ['header', 'moments'] + (['cached'] if cached_available else [])
+    elif method == 'cached' and not cached_available:
+        logger.info('No cached transform, initializing from the header')
+        candidates = ['header']
+    else:
+        candidates = [method]
+
+    results = list()
+
+    for candidate in candidates:
+        transform_file = os.path.join(work_dir, f"initial_{candidate}_0GenericAffine.mat")
+        if candidate == 'header':
+            write_identity_transform(transform_file)
+        elif candidate == 'moments':
+            write_moments_transform(fixed_image, moving_image, transform_file)
+        else:
+            # Copy, since the cached transform may be overwritten by the output of this run
+            system_helpers.copy_file(cached_transform, transform_file)
+        nmi = normalized_mutual_information(fixed_image, moving_image, fixed_mask, transform_file)
+        logger.info(f"Initial NMI from {candidate}: {nmi:.4f}")
+        results.append((candidate, transform_file, nmi))
+
+    return max(results, key=lambda result: result[2])
@@ -0,0 +1,121 @@
+"""
+Scratch storage for intermediate images.
+
+Intermediates that only live in the working directory are written as uncompressed NIfTI by default, so readers memory-map
+them rather than decompressing and copying the whole volume. Only images that are published to a BIDS dataset are
+compressed, once, on the way out.
+
+Uncompressed NIfTI rather than raw .npy is used for scratch, because the intermediates are also read by ANTs
+command-line tools, which need the header.
+"""
+
+import gzip
+import os
+import shutil
+
+import numpy as np
+
+import lazy_imports
+
+nib = lazy_imports.lazy_module('nibabel')
+bids_helpers = lazy_imports.lazy_module('antsnetct.bids_helpers')
+system_helpers = lazy_imports.lazy_module('antsnetct.system_helpers')
+ants_image_write = lazy_imports.lazy_function('ants', 'image_write')
+
+SCRATCH_FORMATS = ('nii', 'nii.gz')
+
+
+def get_scratch_file(work_dir, prefix, scratch_format='nii'):
+    """
+    Get a unique path for a scratch image in the working directory.
+
+    Args:
+        work_dir (str): working directory.
+        prefix (str): prefix for the file name.
+        scratch_format (str): 'nii' for uncompressed, or 'nii.gz'.
+
+    Returns:
+        str: path to the scratch image.
+    """
+    if scratch_format not in SCRATCH_FORMATS:
+        raise ValueError(f"Invalid scratch format: {scratch_format}. Options are {SCRATCH_FORMATS}")
+    return system_helpers.get_temp_file(work_dir, prefix=prefix) + f"_{prefix}.{scratch_format}"
+
+
+def write_scratch_image(image, work_dir, prefix, scratch_format='nii'):
+    """
+    Write an ANTsImage to the working directory.
+
+    Args:
+        image (ANTsImage): image to write.
+        work_dir (str): working directory.
+        prefix (str): prefix for the file name.
+        scratch_format (str): 'nii' for uncompressed, or 'nii.gz'.
+
+    Returns:
+        str: path to the scratch image.
+    """
+    scratch_file = get_scratch_file(work_dir, prefix, scratch_format)
+    ants_image_write(image, scratch_file)
+    return scratch_file
+
+
+def compress_image(image_file, work_dir):
+    """
+    Get a compressed copy of an image, if it is not already compressed.
+
+    The uncompressed NIfTI bytes are gzipped directly, without decoding the image.
+
+    Args:
+        image_file (str): NIfTI image, compressed or not.
+        work_dir (str): working directory.
+
+    Returns:
+        str: path to a .nii.gz image with the same contents. If the input is already compressed, it is returned as is.
+    """
+    if image_file.endswith('.nii.gz'):
+        return image_file
+    if not image_file.endswith('.nii'):
+        raise ValueError(f"Not a NIfTI image: {image_file}")
+
+    compressed_file = os.path.join(work_dir, os.path.basename(image_file) + '.gz')
+
+    with open(image_file, 'rb') as f_in, gzip.open(compressed_file, 'wb', compresslevel=6) as f_out:
+        shutil.copyfileobj(f_in, f_out, length=1 << 20)
+
+    return compressed_file
+
+
+def image_to_bids(image_file, output_dataset, rel_path, work_dir, metadata=None):
+    """
+    Publish a scratch image to a BIDS dataset, compressing it if needed.
+
+    Args:
+        image_file (str): scratch image, compressed or not.
+        output_dataset (str): BIDS dataset.
+        rel_path (str): path of the image in the dataset, ending in .nii.gz.
+        work_dir (str): working directory, used for the compressed copy.
+        metadata (dict, optional): sidecar metadata.
+
+    Returns:
+        BIDSImage: the image in the dataset.
+    """
+    return bids_helpers.image_to_bids(compress_image(image_file, work_dir), output_dataset, rel_path,
+                                      metadata=metadata)
+
+
+def load_array(image_file):
+    """
+    Load the voxel array of an image, memory-mapped if it is uncompressed.
+
+    For an uncompressed image, only the pages of the file that are accessed are read. Compressed images are read in
+    full.
+
+    Args:
+        image_file (str): NIfTI image.
+
+    Returns:
+        tuple: (array, spacing), where spacing is the voxel size in mm.
+    """
+    image = nib.load(image_file, mmap='r')
+    return np.asanyarray(image.dataobj), tuple(float(z) for z in image.header.get_zooms()[:3])
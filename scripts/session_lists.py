@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+Streaming reader for participant,session lists, with sharding, deduplication and completion filtering.
+
+Session lists are CSV files with a participant and a session per line, and no header. Blank lines, lines with fewer
+than two fields, and lines starting with '#' are ignored, and repeated sessions are only read once.
+
+A list can be split into N disjoint shards, so that several jobs or nodes each process a slice of a large cohort
+without coordinating. Shard i of N (1 <= i <= N, so that an LSF job array index can be used directly) is chosen by
+
+    hash  : a hash of the participant, so all sessions of a participant are in the same shard, and a session stays in
+            the same shard when the list is reordered or extended.
+    range : the i-th contiguous block of the list, so shards differ in size by at most one session.
+
+The list is read line by line, so it is never held in memory, except for the set of sessions already seen. Range shards
+read the list twice, first to count its sessions.
+
+Sessions that a stage has already completed can be filtered out with their completion manifests. This checks inputs
+and outputs, but not stage parameters, which the stage itself checks before skipping a session.
+
+To write shard 2 of 8 of a list to stdout:
+
+    session_lists.py --session-list lists/all_sessions.txt --shard 2/8
+
+This module only uses the standard library, so lists can be read outside the container.
+"""
+
+import argparse
+import csv
+import hashlib
+import logging
+import sys
+
+import manifest_helpers
+
+logger = logging.getLogger(__name__)
+
+SHARD_METHODS = ('hash', 'range')
+
+
+def parse_shard(shard):
+    """
+    Parse a shard specification.
+
+    Args:
+        shard (str): 'i/N', for shard i of N, with 1 <= i <= N.
+
+    Returns:
+        tuple: (i, N).
+    """
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard {shard}, expected i/N")
+
+    if count < 1 or index < 1 or index > count:
+        raise ValueError(f"Invalid shard {shard}, expected 1 <= i <= N")
+
+    return index, count
+
+
+def get_hash_shard(participant, count):
+    """
+    Get the hash shard of a participant.
+
+    The hash does not depend on the Python process, so every job assigns a participant to the same shard.
+
+    Args:
+        participant (str): participant ID.
+        count (int): number of shards.
+
+    Returns:
+        int: shard index, from 1 to count.
+    """
+    digest = hashlib.sha256(participant.encode('utf-8')).hexdigest()
+    return int(digest[:16], 16) % count + 1
+
+
+def _iter_rows(session_list, dedup):
+    seen = set()
+    num_duplicates = 0
+
+    with open(session_list, 'r', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0].lstrip().startswith('#'):
+                continue
+            participant_session = (row[0].strip(), row[1].strip())
+            if participant_session[0] == '' or participant_session[1] == '':
+                continue
+            if dedup:
+                if participant_session in seen:
+                    num_duplicates += 1
+                    continue
+                seen.add(participant_session)
+            yield participant_session
+
+    if num_duplicates > 0:
+        logger.info(f"Ignored {num_duplicates} repeated sessions in {session_list}")
+
+
+def iter_session_list(session_list, shard=None, shard_method='hash', dedup=True):
+    """
+    Read a participant,session CSV file with no header, one session at a time.
+
+    Args:
+        session_list (str): path to the CSV file.
+        shard (str or tuple, optional): 'i/N' or (i, N), to only read shard i of N.
+        shard_method (str): 'hash' or 'range', see the module documentation.
+        dedup (bool): only read the first occurrence of each session.
+
+    Yields:
+        tuple: (participant, session), in file order.
+    """
+    if shard is None:
+        yield from _iter_rows(session_list, dedup)
+        return
+
+    if shard_method not in SHARD_METHODS:
+        raise ValueError(f"Invalid shard method: {shard_method}. Options are {SHARD_METHODS}")
+
+    index, count = parse_shard(shard) if isinstance(shard, str) else shard
+
+    if shard_method == 'hash':
+        for participant, session in _iter_rows(session_list, dedup):
+            if get_hash_shard(participant, count) == index:
+                yield participant, session
+        return
+
+    num_sessions = sum(1 for _ in _iter_rows(session_list, dedup))
+    start = (index - 1) * num_sessions // count
+    end = index * num_sessions // count
+
+    for position, participant_session in enumerate(_iter_rows(session_list, dedup)):
+        if position >= end:
+            break
+        if position >= start:
+            yield participant_session
+
+
+def read_session_list(session_list, shard=None, shard_method='hash', dedup=True):
+    """
+    Read a participant,session CSV file with no header.
+
+    Args:
+        session_list (str): path to the CSV file.
+        shard (str or tuple, optional): 'i/N' or (i, N), to only read shard i of N.
+        shard_method (str): 'hash' or 'range', see the module documentation.
+        dedup (bool): only read the first occurrence of each session.
+
+    Returns:
+        list: (participant, session) tuples, in file order.
+    """
+    return list(iter_session_list(session_list, shard=shard, shard_method=shard_method, dedup=dedup))
+
+
+def filter_incomplete_sessions(sessions, dataset, stage, session_dir_marks_partial=True):
+    """
+    Drop the sessions that a stage has completed, according to their completion manifests.
+
+    Args:
+        sessions (iterable): (participant, session) tuples.
+        dataset (str): dataset the stage writes to.
+        stage (str): stage name.
+        session_dir_marks_partial (bool): passed to manifest_helpers.check_session.
+
+    Yields:
+        tuple: (participant, session) of the sessions that are not done.
+    """
+    for participant, session in sessions:
+        status, _ = manifest_helpers.check_session(dataset, stage, participant, session,
+                                                   session_dir_marks_partial=session_dir_marks_partial)
+        if status != manifest_helpers.STATUS_DONE:
+            yield participant, session
+
+
+def session_lists():
+    parser = argparse.ArgumentParser(description='Write a shard of a participant,session list to stdout, without '
+                                     'repeated sessions, and optionally without the sessions a stage has completed')
+    parser.add_argument('--session-list', help='CSV file with participants and sessions, one per line, no header',
+                        type=str, required=True)
+    parser.add_argument('--shard', help='Only write shard i of N, as i/N with 1 <= i <= N', type=str, default=None)
+    parser.add_argument('--shard-method', help='How sessions are assigned to shards', type=str, default='hash',
+                        choices=SHARD_METHODS)
+    parser.add_argument('--dataset', help='With --stage, skip sessions with a complete manifest in this dataset',
+                        type=str, default=None)
+    parser.add_argument('--stage', help='Stage of the completion manifests, eg register', type=str, default=None)
+    args = parser.parse_args()
+
+    if (args.dataset is None) != (args.stage is None):
+        raise ValueError('--dataset and --stage must be used together')
+
+    sessions = iter_session_list(args.session_list, shard=args.shard, shard_method=args.shard_method)
+
+    if args.stage is not None:
+        # The label stats write into session directories made by the registration
+        sessions = filter_incomplete_sessions(sessions, args.dataset, args.stage,
+                                              session_dir_marks_partial=args.stage != 'labelstats')
+
+    for participant, session in sessions:
+        sys.stdout.write(f"{participant},{session}\n")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    session_lists()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+import argparse
+import importlib
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import traceback
+
+import task_queue
+import work_dir_helpers
+
+logger = logging.getLogger(__name__)
+
+# Stage name -> module whose t1w_to_ihmt_pipeline() runs one session, reading its arguments from sys.argv
+STAGE_MODULES = {'register': 'register_t1w_to_ihmt_plus', 'labelstats': 'label_stats_plus'}
+
+# Exit code of a worker process that stopped to be replaced by a fresh one, rather than because the queue is empty
+RECYCLE_EXIT_CODE = 75
+
+# Helps with CLI help formatting
+class RawDefaultsHelpFormatter(
+    argparse.RawTextHelpFormatter, argparse.ArgumentDefaultsHelpFormatter
+):
+    pass
+
+def session_worker():
+
+    parser = argparse.ArgumentParser(formatter_class=RawDefaultsHelpFormatter, add_help = False,
+                                     description='''Run pipeline sessions from a queue in long-lived worker processes.
+
+    Each stage script imports antsnetct, ANTsPy and pandas, which can take longer than the work itself for short stages
+    such as label stats. A worker imports the stages once and runs queued sessions back to back.
+
+    Sessions are added to a queue directory with 'submit', which only needs the Python standard library:
+
+        session_worker.py submit --queue-dir Q --stage labelstats --session-list list.csv -- \\
+            --input-dataset /path/to/t1wToihMT --label-def-dir /path/to/label_def
+
+    Arguments after '--' are passed to the stage script, with --participant and --session added for each session.
+
+    'work' then runs the queued sessions until the queue is empty:
+
+        session_worker.py work --queue-dir Q --max-tasks 50 --max-rss-mb 4000
+
+    Any number of workers can share a queue. Each session runs in a worker process that is replaced by a fresh one
+    after --max-tasks sessions, or when its memory exceeds --max-rss-mb, so that memory held by the libraries does not
+    accumulate. The peak memory in each session's manifest is the peak of its worker process up to that session.
+
+    Finished sessions are recorded under <queue>/done and <queue>/failed. A worker that receives SIGTERM, as when LSF
+    kills the job, puts its running session back in the queue and exits without claiming another. Sessions left in
+    <queue>/running by a worker that was killed outright can be put back with 'requeue --state running', once no workers
+    are running.
+
+    ''')
+    parser.add_argument('-h', '--help', action='help', help='show this help message and exit')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    submit_parser = subparsers.add_parser('submit', formatter_class=RawDefaultsHelpFormatter,
+                                          help='Add sessions to the queue')
+    submit_parser.add_argument('--queue-dir', help='Queue directory', type=str, required=True)
+    submit_parser.add_argument('--stage', help='Stage to run', type=str, required=True, choices=list(STAGE_MODULES))
+    submit_parser.add_argument('--session-list', help='CSV file with participants and sessions to run, one per line, '
+                               'no header', type=str, required=True)
+    submit_parser.add_argument('stage_args', help='Arguments for the stage script, after --', nargs=argparse.REMAINDER)
+
+    for command, command_help in (('work', 'Run queued sessions until the queue is empty'),
+                                  ('serve', argparse.SUPPRESS)):
+        worker_parser = subparsers.add_parser(command, formatter_class=RawDefaultsHelpFormatter, help=command_help)
+        worker_parser.add_argument('--queue-dir', help='Queue directory', type=str, required=True)
+        worker_parser.add_argument('--max-tasks', help='Number of sessions to run before replacing the worker process',
+                                   type=int, default=50)
+        worker_parser.add_argument('--max-rss-mb', help='Replace the worker process after a session if its memory '
+                                   'exceeds this', type=float, default=None)
+        worker_parser.add_argument('--idle-wait', help='Seconds to wait for new sessions when the queue is empty, '
+                                   'before exiting', type=float, default=0)
+
+    requeue_parser = subparsers.add_parser('requeue', formatter_class=RawDefaultsHelpFormatter,
+                                           help='Put running or failed sessions back in the queue')
+    requeue_parser.add_argument('--queue-dir', help='Queue directory', type=str, required=True)
+    requeue_parser.add_argument('--state', help='State of the sessions to requeue', type=str, required=True,
+                                choices=[task_queue.STATE_RUNNING, task_queue.STATE_FAILED])
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+        print(f"\nRun {os.path.basename(sys.argv[0])} --help for more information")
+        sys.exit(1)
+
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        stage_args = args.stage_args[1:] if args.stage_args[:1] == ['--'] else args.stage_args
+        submit_sessions(args.queue_dir, args.stage, args.session_list, stage_args)
+    elif args.command == 'work':
+        run_workers(args.queue_dir, args.max_tasks, args.max_rss_mb, args.idle_wait)
+    elif args.command == 'serve':
+        sys.exit(serve(args.queue_dir, args.max_tasks, args.max_rss_mb, args.idle_wait))
+    else:
+        requeued = task_queue.requeue_tasks(args.queue_dir, args.state)
+        print(f"Requeued {len(requeued)} {args.state} sessions in {args.queue_dir}")
+
+
+def submit_sessions(queue_dir, stage, session_list, stage_args):
+    """
+    Add a task to the queue for each session in a session list.
+
+    Args:
+        queue_dir (str): queue directory.
+        stage (str): stage to run.
+        session_list (str): CSV file with participants and sessions, one per line, no header.
+        stage_args (list): arguments for the stage script, other than the participant and session.
+    """
+    # The session list reader is shared with the status report
+    from session_lists import read_session_list
+
+    sessions = read_session_list(session_list)
+
+    for participant, session in sessions:
+        task_queue.add_task(queue_dir, stage, participant, session,
+                            list(stage_args) + ['--participant', participant, '--session', session])
+
+    print(f"Added {len(sessions)} {stage} sessions to {queue_dir}")
+
+
+def run_workers(queue_dir, max_tasks, max_rss_mb, idle_wait):
+    """
+    Run worker processes one after another, until one exits because the queue is empty.
+
+    Args:
+        queue_dir (str): queue directory.
+        max_tasks (int): number of sessions per worker process.
+        max_rss_mb (float): memory above which a worker process is replaced, or None.
+        idle_wait (float): seconds a worker waits for new sessions before exiting.
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), 'serve', '--queue-dir', queue_dir, '--max-tasks', str(max_tasks),
+           '--idle-wait', str(idle_wait)]
+    if max_rss_mb is not None:
+        cmd.extend(['--max-rss-mb', str(max_rss_mb)])
+
+    while True:
+        retval = subprocess.call(cmd)
+        if retval != RECYCLE_EXIT_CODE:
+            break
+        logger.info('Starting a new worker process')
+
+    if retval != 0:
+        raise RuntimeError(f"Worker process exited with code {retval}")
+
+
+def serve(queue_dir, max_tasks, max_rss_mb, idle_wait):
+    """
+    Import the stages and run queued sessions in this process.
+
+    Args:
+        queue_dir (str): queue directory.
+        max_tasks (int): number of sessions to run before exiting for a fresh process.
+        max_rss_mb (float): memory above which to exit for a fresh process, or None.
+        idle_wait (float): seconds to wait for new sessions when the queue is empty.
+
+    Returns:
+        int: RECYCLE_EXIT_CODE if the process should be replaced, 0 if the queue is empty.
+    """
+    import memory_helpers
+
+    start_time = time.time()
+    stage_functions = {stage: importlib.import_module(module).t1w_to_ihmt_pipeline
+                       for stage, module in STAGE_MODULES.items()}
+    logger.info(f"Imported stages in {time.time() - start_time:.1f} s")
+
+    # Stop on SIGTERM, rather than only failing the running session and claiming the next one
+    signal.signal(signal.SIGTERM, work_dir_helpers.raise_terminated)
+
+    worker_id = f"{socket.gethostname()}_{os.getpid()}"
+    tasks_run = 0
+    idle_since = None
+
+    while tasks_run < max_tasks:
+        task_name, task = task_queue.claim_task(queue_dir, worker_id)
+
+        if task is None:
+            if idle_since is None:
+                idle_since = time.time()
+            if time.time() - idle_since >= idle_wait:
+                logger.info(f"Queue is empty, exiting after {tasks_run} sessions")
+                return 0
+            time.sleep(min(10.0, idle_wait))
+            continue
+
+        idle_since = None
+        logger.info(f"Running {task['Stage']} for participant {task['Participant']}, session {task['Session']}")
+
+        task_start = time.time()
+        try:
+            succeeded, error = run_task(stage_functions[task['Stage']], STAGE_MODULES[task['Stage']], task['Args'])
+        except work_dir_helpers.Terminated:
+            task_queue.release_task(queue_dir, task_name)
+            logger.info(f"Worker terminated, returned {task_name} to the queue")
+            raise
+        elapsed = time.time() - task_start
+
+        task_queue.finish_task(queue_dir, task_name, task, succeeded, elapsed, error=error)
+        tasks_run += 1
+
+        rss_mb = memory_helpers.current_rss_mb()
+        logger.info(f"Finished {task_name} ({'done' if succeeded else 'failed'}) in {elapsed:.1f} s, "
+                    f"worker memory {rss_mb:.0f} MB")
+
+        if max_rss_mb is not None and rss_mb > max_rss_mb:
+            logger.info(f"Worker memory {rss_mb:.0f} MB exceeds {max_rss_mb} MB, replacing the worker process")
+            return RECYCLE_EXIT_CODE
+
+    logger.info(f"Ran {tasks_run} sessions, replacing the worker process")
+    return RECYCLE_EXIT_CODE
+
+
+def run_task(stage_function, module_name, stage_args):
+    """
+    Run one session of a stage, as if its script was called with the given arguments.
+
+    Args:
+        stage_function (callable): the stage's pipeline function.
+        module_name (str): the stage's module, used as the script name.
+        stage_args (list): command line arguments for the stage.
+
+    Returns:
+        tuple: (succeeded, error), with error a message, or None if the stage succeeded.
+
+    Raises:
+        work_dir_helpers.Terminated: if the process was terminated while the stage ran.
+    """
+    saved_argv = sys.argv
+    sys.argv = [f"{module_name}.py"] + list(stage_args)
+
+    try:
+        stage_function()
+        return True, None
+    except work_dir_helpers.Terminated:
+        raise
+    except SystemExit as e:
+        if e.code in (None, 0):
+            return True, None
+        if e.code == work_dir_helpers.TERMINATED_EXIT_CODE:
+            raise work_dir_helpers.Terminated(e.code)
+        return False, f"Exited with code {e.code}"
+    except Exception as e:
+        traceback.print_exc()
+        return False, f"{type(e).__name__}: {e}"
+    finally:
+        sys.argv = saved_argv
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    session_worker()
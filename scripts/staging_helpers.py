@@ -0,0 +1,156 @@
+"""
+Bulk staging of existing files into a BIDS dataset.
+
+Gathered images are byte-for-byte copies of files in other datasets, so rather than decoding and rewriting them, they
+are linked or copied as files. Files are staged concurrently, preferring a hard link when source and destination are on
+the same filesystem, then a reflink (copy-on-write clone) where the filesystem supports it, then a streamed copy. Copies
+are verified by checksum, computed as the data is copied.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+STAGE_MODES = ('auto', 'hardlink', 'reflink', 'copy')
+
+# ioctl request to clone a file, from linux/fs.h
+_FICLONE = 0x40049409
+
+
+def _checksum_file(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _hardlink(src, dest):
+    os.link(src, dest)
+
+
+def _reflink(src, dest):
+    with open(src, 'rb') as f_src, open(dest, 'wb') as f_dest:
+        try:
+            fcntl.ioctl(f_dest.fileno(), _FICLONE, f_src.fileno())
+        except OSError:
+            f_dest.close()
+            os.remove(dest)
+            raise
+
+
+def _copy_with_checksum(src, dest, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(src, 'rb') as f_src, open(dest, 'wb') as f_dest:
+        for block in iter(lambda: f_src.read(block_size), b''):
+            digest.update(block)
+            f_dest.write(block)
+    shutil.copystat(src, dest)
+    return digest.hexdigest()
+
+
+def stage_file(src, dest, mode='auto', verify=True):
+    """
+    Stage one file, replacing the destination if it exists.
+
+    Args:
+        src (str): source file.
+        dest (str): destination file.
+        mode (str): 'auto' tries a hard link, then a reflink, then a copy. 'hardlink', 'reflink' and 'copy' use only
+            that method, except that 'hardlink' and 'reflink' fall back to a copy if the link fails.
+        verify (bool): if True, verify copies by checksum.
+
+    Returns:
+        tuple: (method, checksum), where method is the method used, and checksum is the sha256 of the file, or None if
+            it was linked without verification.
+    """
+    if mode not in STAGE_MODES:
+        raise ValueError(f"Invalid stage mode: {mode}. Options are {STAGE_MODES}")
+
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+    # Write to a temporary name, so an interrupted copy never leaves a partial file at the destination
+    tmp_dest = os.path.join(os.path.dirname(dest), f".tmp_{os.path.basename(dest)}")
+    if os.path.lexists(tmp_dest):
+        os.remove(tmp_dest)
+
+    attempts = list()
+    if mode in ('auto', 'hardlink'):
+        attempts.append(('hardlink', _hardlink))
+    if mode in ('auto', 'reflink'):
+        attempts.append(('reflink', _reflink))
+
+    for method, link in attempts:
+        try:
+            link(src, tmp_dest)
+            os.replace(tmp_dest, dest)
+            return method, None
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                               errno.EMLINK, errno.ENOSYS):
+                raise
+            logger.debug(f"Could not {method} {src} to {dest}: {e}")
+
+    checksum = _copy_with_checksum(src, tmp_dest)
+
+    if verify and _checksum_file(tmp_dest) != checksum:
+        os.remove(tmp_dest)
+        raise IOError(f"Checksum mismatch copying {src} to {dest}")
+
+    os.replace(tmp_dest, dest)
+
+    return 'copy', checksum
+
+
+def write_sidecar(image_file, metadata):
+    """
+    Write the JSON sidecar for a NIfTI image in a BIDS dataset.
+
+    Args:
+        image_file (str): image path, ending in .nii.gz or .nii.
+        metadata (dict): sidecar contents.
+
+    Returns:
+        str: path to the sidecar.
+    """
+    if image_file.endswith('.nii.gz'):
+        sidecar_file = image_file[:-len('.nii.gz')] + '.json'
+    else:
+        sidecar_file = os.path.splitext(image_file)[0] + '.json'
+    with open(sidecar_file, 'w') as f:
+        json.dump(metadata, f, indent=4, sort_keys=True)
+    return sidecar_file
+
+
+def stage_files(jobs, threads=4, mode='auto', verify=True):
+    """
+    Stage a batch of files concurrently, with their sidecars.
+
+    Args:
+        jobs (list): dicts with keys 'src', 'dest', and optionally 'metadata' for the sidecar.
+        threads (int): number of files to stage concurrently.
+        mode (str): staging mode, see stage_file.
+        verify (bool): if True, verify copies by checksum.
+
+    Returns:
+        dict: dest -> sha256 of the staged file, for files whose checksum was computed during staging.
+    """
+    def stage_job(job):
+        method, checksum = stage_file(job['src'], job['dest'], mode=mode, verify=verify)
+        if job.get('metadata') is not None:
+            write_sidecar(job['dest'], job['metadata'])
+        logger.info(f"Staged ({method}) {job['src']} -> {job['dest']}")
+        return job['dest'], checksum
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        results = list(executor.map(stage_job, jobs))
+
+    return {dest: checksum for dest, checksum in results if checksum is not None}
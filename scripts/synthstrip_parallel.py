@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import mask_validation
+from session_lists import read_session_list
+
+logger = logging.getLogger(__name__)
+
+# Per-image times at each thread count are cached here, relative to the dataset, so only the first run calibrates
+TIMINGS_FILE = os.path.join('code', 'synthstrip_timings.json')
+
+# Thread counts tried by the calibration
+CALIBRATION_THREADS = (1, 2, 4, 8)
+
+# Helps with CLI help formatting
+class RawDefaultsHelpFormatter(
+    argparse.RawTextHelpFormatter, argparse.ArgumentDefaultsHelpFormatter
+):
+    pass
+
+def synthstrip_parallel():
+
+    parser = argparse.ArgumentParser(formatter_class=RawDefaultsHelpFormatter, add_help = False,
+                                     description='''Run synthstrip on the T1w and ihMTR images of many sessions in parallel.
+
+    The available cores are divided between concurrent mri_synthstrip processes. synthstrip does not scale linearly
+    with its thread count, so several processes with a few threads each usually mask a cohort faster than one process
+    using every core. The split is planned from measured per-image times: unless --threads-per-process is given, the
+    first images are masked one at a time with 1, 2, 4 and 8 threads, and the thread count with the highest
+    throughput, ie (processes that fit in the cores and memory) / (time per image), is used for the rest. The times are
+    cached in the dataset, in code/synthstrip_timings.json, and reused by later runs.
+
+    Existing masks are checked before they are skipped: a mask that is truncated, empty, on a different grid from its
+    image, older than its image, or of implausible volume is made again. Masks are written to a temporary file and
+    renamed when complete, so an interrupted run does not leave partial masks.
+
+    Output is in the same dataset as the input:
+
+        <T1w prefix>_desc-synthstrip_mask.nii.gz
+        sub-<participant>_ses-<session>_desc-ihMTRSynthstrip_mask.nii.gz
+
+    and with --no-csf, the _desc-synthstripNoCSF and _desc-ihMTRSynthstripNoCSF masks.
+
+    This script only needs the Python standard library. It runs outside the container, and runs mri_synthstrip in the
+    FreeSurfer container with apptainer.
+
+    ''')
+    required_parser = parser.add_argument_group('Required arguments')
+    required_parser.add_argument('--input-dataset', help='Input dataset, as produced by gather_t1w_ihmt_inputs.sh',
+                                 type=str, required=True)
+    required_parser.add_argument('--container', help='FreeSurfer container with mri_synthstrip', type=str,
+                                 required=True)
+    required_parser.add_argument('--session-list', help='CSV file with participants and sessions, one per line, no '
+                                 'header', type=str, required=True)
+
+    optional_parser = parser.add_argument_group('General optional arguments')
+    optional_parser.add_argument('--shard', help='Only process shard i of N of the session list, as i/N. See '
+                                 'session_lists.py', type=str, default=None)
+    optional_parser.add_argument('--no-csf', help='Also make masks without CSF', action='store_true')
+    optional_parser.add_argument('--cores', help='Number of cores to use. Default is the number allocated to the job',
+                                 type=int, default=None)
+    optional_parser.add_argument('--threads-per-process', help='Threads for each mri_synthstrip process. Default is '
+                                 'planned from measured per-image times', type=int, default=None)
+    optional_parser.add_argument('--memory-gb', help='Memory available for mri_synthstrip processes, in GB. Default is '
+                                 'no limit', type=float, default=None)
+    optional_parser.add_argument('--memory-per-process-gb', help='Peak memory of one mri_synthstrip process, in GB',
+                                 type=float, default=3.0)
+    optional_parser.add_argument('--min-mask-volume-ml', help='Existing masks smaller than this are made again',
+                                 type=float, default=400.0)
+    optional_parser.add_argument('--max-mask-volume-ml', help='Existing masks larger than this are made again',
+                                 type=float, default=3000.0)
+    optional_parser.add_argument('--force', help='Make all masks again', action='store_true')
+    optional_parser.add_argument('-h', '--help', action='help', help='show this help message and exit')
+
+    if len(sys.argv) == 1:
+        parser.print_usage()
+        print(f"\nRun {os.path.basename(sys.argv[0])} --help for more information")
+        sys.exit(1)
+
+    args = parser.parse_args()
+
+    logger.info("Parsed args: " + str(args))
+
+    cores = args.cores if args.cores is not None else get_available_cores()
+
+    max_processes = cores
+    if args.memory_gb is not None:
+        max_processes = max(1, min(cores, int(args.memory_gb // args.memory_per_process_gb)))
+
+    sessions = read_session_list(args.session_list, shard=args.shard)
+
+    tasks = list()
+    num_valid = 0
+
+    for participant, session in sessions:
+        try:
+            session_tasks = get_session_tasks(args.input_dataset, participant, session, no_csf=args.no_csf)
+        except ValueError as e:
+            logger.error(f"Skipping participant {participant}, session {session}: {e}")
+            continue
+        for task in session_tasks:
+            if not args.force:
+                problems = mask_validation.check_mask(task['mask'], task['image'],
+                                                      min_volume_ml=args.min_mask_volume_ml,
+                                                      max_volume_ml=args.max_mask_volume_ml)
+                if len(problems) == 0:
+                    num_valid += 1
+                    continue
+                if os.path.exists(task['mask']):
+                    logger.info(f"Remaking {task['mask']}: {'; '.join(problems)}")
+            tasks.append(task)
+
+    logger.info(f"{num_valid} masks are valid, {len(tasks)} to make, using {cores} cores")
+
+    if len(tasks) == 0:
+        return
+
+    timings_file = os.path.join(args.input_dataset, TIMINGS_FILE)
+
+    num_failed = 0
+
+    if args.threads_per_process is not None:
+        threads = args.threads_per_process
+    else:
+        timings = read_timings(timings_file)
+        candidates = [t for t in CALIBRATION_THREADS if t <= cores and str(t) not in timings]
+        # Calibrate on T1w images, so the times are comparable
+        calibration_tasks = [task for task in tasks if task['kind'] == 'T1w'][:len(candidates)]
+        for candidate, task in zip(candidates, calibration_tasks):
+            elapsed = run_synthstrip(args.container, args.input_dataset, task, candidate)
+            if elapsed is not None:
+                timings[str(candidate)] = elapsed
+                logger.info(f"Calibration: {elapsed:.1f} s per image with {candidate} threads")
+            else:
+                num_failed += 1
+            tasks.remove(task)
+        if len(calibration_tasks) > 0:
+            write_timings(timings_file, timings)
+        threads = plan_threads(cores, max_processes, {int(t): s for t, s in timings.items()})
+
+    if len(tasks) == 0:
+        sys.exit(1 if num_failed > 0 else 0)
+
+    processes = max(1, min(cores // max(threads, 1), max_processes, len(tasks)))
+
+    logger.info(f"Running {processes} mri_synthstrip processes with {threads} threads each")
+
+    start_time = time.time()
+    num_made = len(tasks)
+
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(run_synthstrip, args.container, args.input_dataset, task, threads): task
+                   for task in tasks}
+        for future in as_completed(futures):
+            if future.result() is None:
+                num_made -= 1
+                num_failed += 1
+
+    elapsed = time.time() - start_time
+    logger.info(f"Made {num_made} masks in {elapsed:.0f} s ({3600.0 * num_made / max(elapsed, 1e-6):.0f} per hour), "
+                f"{num_failed} failed")
+
+    if num_failed > 0:
+        sys.exit(1)
+
+
+def get_available_cores():
+    """
+    Get the number of cores available to this job.
+
+    Returns:
+        int: the LSF slot count if set, otherwise the CPUs this process may run on.
+    """
+    if os.environ.get('LSB_DJOB_NUMPROC', '').isdigit():
+        return max(1, int(os.environ['LSB_DJOB_NUMPROC']))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_session_tasks(input_dataset, participant, session, no_csf=False):
+    """
+    List the masks to make for a session.
+
+    Args:
+        input_dataset (str): input dataset.
+        participant (str): Participant ID.
+        session (str): Session ID.
+        no_csf (bool): include the masks without CSF.
+
+    Returns:
+        list: dicts with keys 'kind' ('T1w' or 'ihMTR'), 'image', 'mask' and 'args', the extra mri_synthstrip arguments.
+
+    Raises:
+        ValueError: if the session does not have exactly one T1w and one ihMTR image.
+    """
+    anat_dir = os.path.join(input_dataset, f"sub-{participant}", f"ses-{session}", 'anat')
+
+    # There should be one of each of these images selected by the gather script
+    t1w = glob.glob(os.path.join(anat_dir, f"sub-{participant}_ses-{session}*_desc-preproc_T1w.nii.gz"))
+    mag = glob.glob(os.path.join(anat_dir, f"sub-{participant}_ses-{session}*_ihMTR.nii.gz"))
+
+    if len(t1w) != 1 or len(mag) != 1:
+        raise ValueError(f"expected one T1w and one ihMTR image, found {len(t1w)} and {len(mag)}")
+
+    t1w_derivative_root = t1w[0][:-len('_desc-preproc_T1w.nii.gz')]
+    ihmtr_root = os.path.join(anat_dir, f"sub-{participant}_ses-{session}")
+
+    tasks = [{'kind': 'T1w', 'image': t1w[0], 'mask': f"{t1w_derivative_root}_desc-synthstrip_mask.nii.gz",
+              'args': []},
+             {'kind': 'ihMTR', 'image': mag[0], 'mask': f"{ihmtr_root}_desc-ihMTRSynthstrip_mask.nii.gz", 'args': []}]
+
+    if no_csf:
+        # As in synthstrip_t1w_ihmt.sh, the ihMTR NoCSF mask is made without --no-csf
+        tasks.append({'kind': 'T1w', 'image': t1w[0], 'mask': f"{t1w_derivative_root}_desc-synthstripNoCSF_mask.nii.gz",
+                      'args': ['--no-csf']})
+        tasks.append({'kind': 'ihMTR', 'image': mag[0], 'mask': f"{ihmtr_root}_desc-ihMTRSynthstripNoCSF_mask.nii.gz",
+                      'args': []})
+
+    return tasks
+
+
+def run_synthstrip(container, input_dataset, task, threads):
+    """
+    Make one mask with mri_synthstrip in the container.
+
+    The mask is written to a temporary file in the same directory, and renamed to the mask name when synthstrip
+    finishes.
+
+    Args:
+        container (str): FreeSurfer container.
+        input_dataset (str): input dataset, bound in the container.
+        task (dict): task from get_session_tasks.
+        threads (int): mri_synthstrip threads.
+
+    Returns:
+        float: elapsed time in seconds, or None if synthstrip failed.
+    """
+    mask_dir, mask_name = os.path.split(task['mask'])
+    tmp_mask = os.path.join(mask_dir, f".tmp_{os.getpid()}_{mask_name}")
+
+    cmd = ['apptainer', 'exec', '--containall', '-B', input_dataset, container,
+           'mri_synthstrip', '--image', task['image'], '--mask', tmp_mask, '--threads', str(threads)] + task['args']
+
+    start_time = time.time()
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    elapsed = time.time() - start_time
+
+    if result.returncode != 0 or not os.path.exists(tmp_mask):
+        logger.error(f"mri_synthstrip failed for {task['image']}, exit code {result.returncode}:\n{result.stdout}")
+        if os.path.exists(tmp_mask):
+            os.remove(tmp_mask)
+        return None
+
+    os.replace(tmp_mask, task['mask'])
+    logger.info(f"Made {task['mask']} in {elapsed:.1f} s")
+
+    return elapsed
+
+
+def plan_threads(cores, max_processes, timings):
+    """
+    Choose the threads per process that masks the most images per second.
+
+    Args:
+        cores (int): cores available.
+        max_processes (int): most processes that fit in memory.
+        timings (dict): threads -> measured seconds per image.
+
+    Returns:
+        int: threads per process. If there are no timings, 2, as in synthstrip_t1w_ihmt.sh.
+    """
+    timings = {t: s for t, s in timings.items() if t <= cores and s > 0}
+
+    if len(timings) == 0:
+        return min(2, cores)
+
+    def throughput(threads):
+        return min(cores // threads, max_processes) / timings[threads]
+
+    return max(sorted(timings), key=throughput)
+
+
+def read_timings(timings_file):
+    """
+    Read cached per-image synthstrip times.
+
+    Args:
+        timings_file (str): JSON file.
+
+    Returns:
+        dict: thread count, as a string -> seconds per image. Empty if the file does not exist.
+    """
+    if not os.path.exists(timings_file):
+        return dict()
+    with open(timings_file, 'r') as f:
+        return json.load(f).get('SecondsPerImage', dict())
+
+
+def write_timings(timings_file, timings):
+    """
+    Write per-image synthstrip times.
+
+    Args:
+        timings_file (str): JSON file.
+        timings (dict): thread count, as a string -> seconds per image.
+    """
+    os.makedirs(os.path.dirname(timings_file), exist_ok=True)
+    with open(timings_file, 'w') as f:
+        json.dump({'SecondsPerImage': timings}, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    synthstrip_parallel()
@@ -0,0 +1,215 @@
+"""
+A file-based queue of session tasks, shared by worker processes on any host that can see the queue directory.
+
+The queue is a directory with one subdirectory per task state:
+
+    <queue>/pending/   tasks waiting for a worker
+    <queue>/running/   tasks claimed by a worker
+    <queue>/done/      finished tasks, with the worker, timings and exit status added
+    <queue>/failed/    tasks that raised an error or exited non-zero
+
+Each task is a JSON file. A worker claims a task by renaming it from pending/ to running/; rename is atomic, so
+exactly one worker gets each task, without a lock or a server. Task names start with the submission time, so tasks
+are claimed in submission order.
+
+A task left in running/ by a worker that was killed is not retried automatically; requeue_tasks moves it back to
+pending/. Tasks are safe to repeat, since the stages skip sessions whose completion manifest is up to date.
+
+This module only uses the standard library, so tasks can be submitted outside the container.
+"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+STATE_PENDING = 'pending'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+TASK_STATES = (STATE_PENDING, STATE_RUNNING, STATE_DONE, STATE_FAILED)
+
+
+def get_state_dir(queue_dir, state):
+    """
+    Get the directory holding the tasks in a state.
+
+    Args:
+        queue_dir (str): queue directory.
+        state (str): task state, one of TASK_STATES.
+
+    Returns:
+        str: directory for the state.
+    """
+    if state not in TASK_STATES:
+        raise ValueError(f"Invalid task state: {state}. Options are {TASK_STATES}")
+    return os.path.join(queue_dir, state)
+
+
+def _write_json_atomic(data, output_file):
+    output_dir = os.path.dirname(output_file)
+    with tempfile.NamedTemporaryFile('w', dir=output_dir, prefix='.tmp_', suffix='.json', delete=False) as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        tmp_path = f.name
+    os.replace(tmp_path, output_file)
+
+
+def list_tasks(queue_dir, state):
+    """
+    List the task files in a state, in submission order.
+
+    Args:
+        queue_dir (str): queue directory.
+        state (str): task state.
+
+    Returns:
+        list: task file names.
+    """
+    state_dir = get_state_dir(queue_dir, state)
+    if not os.path.isdir(state_dir):
+        return list()
+    return sorted(f for f in os.listdir(state_dir) if f.endswith('.json') and not f.startswith('.'))
+
+
+def add_task(queue_dir, stage, participant, session, args):
+    """
+    Add a task to the queue.
+
+    Args:
+        queue_dir (str): queue directory.
+        stage (str): stage to run.
+        participant (str): participant ID.
+        session (str): session ID.
+        args (list): command line arguments for the stage, including the participant and session.
+
+    Returns:
+        str: task file name.
+    """
+    for state in TASK_STATES:
+        os.makedirs(get_state_dir(queue_dir, state), exist_ok=True)
+
+    safe_id = re.sub(r'[^A-Za-z0-9._-]', '', f"{stage}_sub-{participant}_ses-{session}")
+    task_name = f"{time.time_ns():020d}_{safe_id}.json"
+
+    task = {'Stage': stage, 'Participant': participant, 'Session': session, 'Args': list(args),
+            'Submitted': datetime.datetime.now().isoformat(timespec='seconds')}
+
+    _write_json_atomic(task, os.path.join(get_state_dir(queue_dir, STATE_PENDING), task_name))
+
+    return task_name
+
+
+def claim_task(queue_dir, worker_id):
+    """
+    Claim the oldest pending task.
+
+    Args:
+        queue_dir (str): queue directory.
+        worker_id (str): identifier of the claiming worker, recorded in the task.
+
+    Returns:
+        tuple: (task name, task dict), or (None, None) if there are no pending tasks.
+    """
+    pending_dir = get_state_dir(queue_dir, STATE_PENDING)
+    running_dir = get_state_dir(queue_dir, STATE_RUNNING)
+
+    for task_name in list_tasks(queue_dir, STATE_PENDING):
+        try:
+            os.rename(os.path.join(pending_dir, task_name), os.path.join(running_dir, task_name))
+        except FileNotFoundError:
+            # Claimed by another worker
+            continue
+
+        running_file = os.path.join(running_dir, task_name)
+        with open(running_file, 'r') as f:
+            task = json.load(f)
+
+        task['Worker'] = worker_id
+        task['Started'] = datetime.datetime.now().isoformat(timespec='seconds')
+        _write_json_atomic(task, running_file)
+
+        return task_name, task
+
+    return None, None
+
+
+def finish_task(queue_dir, task_name, task, succeeded, elapsed_seconds, error=None):
+    """
+    Move a claimed task to done/ or failed/, recording how it ran.
+
+    Args:
+        queue_dir (str): queue directory.
+        task_name (str): task file name, from claim_task.
+        task (dict): task, from claim_task.
+        succeeded (bool): whether the task succeeded.
+        elapsed_seconds (float): run time of the task.
+        error (str, optional): error message for a failed task.
+
+    Returns:
+        str: path of the finished task file.
+    """
+    state = STATE_DONE if succeeded else STATE_FAILED
+
+    task = dict(task)
+    task['Finished'] = datetime.datetime.now().isoformat(timespec='seconds')
+    task['ElapsedSeconds'] = round(elapsed_seconds, 1)
+    if error is not None:
+        task['Error'] = error
+
+    finished_file = os.path.join(get_state_dir(queue_dir, state), task_name)
+    _write_json_atomic(task, finished_file)
+    os.remove(os.path.join(get_state_dir(queue_dir, STATE_RUNNING), task_name))
+
+    return finished_file
+
+
+def release_task(queue_dir, task_name):
+    """
+    Put a claimed task back in pending/, eg when its worker is terminated before the task finishes.
+
+    Args:
+        queue_dir (str): queue directory.
+        task_name (str): task file name, from claim_task.
+
+    Returns:
+        str: path of the pending task file.
+    """
+    pending_file = os.path.join(get_state_dir(queue_dir, STATE_PENDING), task_name)
+    os.rename(os.path.join(get_state_dir(queue_dir, STATE_RUNNING), task_name), pending_file)
+    return pending_file
+
+
+def requeue_tasks(queue_dir, state):
+    """
+    Move tasks back to pending/, eg tasks left running by killed workers, or failed tasks after a fix.
+
+    Only requeue running tasks when no workers are using the queue, since a live worker's task would then run twice.
+
+    Args:
+        queue_dir (str): queue directory.
+        state (str): state to requeue, 'running' or 'failed'.
+
+    Returns:
+        list: requeued task file names.
+    """
+    if state not in (STATE_RUNNING, STATE_FAILED):
+        raise ValueError(f"Only running or failed tasks can be requeued, not {state}")
+
+    state_dir = get_state_dir(queue_dir, state)
+    pending_dir = get_state_dir(queue_dir, STATE_PENDING)
+
+    requeued = list()
+    for task_name in list_tasks(queue_dir, state):
+        try:
+            os.rename(os.path.join(state_dir, task_name), os.path.join(pending_dir, task_name))
+        except FileNotFoundError:
+            continue
+        requeued.append(task_name)
+
+    return requeued
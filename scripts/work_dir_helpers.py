@@ -0,0 +1,234 @@
+"""
+Working directories for intermediate files, on a RAM disk when there is memory to spare.
+
+The stages write many intermediate images, which are read back soon after, by ANTs tools and by numpy. By default these
+go to a temporary directory under TMPDIR, which the wrappers bind to /scratch, a shared file system. With a RAM budget,
+the working directory is placed on /dev/shm instead, if
+
+    - /dev/shm has at least the budget free, and
+    - the memory available to the job, in its cgroup if it has a limit, and on the node, is at least the budget.
+
+Files on /dev/shm count against the memory of the job, so the budget should be the expected peak size of the working
+directory, which is reported at the end of each session, and is otherwise left for the stage itself.
+
+The working directory is removed when the stage finishes, fails or is killed with SIGTERM, as LSF does when a job is
+killed or exceeds its run limit, unless it is kept for debugging. SIGTERM raises Terminated, which is a SystemExit, so
+a script exits with status 143 after cleaning up, and a caller running stages in-process can tell termination apart
+from a failed stage.
+
+This module only uses the standard library.
+"""
+
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+SHM_DIR = '/dev/shm'
+
+# Exit status of a process terminated by SIGTERM
+TERMINATED_EXIT_CODE = 128 + signal.SIGTERM
+
+_CGROUP_FILES = (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                 ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes'))
+
+
+class Terminated(SystemExit):
+    """
+    Raised when the process receives SIGTERM, with the exit status of a process killed by the signal.
+    """
+
+
+def raise_terminated(signum, frame):
+    """
+    Signal handler that raises Terminated, so that the stack unwinds and cleanup runs.
+    """
+    raise Terminated(128 + signum)
+
+
+def get_available_memory_mb():
+    """
+    Get the memory available to this process, the smaller of the node's available memory and the headroom of the
+    process's cgroup.
+
+    Returns:
+        float: available memory in MB, or None if it can not be determined.
+    """
+    available = list()
+
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available.append(int(line.split()[1]) / 1024.0)
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+
+    for limit_file, usage_file in _CGROUP_FILES:
+        try:
+            with open(limit_file, 'r') as f:
+                limit = f.read().strip()
+            with open(usage_file, 'r') as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        # Unlimited cgroups report 'max', or a very large number
+        if limit != 'max' and int(limit) < 2 ** 60:
+            available.append((int(limit) - usage) / (1024.0 * 1024.0))
+        break
+
+    return min(available) if len(available) > 0 else None
+
+
+def get_free_space_mb(path):
+    """
+    Get the free space on the file system of a path.
+
+    Args:
+        path (str): a path on the file system.
+
+    Returns:
+        float: free space in MB, or None if the path does not exist.
+    """
+    try:
+        stat = os.statvfs(path)
+    except OSError:
+        return None
+    return stat.f_bavail * stat.f_frsize / (1024.0 * 1024.0)
+
+
+def choose_placement(shm_budget_mb):
+    """
+    Choose where to put a working directory.
+
+    Args:
+        shm_budget_mb (float): RAM that may be used for the working directory, in MB. If 0 or None, the working
+            directory is under TMPDIR.
+
+    Returns:
+        tuple: (placement, reason), where placement is 'shm' or 'scratch'.
+    """
+    if shm_budget_mb is None or shm_budget_mb <= 0:
+        return 'scratch', 'no RAM budget'
+
+    if not os.path.isdir(SHM_DIR) or not os.access(SHM_DIR, os.W_OK):
+        return 'scratch', f"{SHM_DIR} is not writable"
+
+    free_mb = get_free_space_mb(SHM_DIR)
+    if free_mb is None or free_mb < shm_budget_mb:
+        return 'scratch', f"{SHM_DIR} has {free_mb or 0:.0f} MB free, less than the budget of {shm_budget_mb:.0f} MB"
+
+    available_mb = get_available_memory_mb()
+    if available_mb is not None and available_mb < shm_budget_mb:
+        return 'scratch', f"{available_mb:.0f} MB of memory available, less than the budget of {shm_budget_mb:.0f} MB"
+
+    return 'shm', f"{free_mb:.0f} MB free on {SHM_DIR}"
+
+
+def get_directory_size_mb(path):
+    """
+    Get the total size of the files under a directory.
+
+    Args:
+        path (str): directory.
+
+    Returns:
+        float: size in MB. Files removed while the directory is walked are ignored.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total / (1024.0 * 1024.0)
+
+
+class WorkDir:
+    """
+    A working directory that is removed when the stage finishes, fails or is terminated.
+
+    Use as a context manager:
+
+        with WorkDir(f"ihmt_label_stats_{participant}", shm_budget_mb=args.work_dir_shm_mb) as managed_work_dir:
+            work_dir = managed_work_dir.path
+            ...
+            managed_work_dir.report('resampling')
+
+    Args:
+        suffix (str): suffix of the directory name.
+        shm_budget_mb (float, optional): RAM that may be used for the working directory, in MB. See choose_placement.
+        keep (bool): keep the directory at the end, for debugging. Its path is logged.
+    """
+
+    def __init__(self, suffix, shm_budget_mb=None, keep=False):
+        self.placement, reason = choose_placement(shm_budget_mb)
+        self.keep = keep
+        self.peak_mb = 0.0
+        self.usage = dict()
+
+        parent_dir = SHM_DIR if self.placement == 'shm' else None
+        self.path = tempfile.mkdtemp(suffix=f"{suffix}.tmpdir", dir=parent_dir)
+
+        logger.info(f"Working directory {self.path} ({self.placement}: {reason})")
+
+        self._previous_handler = None
+
+    def __enter__(self):
+        # Turn SIGTERM into Terminated, so the directory is cleaned up when the job is killed. Signal handlers can only
+        # be set in the main thread
+        if threading.current_thread() is threading.main_thread():
+            self._previous_handler = signal.signal(signal.SIGTERM, raise_terminated)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._previous_handler is not None:
+            signal.signal(signal.SIGTERM, self._previous_handler)
+            self._previous_handler = None
+        self.report('stage')
+        self.cleanup()
+        return False
+
+    def report(self, stage):
+        """
+        Log the size of the working directory after a step, and update the peak size.
+
+        Args:
+            stage (str): name of the step.
+
+        Returns:
+            float: size in MB.
+        """
+        if not os.path.isdir(self.path):
+            return 0.0
+        size_mb = get_directory_size_mb(self.path)
+        self.peak_mb = max(self.peak_mb, size_mb)
+        self.usage[stage] = round(size_mb, 1)
+        logger.info(f"Working directory size after {stage}: {size_mb:.1f} MB ({self.placement})")
+        return size_mb
+
+    def resources(self):
+        """
+        Get the working directory usage, for the completion manifest.
+
+        Returns:
+            dict: WorkDirPlacement, 'shm' or 'scratch', WorkDirPeakMB, the largest size reported so far, and
+                WorkDirSizeMB, the size in MB after each reported step.
+        """
+        return {'WorkDirPlacement': self.placement, 'WorkDirPeakMB': round(self.peak_mb, 1),
+                'WorkDirSizeMB': dict(self.usage)}
+
+    def cleanup(self):
+        """
+        Remove the working directory, unless it is kept.
+        """
+        if self.keep:
+            logger.info(f"Keeping working directory {self.path}")
+            return
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,128 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+import aggregate_label_stats  # noqa: E402
+
+
+def write_session(dataset, participant, session):
+    anat_dir = os.path.join(dataset, f"sub-{participant}", f"ses-{session}", 'anat')
+    os.makedirs(anat_dir)
+    prefix = os.path.join(anat_dir, f"sub-{participant}_ses-{session}_space-ihmt")
+    for atlas, labels in (('dkt31', [1, 2, 3]), ('hoa', [1, 5])):
+        pd.DataFrame({'label': labels, 'mean': [float(label) for label in labels]}).to_csv(
+            f"{prefix}_seg-{atlas}_ihMTRstats.tsv", sep='\t', index=False)
+    pd.DataFrame({'tissue': ['csf', 'gm', 'wm'], 'volume': [1.0, 2.0, 3.0]}).to_csv(
+        f"{prefix}_desc-qc_brainstats.tsv", sep='\t', index=False)
+
+
+@pytest.fixture(params=['parquet', 'feather'])
+def store(request, tmp_path):
+    dataset = str(tmp_path / 'dataset')
+    for participant, session in (('01', '01'), ('02', '01')):
+        write_session(dataset, participant, session)
+    store = str(tmp_path / 'store')
+    aggregate_label_stats.update_store(dataset, store, store_format=request.param, threads=2)
+    return store
+
+
+def test_read_all_atlases(store):
+    df = aggregate_label_stats.read_label_stats(store)
+    assert sorted(df['atlas'].unique()) == ['dkt31', 'hoa', 'qc']
+    assert len(df) == 2 * (3 + 2 + 3)
+
+
+def test_read_labels_across_atlases(store):
+    df = aggregate_label_stats.read_label_stats(store, labels=[1])
+    assert sorted(df['atlas'].unique()) == ['dkt31', 'hoa']
+    assert set(df['label']) == {1}
+    assert len(df) == 2 * 2
+
+
+def test_read_labels_and_participants(store):
+    df = aggregate_label_stats.read_label_stats(store, atlas=['dkt31', 'qc'], labels=[2, 3], participants=['02'])
+    assert list(df['atlas'].unique()) == ['dkt31']
+    assert set(df['participant']) == {'02'}
+    assert sorted(df['label']) == [2, 3]
+
+
+def test_read_columns_across_atlases(store):
+    df = aggregate_label_stats.read_label_stats(store, columns=['mean'])
+    assert set(df.columns) == set(aggregate_label_stats.ID_COLUMNS + ['mean'])
+    assert df.loc[df['atlas'] == 'qc', 'mean'].isna().all()
+
+
+def read_partition(store, atlas, table='ihMTRstats'):
+    df = aggregate_label_stats.read_label_stats(store, atlas=atlas, table=table)
+    return df.sort_values(['participant', 'session', 'label']).reset_index(drop=True)
+
+
+def test_update_replaces_changed_rows(tmp_path):
+    dataset = str(tmp_path / 'dataset')
+    for participant, session in (('01', '01'), ('02', '01')):
+        write_session(dataset, participant, session)
+    store = str(tmp_path / 'store')
+    aggregate_label_stats.update_store(dataset, store, threads=2)
+
+    changed_file = os.path.join(dataset, 'sub-01', 'ses-01', 'anat',
+                                'sub-01_ses-01_space-ihmt_seg-dkt31_ihMTRstats.tsv')
+    pd.DataFrame({'label': [1, 2], 'mean': [10.5, 20.5]}).to_csv(changed_file, sep='\t', index=False)
+    stat = os.stat(changed_file)
+    os.utime(changed_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    aggregate_label_stats.update_store(dataset, store, threads=2)
+
+    df = read_partition(store, 'dkt31')
+    assert df.loc[df['participant'] == '01', 'mean'].tolist() == [10.5, 20.5]
+    assert df.loc[df['participant'] == '02', 'mean'].tolist() == [1.0, 2.0, 3.0]
+    # Other atlases are unchanged
+    assert len(read_partition(store, 'hoa')) == 4
+
+
+def test_update_drops_removed_rows(tmp_path):
+    dataset = str(tmp_path / 'dataset')
+    for participant, session in (('01', '01'), ('02', '01')):
+        write_session(dataset, participant, session)
+    store = str(tmp_path / 'store')
+    aggregate_label_stats.update_store(dataset, store, threads=2)
+
+    os.remove(os.path.join(dataset, 'sub-02', 'ses-01', 'anat', 'sub-02_ses-01_space-ihmt_seg-hoa_ihMTRstats.tsv'))
+
+    aggregate_label_stats.update_store(dataset, store, threads=2)
+
+    hoa = read_partition(store, 'hoa')
+    assert set(hoa['participant']) == {'01'}
+    assert len(hoa) == 2
+    assert set(read_partition(store, 'dkt31')['participant']) == {'01', '02'}
+
+    sources = pd.read_csv(os.path.join(store, aggregate_label_stats.SOURCES_INDEX), sep='\t')
+    assert not sources['path'].str.contains('sub-02_ses-01_space-ihmt_seg-hoa').any()
+
+
+def test_update_adds_new_sessions(tmp_path):
+    dataset = str(tmp_path / 'dataset')
+    write_session(dataset, '01', '01')
+    store = str(tmp_path / 'store')
+    aggregate_label_stats.update_store(dataset, store, threads=2)
+
+    write_session(dataset, '01', '02')
+    aggregate_label_stats.update_store(dataset, store, threads=2)
+
+    df = read_partition(store, 'dkt31')
+    assert sorted(set(zip(df['participant'], df['session']))) == [('01', '01'), ('01', '02')]
+    assert len(df) == 6
+
+
+def test_update_rejects_other_format(tmp_path):
+    dataset = str(tmp_path / 'dataset')
+    write_session(dataset, '01', '01')
+    store = str(tmp_path / 'store')
+    aggregate_label_stats.update_store(dataset, store, store_format='parquet', threads=2)
+
+    write_session(dataset, '02', '01')
+    with pytest.raises(ValueError, match='parquet'):
+        aggregate_label_stats.update_store(dataset, store, store_format='feather', threads=2)
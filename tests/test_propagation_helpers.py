@@ -0,0 +1,73 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+import propagation_helpers  # noqa: E402
+
+ants = pytest.importorskip('ants')
+
+
+def sphere_labels():
+    """WM sphere surrounded by a shell of cortex, split into six labels by angle."""
+    z, y, x = np.indices((32, 32, 32))
+    radius = np.sqrt((z - 15.5) ** 2 + (y - 15.5) ** 2 + (x - 15.5) ** 2)
+    wm = (radius < 9).astype(np.uint8)
+    angle = np.arctan2(y - 15.5, x - 15.5)
+    sectors = np.digitize(angle, np.linspace(-np.pi, np.pi, 7)[1:-1]) + 1
+    labels = np.where((radius >= 9) & (radius < 12), sectors, 0).astype(np.uint32)
+    return wm, labels
+
+
+def itk_propagate(mask, labels):
+    return ants.iMath_propagate_labels_through_mask(ants.from_numpy(mask.astype(np.float32)),
+                                                    ants.from_numpy(labels.astype(np.float32))).numpy().astype(
+                                                        np.uint32)
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_dilate_mask_matches_itk(seed):
+    mask = (np.random.default_rng(seed).random((20, 18, 16)) > 0.8).astype(np.uint8)
+    expected = ants.iMath(ants.from_numpy(mask.astype(np.float32)), 'MD', 2).numpy() > 0
+    np.testing.assert_array_equal(propagation_helpers.dilate_mask(mask, 2) > 0, expected)
+
+
+@pytest.mark.parametrize('method', propagation_helpers.PROPAGATION_METHODS)
+def test_propagation_matches_itk_between_slabs(method):
+    mask = np.zeros((24, 20, 16), dtype=np.uint8)
+    mask[3:21, 3:17, 3:13] = 1
+    labels = np.zeros(mask.shape, dtype=np.uint32)
+    labels[3, 3:17, 3:13] = 1
+    labels[20, 3:17, 3:13] = 2
+
+    output = propagation_helpers.propagate_labels_through_mask(mask, labels, method=method)
+
+    np.testing.assert_array_equal(output, itk_propagate(mask, labels))
+
+
+@pytest.mark.parametrize('method', propagation_helpers.PROPAGATION_METHODS)
+def test_propagation_close_to_itk_into_wm(method):
+    wm, labels = sphere_labels()
+    mask = propagation_helpers.dilate_mask(wm, 2)
+
+    output = propagation_helpers.propagate_labels_through_mask(mask, labels, method=method)
+    expected = itk_propagate(mask, labels)
+
+    assert np.all(output[mask == 0] == 0)
+    assert np.all(output[mask > 0] > 0)
+    # Fast marching and the numpy methods differ only near the boundaries between labels
+    assert np.mean(output[wm > 0] == expected[wm > 0]) > 0.9
+
+
+@pytest.mark.parametrize('max_distance', [None, 3.0])
+def test_bfs_threads_do_not_change_result(max_distance):
+    wm, labels = sphere_labels()
+    mask = propagation_helpers.dilate_mask(wm, 2)
+
+    single = propagation_helpers.propagate_labels_through_mask(mask, labels, method='bfs', max_distance=max_distance)
+    for threads in (2, 3, 5):
+        np.testing.assert_array_equal(propagation_helpers.propagate_labels_through_mask(
+            mask, labels, method='bfs', max_distance=max_distance, threads=threads), single)